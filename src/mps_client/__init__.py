@@ -22,4 +22,11 @@ __version__ = "0.3.1"
 
 
 from mps_client.core.graph_queries import run_raw_graph_query
-from mps_client.core.queries import get_process_history, run_raw_query
+from mps_client.core.queries import (
+    get_foms,
+    get_process_histories,
+    get_process_history,
+    get_sample_foms,
+    run_raw_query,
+    stream_raw_query,
+)
@@ -46,6 +46,24 @@ class ConnectionTimeoutError(MPSClientException):
     """Raised when an http connection request times out."""
 
 
+class RangeRequestsNotSupported(MPSClientException):
+    """Raised when a server does not support http range requests for random access into a file."""
+
+
+class ChecksumMismatch(MPSClientException):
+    """Raised when a downloaded file does not match the checksum listed in its record."""
+
+    url: Optional[str]
+    expected: Optional[str]
+    actual: Optional[str]
+
+    def __init__(self, message: str = '', url: str = None, expected: str = None, actual: str = None) -> None:
+        super().__init__(message)
+        self.url = url
+        self.expected = expected
+        self.actual = actual
+
+
 class DeadUrlError(MPSClientException):
     """Raised when a link redirects to a dead url."""
 
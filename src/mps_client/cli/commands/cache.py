@@ -0,0 +1,85 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import typer
+from pydantic import ByteSize, parse_obj_as
+from rich.table import Table
+
+import mps_client.cli.styles as styles
+from mps_client.configuration import settings
+from mps_client.utils.cache import CacheEntry, DiskCache
+
+cache_app = typer.Typer(
+    name='cache', no_args_is_help=True, help="Inspect and prune the local download cache."
+)
+
+
+def _get_cache() -> DiskCache:
+    return DiskCache(settings.CACHE_DIR, ttl=settings.CACHE_TTL, max_size=settings.CACHE_MAX_SIZE)
+
+
+def _human(size: int) -> str:
+    return ByteSize(size).human_readable()
+
+
+@cache_app.command(name="info")
+def cache_info():
+    """
+    Show the location, limits and contents of the local cache.
+    """
+    cache = _get_cache()
+    by_namespace: Dict[str, List[CacheEntry]] = defaultdict(list)
+    for entry in cache.entries():
+        by_namespace[entry.namespace].append(entry)
+
+    styles.console.print(f'Cache directory: {cache.root}' + ('' if settings.CACHE_ENABLED else ' (disabled)'))
+    ttl_str = f'{cache.ttl}s' if cache.ttl is not None else 'none'
+    max_size_str = _human(cache.max_size) if cache.max_size is not None else 'none'
+    styles.console.print(f'TTL: {ttl_str}, max size: {max_size_str}')
+    table = Table(title='Cache contents', width=styles.console.width)
+    table.add_column('Namespace')
+    table.add_column('Entries')
+    table.add_column('Size')
+    for namespace, entries in sorted(by_namespace.items()):
+        table.add_row(namespace, str(len(entries)), _human(sum(entry.size for entry in entries)))
+    total = sum((entries for entries in by_namespace.values()), [])
+    table.add_row('total', str(len(total)), _human(sum(entry.size for entry in total)))
+    styles.console.print(table)
+
+
+@cache_app.command(name="prune")
+def cache_prune(
+    max_size: Optional[str] = typer.Option(
+        None, '--max-size', help='Evict least recently used entries above this size, e.g. 2GiB.'
+    ),
+    ttl: Optional[int] = typer.Option(None, '--ttl', help='Remove entries older than this many seconds.'),
+    namespace: Optional[str] = typer.Option(
+        None, '--namespace', help='Only prune entries in this namespace.'
+    ),
+    clear: bool = typer.Option(False, '--all', help='Remove every entry.'),
+):
+    """
+    Remove expired entries and evict entries until the cache is under its maximum size.
+    """
+    cache = _get_cache()
+    if clear:
+        removed = cache.clear(namespace)
+    else:
+        size_limit = parse_obj_as(ByteSize, max_size) if max_size is not None else None
+        removed = cache.prune(ttl=ttl, max_size=size_limit, namespace=namespace)
+    styles.good_typer_print(
+        f'Removed {len(removed)} entries ({_human(sum(entry.size for entry in removed))}) from {cache.root}'
+    )
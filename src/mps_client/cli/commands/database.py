@@ -11,12 +11,21 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
+from typing import List, Optional
+
 import typer
+from rich.table import Table
 
 import mps_client.cli.styles as styles
+from mps_client.core.indexes import IndexReport, apply_indexes, plan_indexes
+from mps_client.core.views import VIEWS, refresh_views
 from mps_client.database.session import get_connection
 
 database_app = typer.Typer(name='database', no_args_is_help=True, help="Test connection to the database.")
+indexes_app = typer.Typer(
+    name='indexes', no_args_is_help=True, help="Index the join keys and views used by mps-client queries."
+)
+database_app.add_typer(indexes_app)
 
 
 @database_app.command(name="test")
@@ -41,3 +50,83 @@ def test_connection(
         failed = True
     styles.delimiter()
     raise typer.Exit(code=2 if failed else 0)
+
+
+@database_app.command(name="refresh-views")
+def refresh_views_command(
+    views: Optional[List[str]] = typer.Option(
+        None, '--view', help=f'View to refresh, can be repeated. Defaults to all of {", ".join(VIEWS)}.'
+    ),
+    concurrently: bool = typer.Option(
+        True,
+        '--concurrently/--blocking',
+        help='Refresh without blocking queries reading the views, slower than a blocking refresh.',
+    ),
+):
+    """
+    Create the materialized views used to speed up queries, or refresh them after new data is loaded
+    """
+    try:
+        with styles.console.status('Refreshing views...'):
+            actions = refresh_views(views, concurrently)
+    except ValueError as exc:
+        raise typer.BadParameter(str(exc))
+    for name, action in actions:
+        styles.good_typer_print(f'View {name} {action}')
+
+
+@indexes_app.command(name="plan")
+def plan_indexes_command():
+    """
+    Show the missing indexes and the estimated cost of the queries with them
+    """
+    with styles.console.status('Planning indexes...'):
+        report = plan_indexes()
+    _print_index_report(report)
+    if not report.hypothetical and report.missing:
+        styles.console.print('Install the hypopg extension to estimate query costs with the missing indexes.')
+
+
+@indexes_app.command(name="apply")
+def apply_indexes_command(
+    benchmark: bool = typer.Option(
+        True, '--benchmark/--no-benchmark', help='Time the queries before and after creating the indexes.'
+    ),
+):
+    """
+    Create the missing indexes with CREATE INDEX CONCURRENTLY
+    """
+    with styles.console.status('Creating indexes...'):
+        report = apply_indexes(benchmark=benchmark)
+    _print_index_report(report)
+
+
+def _print_index_report(report: IndexReport) -> None:
+    table = Table(title='Indexes', width=styles.console.width)
+    table.add_column('Index')
+    table.add_column('Table')
+    table.add_column('Status')
+    for status in report.indexes:
+        state = {True: 'exists', False: 'invalid', None: 'missing'}[status.valid]
+        table.add_row(status.spec.name, status.spec.table, state)
+    styles.console.print(table)
+    if not report.timings:
+        return
+
+    def number(value, unit=''):
+        return '-' if value is None else f'{value:,.2f}{unit}'
+
+    table = Table(title='Query speedups', width=styles.console.width)
+    for column in ('Query', 'Cost before', 'Cost after', 'Estimated', 'Before', 'After', 'Observed'):
+        table.add_column(column)
+    for timing in report.timings:
+        table.add_row(
+            timing.query,
+            number(timing.cost_before),
+            number(timing.cost_after),
+            number(timing.estimated_speedup, 'x'),
+            number(timing.ms_before, 'ms'),
+            number(timing.ms_after, 'ms'),
+            number(timing.observed_speedup, 'x'),
+        )
+    styles.console.print(table)
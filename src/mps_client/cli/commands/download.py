@@ -12,23 +12,50 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 import asyncio
+import json
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional, Tuple
 from uuid import UUID
 
+import httpx
 import typer
+from rich.table import Table
+from sqlalchemy.exc import DBAPIError
 
 import mps_client.cli.styles as styles
 from mps_client._enums import EntityType
 from mps_client._exceptions import (
+    ChecksumMismatch,
     ConnectionTimeoutError,
     DeadUrlError,
     DOINotFound,
     MPSClientException,
+    RangeRequestsNotSupported,
     RequestLimitation,
 )
-from mps_client.core.download import async_download_doi, get_redirect_link_from_doi, get_zip_links_from_doi
-from mps_client.core.queries import get_doi
+from mps_client.cli.options import (
+    exclude_option,
+    force_option,
+    include_option,
+    processes_option,
+    stats_json_option,
+    stats_option,
+    use_cache_option,
+)
+from mps_client.configuration import settings
+from mps_client.core.download import (
+    DownloadResult,
+    async_download_doi,
+    async_download_dois,
+    create_client,
+    get_redirect_link_from_doi,
+    get_zip_links_from_doi,
+)
+from mps_client.core.mirror import mirror_doi
+from mps_client.core.pipeline import download_pipeline, query_downloads
+from mps_client.core.queries import get_doi, get_dois
+from mps_client.core.remote_archive import extract_archive_members, list_archive_members
+from mps_client.utils.profiling import StageReport, collect_report, summarize
 
 download_app = typer.Typer(
     name='download', no_args_is_help=True, help="Download Zip files from sample and process information."
@@ -39,18 +66,52 @@ download_app = typer.Typer(
 def download_doi_command(
     doi: str = typer.Option(..., '--doi', help='Doi to download'),
     path: Path = typer.Option(..., '--path', help='Path to download the doi to'),
+    use_cache: bool = use_cache_option,
+    include: Optional[List[str]] = include_option,
+    exclude: Optional[List[str]] = exclude_option,
+    processes: int = processes_option,
+    force: bool = force_option,
+    stats: bool = stats_option,
+    stats_json: Optional[Path] = stats_json_option,
 ):
     """
     Download a doi from Caltech Data.
     """
-    with styles.console.status('Downloading DOI zip...'):
+    with styles.console.status('Downloading DOI zip...'), collect_report(doi) as report:
         try:
-            asyncio.run(async_download_doi(doi, path))
+            downloaded = asyncio.run(
+                async_download_doi(
+                    doi,
+                    path,
+                    use_cache=use_cache,
+                    include=include,
+                    exclude=exclude,
+                    processes=processes,
+                    force=force,
+                )
+            )
         except DOINotFound:
             styles.bad_typer_print(f'DOI provided is invalid, see https://doi.org/{doi} for details')
             raise typer.Exit(code=1)
+        except ConnectionTimeoutError:
+            styles.bad_typer_print(f'Download request timed out, see https://doi.org/{doi} for details')
+            raise typer.Exit(code=1)
+        except DeadUrlError as exc:
+            styles.bad_typer_print(
+                f'DOI redirects to a dead url {exc.dead_url}, https://doi.org/{doi} for details'
+            )
+            raise typer.Exit(code=1)
+        except ChecksumMismatch as exc:
+            styles.bad_typer_print(
+                f'Download of {exc.url} has checksum {exc.actual}, expected {exc.expected} from the record'
+            )
+            raise typer.Exit(code=1)
     styles.delimiter()
-    styles.console.print(f'Finished downloading, files extracted to {str(path)!r}')
+    if downloaded:
+        styles.console.print(f'Finished downloading, files extracted to {str(path)!r}')
+    else:
+        styles.console.print(f'Files already extracted to {str(path)!r} match the record checksum, skipped')
+    _report_stats([report], stats, stats_json)
 
 
 @download_app.command(name="entity")
@@ -59,6 +120,13 @@ def download_entity(
     entity_id: Optional[UUID] = typer.Option(None, '--id', help='Path to sql file to run query from'),
     entity_label: Optional[str] = typer.Option(None, '--label', help='Path to sql file to run query from'),
     path: Path = typer.Option(None, '--path', help='Path to download the doi to'),
+    use_cache: bool = use_cache_option,
+    include: Optional[List[str]] = include_option,
+    exclude: Optional[List[str]] = exclude_option,
+    processes: int = processes_option,
+    force: bool = force_option,
+    stats: bool = stats_option,
+    stats_json: Optional[Path] = stats_json_option,
 ):
     """
     Download a doi from Caltech Data using an entity type and label/uuid.
@@ -73,9 +141,19 @@ def download_entity(
     # Default path is created from entity label and path
     if path is None:
         path = Path.cwd() / f'results/{entity_type}/{(entity_id or entity_label)}/'
-    with styles.console.status(f'Downloading DOI zip to \'{path}\'...'):
+    with styles.console.status(f'Downloading DOI zip to \'{path}\'...'), collect_report(doi) as report:
         try:
-            asyncio.run(async_download_doi(doi, path))
+            downloaded = asyncio.run(
+                async_download_doi(
+                    doi,
+                    path,
+                    use_cache=use_cache,
+                    include=include,
+                    exclude=exclude,
+                    processes=processes,
+                    force=force,
+                )
+            )
         except DOINotFound:
             styles.bad_typer_print(
                 f'DOI found for entity {entity_type}({lable_str}) is invalid, see https://doi.org/{doi} for details'
@@ -89,9 +167,338 @@ def download_entity(
                 f'DOI redirects to a dead url {exc.dead_url}, https://doi.org/{doi} for details'
             )
             raise typer.Exit(code=1)
+        except ChecksumMismatch as exc:
+            styles.bad_typer_print(
+                f'Download of {exc.url} has checksum {exc.actual}, expected {exc.expected} from the record'
+            )
+            raise typer.Exit(code=1)
+
+    styles.delimiter()
+    if downloaded:
+        styles.console.print(f'Finished downloading, files extracted to {str(path)!r}')
+    else:
+        styles.console.print(f'Files already extracted to {str(path)!r} match the record checksum, skipped')
+    _report_stats([report], stats, stats_json)
+
+
+def _report_stats(reports: List[StageReport], stats: bool, stats_json: Optional[Path]) -> None:
+    """Print a summary of the download stages and/or write them to a json file."""
+    totals = summarize(reports)
+    if stats_json:
+        output = {
+            'stages': {name: stage_stats.to_dict() for name, stage_stats in totals.items()},
+            'downloads': [report.to_dict() for report in reports],
+        }
+        stats_json.write_text(json.dumps(output, indent=2))
+        styles.console.print(f'Wrote download stats to {str(stats_json)!r}')
+    if not stats:
+        return
+    table = Table(title='Download stages', width=styles.console.width)
+    for column in ('Stage', 'Count', 'Total (s)', 'Mean (s)', 'MB', 'MB/s'):
+        table.add_column(column)
+    for name, stage_stats in totals.items():
+        mb_per_s = stage_stats.mb_per_s
+        table.add_row(
+            name,
+            str(stage_stats.count),
+            f'{stage_stats.seconds:.3f}',
+            f'{stage_stats.seconds / stage_stats.count:.3f}',
+            f'{stage_stats.bytes / 1e6:.2f}' if stage_stats.bytes else '',
+            f'{mb_per_s:.2f}' if mb_per_s is not None else '',
+        )
+    styles.console.print(table)
+    wall = max((report.seconds for report in reports), default=0.0)
+    styles.console.print(f'Wall time {wall:.3f}s for {len(reports)} download(s)')
+
+
+def _read_lines(file: Path) -> List[str]:
+    """Read the non-empty, non-comment lines of a file."""
+    lines = (line.strip() for line in file.read_text().splitlines())
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def _parse_entity_key(key: str) -> Tuple[Optional[UUID], Optional[str]]:
+    """Interpret a line from an entity file as an id if it is a UUID and a label otherwise."""
+    try:
+        return UUID(key), None
+    except ValueError:
+        return None, key
+
+
+@download_app.command(name="batch")
+def download_batch(
+    dois: Optional[List[str]] = typer.Option(None, '--doi', help='Doi to download, can be repeated'),
+    file: Optional[Path] = typer.Option(
+        None,
+        '--file',
+        help='File with one doi per line, or one entity id/label per line when --entity is provided',
+    ),
+    entity_type: Optional[EntityType] = typer.Option(
+        None, '--entity', help='Entity type used to resolve --id, --label and --file to dois'
+    ),
+    entity_ids: Optional[List[UUID]] = typer.Option(None, '--id', help='Entity id, can be repeated'),
+    entity_labels: Optional[List[str]] = typer.Option(None, '--label', help='Entity label, can be repeated'),
+    path: Path = typer.Option(None, '--path', help='Root path to download the dois to'),
+    concurrency: int = typer.Option(
+        settings.DOWNLOAD_CONCURRENCY, '--concurrency', '-c', min=1, help='Number of concurrent downloads'
+    ),
+    use_cache: bool = use_cache_option,
+    include: Optional[List[str]] = include_option,
+    exclude: Optional[List[str]] = exclude_option,
+    processes: int = processes_option,
+    force: bool = force_option,
+    stats: bool = stats_option,
+    stats_json: Optional[Path] = stats_json_option,
+):
+    """
+    Download many dois from Caltech Data concurrently.
+    """
+    # Default path is the results folder in the current directory
+    if path is None:
+        path = Path.cwd() / 'results'
+    downloads: List[Tuple[str, Path]] = []
+    missing: List[str] = []
+    if entity_type is None:
+        if entity_ids or entity_labels:
+            raise typer.BadParameter('--entity is required when providing --id or --label.')
+        for doi in [*(dois or []), *(_read_lines(file) if file else [])]:
+            downloads.append((doi, path / doi.replace('/', '_')))
+    else:
+        keys = [(entity_id, None) for entity_id in entity_ids or []]
+        keys += [(None, entity_label) for entity_label in entity_labels or []]
+        keys += [_parse_entity_key(line) for line in (_read_lines(file) if file else [])]
+        entities = [(entity_type, entity_id or entity_label) for entity_id, entity_label in keys]
+        with styles.console.status(f'Getting dois for {len(entities)} entities...'):
+            try:
+                entity_dois, _ = get_dois(entities)
+            except ValueError as exc:
+                raise typer.BadParameter(str(exc))
+        for entity in dict.fromkeys(entities):
+            doi = entity_dois.get(entity)
+            if doi is None:
+                missing.append(f'{entity_type}({entity[1]})')
+                continue
+            downloads.append((doi, path / f'{entity_type}/{entity[1]}'))
+        for entity in missing:
+            styles.bad_typer_print(f'No doi found for entity {entity}')
+        downloads.extend((doi, path / doi.replace('/', '_')) for doi in dois or [])
+
+    if not downloads:
+        raise typer.BadParameter('No dois to download, provide --doi, --file or --entity with --id/--label.')
+
+    with styles.console.status(f'Downloading {len(downloads)} DOI zips with concurrency {concurrency}...'):
+        results = asyncio.run(
+            async_download_dois(
+                downloads,
+                concurrency=concurrency,
+                use_cache=use_cache,
+                include=include,
+                exclude=exclude,
+                processes=processes,
+                force=force,
+            )
+        )
+
+    failures = _report_results(results, path)
+    _report_stats([result.report for result in results if result.report], stats, stats_json)
+    if failures or missing:
+        raise typer.Exit(code=1)
+
+
+@download_app.command(name="query")
+def download_query(
+    sql_file: Optional[Path] = typer.Option(None, '--file', help='Path to sql file returning dois'),
+    raw_sql: Optional[str] = typer.Option(None, '--raw', help='Raw sql returning dois.'),
+    doi_column: Optional[str] = typer.Option(
+        None, '--doi-column', help='Column holding the dois, defaults to the first column named doi or *_doi'
+    ),
+    path: Path = typer.Option(None, '--path', help='Root path to download the dois to'),
+    resolvers: int = typer.Option(
+        settings.RESOLVE_CONCURRENCY, '--resolvers', min=1, help='Number of dois resolved at once'
+    ),
+    concurrency: int = typer.Option(
+        settings.DOWNLOAD_CONCURRENCY, '--concurrency', '-c', min=1, help='Number of concurrent downloads'
+    ),
+    queue_size: int = typer.Option(
+        settings.PIPELINE_QUEUE_SIZE, '--queue-size', min=1, help='Number of dois waiting between stages'
+    ),
+    use_cache: bool = use_cache_option,
+    include: Optional[List[str]] = include_option,
+    exclude: Optional[List[str]] = exclude_option,
+    processes: int = processes_option,
+    force: bool = force_option,
+    stats: bool = stats_option,
+    stats_json: Optional[Path] = stats_json_option,
+):
+    """
+    Download the dois returned by a sql query as the rows stream in.
+    """
+    if sql_file:
+        query = sql_file.read_text()
+    elif raw_sql:
+        query = raw_sql
+    else:
+        raise typer.BadParameter('Must provide sql file (--file) or raw sql command (--raw).')
+    # Default path is the results folder in the current directory
+    if path is None:
+        path = Path.cwd() / 'results'
+
+    with styles.console.status('Downloading DOI zips returned by query...'):
+        try:
+            results = asyncio.run(
+                download_pipeline(
+                    query_downloads(query, path, doi_column),
+                    resolvers=resolvers,
+                    concurrency=concurrency,
+                    queue_size=queue_size,
+                    use_cache=use_cache,
+                    include=include,
+                    exclude=exclude,
+                    processes=processes,
+                    force=force,
+                )
+            )
+        except ValueError as exc:
+            styles.bad_typer_print(str(exc))
+            raise typer.Exit(code=1)
+        except DBAPIError as exc:
+            styles.bad_typer_print(f'Query failed on the database, {exc.orig}')
+            raise typer.Exit(code=1)
+        except DOINotFound as exc:
+            styles.bad_typer_print(f'DOI returned by the query is invalid, {exc}')
+            raise typer.Exit(code=1)
+        except RequestLimitation:
+            styles.bad_typer_print('You have made too many requests, please wait and try again.')
+            raise typer.Exit(code=1)
+        except MPSClientException as exc:
+            styles.bad_typer_print(str(exc))
+            raise typer.Exit(code=1)
+
+    failures = _report_results(results, path)
+    _report_stats([result.report for result in results if result.report], stats, stats_json)
+    if failures:
+        raise typer.Exit(code=1)
+
+
+@download_app.command(name="mirror")
+def mirror_dois(
+    path: Path = typer.Option(..., '--path', help='Mirror directory to copy the dois into'),
+    dois: Optional[List[str]] = typer.Option(None, '--doi', help='Doi to mirror, can be repeated'),
+    file: Optional[Path] = typer.Option(None, '--file', help='File with one doi per line'),
+    concurrency: int = typer.Option(
+        settings.DOWNLOAD_CONCURRENCY, '--concurrency', '-c', min=1, help='Number of concurrent downloads'
+    ),
+):
+    """
+    Copy the records and archives of dois into a mirror that can be served with MPS_DOI_MIRROR.
+    """
+    if settings.DOI_MIRROR:
+        raise typer.BadParameter('Unset MPS_DOI_MIRROR to copy dois from doi.org and Caltech Data.')
+    all_dois = [*(dois or []), *(_read_lines(file) if file else [])]
+    if not all_dois:
+        raise typer.BadParameter('No dois to mirror, provide --doi or --file.')
+
+    async def mirror_all() -> List[DownloadResult]:
+        semaphore = asyncio.Semaphore(concurrency)
+        results = [DownloadResult(doi, path) for doi in all_dois]
+
+        async def mirror(result: DownloadResult, client: httpx.AsyncClient) -> None:
+            async with semaphore:
+                try:
+                    await mirror_doi(result.doi, path, client)
+                except Exception as exc:
+                    result.error = exc
+
+        async with create_client(concurrency) as client:
+            await asyncio.gather(*(mirror(result, client) for result in results))
+        return results
+
+    with styles.console.status(f'Mirroring {len(all_dois)} dois to {str(path)!r}...'):
+        results = asyncio.run(mirror_all())
+    if _report_results(results, path):
+        raise typer.Exit(code=1)
+
+
+def _report_results(results: List[DownloadResult], path: Path) -> List[DownloadResult]:
+    """Print a summary of many downloads and a table of the failures, which are returned."""
+    failures = [result for result in results if not result.ok]
+    styles.delimiter()
+    skipped = sum(result.skipped for result in results)
+    styles.console.print(
+        f'Finished downloading {len(results) - len(failures)}/{len(results)} dois to {str(path)!r}'
+        + (f', {skipped} already up to date' if skipped else '')
+    )
+    if failures:
+        table = Table(title='Failed downloads', width=styles.console.width)
+        table.add_column('DOI')
+        table.add_column('Error')
+        for result in failures:
+            table.add_row(result.doi, repr(result.error))
+        styles.console.print(table)
+    return failures
+
+
+@download_app.command(name="ls")
+def list_doi_archive(
+    doi: str = typer.Option(..., '--doi', help='Doi whose archive should be listed'),
+    include: Optional[List[str]] = include_option,
+    exclude: Optional[List[str]] = exclude_option,
+    use_cache: bool = use_cache_option,
+):
+    """
+    List the files in a doi's archive without downloading it.
+    """
+    with styles.console.status('Reading archive directory...'):
+        try:
+            members = asyncio.run(
+                list_archive_members(doi, include=include, exclude=exclude, use_cache=use_cache)
+            )
+        except RangeRequestsNotSupported:
+            styles.bad_typer_print(f'Server for doi {doi} does not support partial downloads.')
+            raise typer.Exit(code=1)
+        except MPSClientException:
+            styles.bad_typer_print(f'DOI is invalid, see https://doi.org/{doi} for details')
+            raise typer.Exit(code=1)
+    table = Table(title=f'Archive for doi {doi}', width=styles.console.width)
+    table.add_column('Name')
+    table.add_column('Size')
+    table.add_column('Compressed Size')
+    for member in members:
+        table.add_row(member.filename, str(member.file_size), str(member.compress_size))
+    styles.console.print(table)
+
 
+@download_app.command(name="extract-member")
+def extract_doi_members(
+    doi: str = typer.Option(..., '--doi', help='Doi whose archive the files should be extracted from'),
+    members: List[str] = typer.Option(
+        ..., '--member', help='Name or glob of the archive members to extract. Can be repeated.'
+    ),
+    path: Path = typer.Option(..., '--path', help='Path to extract the files to'),
+    exclude: Optional[List[str]] = exclude_option,
+    use_cache: bool = use_cache_option,
+):
+    """
+    Extract files from a doi's archive, fetching only the bytes of the requested files.
+    """
+    with styles.console.status('Extracting archive members...'):
+        try:
+            extracted = asyncio.run(
+                extract_archive_members(doi, path, include=members, exclude=exclude, use_cache=use_cache)
+            )
+        except RangeRequestsNotSupported:
+            styles.bad_typer_print(
+                f'Server for doi {doi} does not support partial downloads, use \'download doi\' instead.'
+            )
+            raise typer.Exit(code=1)
+        except MPSClientException:
+            styles.bad_typer_print(f'DOI is invalid, see https://doi.org/{doi} for details')
+            raise typer.Exit(code=1)
     styles.delimiter()
-    styles.console.print(f'Finished downloading, files extracted to {str(path)!r}')
+    if not extracted:
+        styles.bad_typer_print(f'No files in the archive matched {", ".join(members)}')
+        raise typer.Exit(code=1)
+    styles.console.print(f'Extracted {len(extracted)} file(s) to {str(path)!r}')
 
 
 @download_app.command(name="check")
@@ -11,6 +11,8 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
+import csv
+from contextlib import ExitStack
 from pathlib import Path
 from typing import List, Optional
 from uuid import UUID
@@ -20,7 +22,14 @@ from rich.table import Table
 
 import mps_client.cli.styles as styles
 from mps_client._enums import EntityType
-from mps_client.core.queries import get_doi, get_process_history, get_sample, run_raw_query
+from mps_client.configuration import settings
+from mps_client.core.queries import (
+    get_doi,
+    get_process_histories,
+    get_process_history,
+    get_sample,
+    stream_raw_query,
+)
 
 query_app = typer.Typer(name='query', no_args_is_help=True, help="Test connection to the database.")
 
@@ -33,6 +42,13 @@ def run_raw_query_command(
     fields: Optional[List[str]] = typer.Option(
         None, '--field', help='Number of rows to print to the screen.'
     ),
+    output: Optional[Path] = typer.Option(None, '--output', '-o', help='Write every row to this csv file.'),
+    fetch_size: int = typer.Option(
+        settings.QUERY_FETCH_SIZE,
+        '--fetch-size',
+        min=1,
+        help='Number of rows fetched from the server at once.',
+    ),
 ):
     """
     Run raw sql queries against the database
@@ -44,8 +60,22 @@ def run_raw_query_command(
     else:
         raise typer.BadParameter('Need to provide --file or --raw.')
 
-    with styles.console.status('Running Query...'):
-        result = run_raw_query(command)
+    # Rows are streamed so only the rows shown are kept in memory
+    result = []
+    count = 0
+    with styles.console.status('Running Query...'), ExitStack() as stack:
+        writer = None
+        for row in stream_raw_query(command, fetch_size=fetch_size):
+            if output and writer is None:
+                writer = csv.writer(stack.enter_context(output.open('w', newline='')))
+                writer.writerow(row._fields)
+            if writer is not None:
+                writer.writerow(row)
+            if count < number_of_rows:
+                result.append(row)
+            count += 1
+    if output and count:
+        styles.console.print(f'Wrote {count} row(s) to {str(output)!r}')
     if result:
         table = Table(title=str(sql_file) if sql_file else command, width=styles.console.width)
         if fields:
@@ -61,7 +91,7 @@ def run_raw_query_command(
                 table.add_column(f'Column {i}')
 
         styles.console.print(
-            f'Query finished. It returned {len(result)} row(s). Showing first {number_of_rows} rows'
+            f'Query finished. It returned {count} row(s). Showing first {number_of_rows} rows'
         )
         styles.delimiter()
         for row in result[:number_of_rows]:
@@ -93,12 +123,42 @@ def get_doi_command(
 
 @query_app.command(name="get-process-history")
 def get_process_history_command(
-    sample_id: Optional[UUID] = typer.Option(None, '--id', help='Path to sql file to run query from'),
-    sample_label: Optional[str] = typer.Option(None, '--label', help='Path to sql file to run query from'),
+    sample_ids: Optional[List[UUID]] = typer.Option(None, '--id', help='Sample id, can be repeated'),
+    sample_labels: Optional[List[str]] = typer.Option(None, '--label', help='Sample label, can be repeated'),
+    file: Optional[Path] = typer.Option(None, '--file', help='File with one sample id or label per line'),
 ):
     """
-    Test connections to the database
+    Print the process history of one or more samples, fetched with a single query.
     """
+    sample_ids, sample_labels = list(sample_ids or []), list(sample_labels or [])
+    for line in file.read_text().splitlines() if file else []:
+        if not line.strip():
+            continue
+        try:
+            sample_ids.append(UUID(line.strip()))
+        except ValueError:
+            sample_labels.append(line.strip())
+    if not sample_ids and not sample_labels:
+        raise typer.BadParameter('Need to provide --id, --label or --file.')
+    if len(sample_ids) + len(sample_labels) == 1:
+        _print_single_process_history(
+            sample_ids[0] if sample_ids else None, sample_labels[0] if sample_labels else None
+        )
+        return
+
+    with styles.console.status('Getting process histories...'):
+        histories = get_process_histories(sample_ids, sample_labels)
+    for key in [*sample_ids, *sample_labels]:
+        id_str = f'Sample({"id" if isinstance(key, UUID) else "label"}={key})'
+        if key not in histories:
+            styles.bad_typer_print(f'{id_str} could not be found or has no process history.')
+            continue
+        _, type_list, tech_list = histories[key]
+        history = (f'{proc_type}({tech})' for proc_type, tech in zip(type_list, tech_list))
+        styles.console.print(f'{id_str}: {" -> ".join(history)}')
+
+
+def _print_single_process_history(sample_id: Optional[UUID], sample_label: Optional[str]) -> None:
     process_history = get_process_history(sample_id, sample_label)
     id_str = f'id={sample_id}' if sample_id else f'label={sample_label}'
     id_str = f'Sample({id_str})'
@@ -20,6 +20,7 @@ import typer
 
 from mps_client import __version__
 from mps_client.cli import styles
+from mps_client.cli.commands.cache import cache_app
 from mps_client.cli.commands.database import database_app
 from mps_client.cli.commands.download import download_app
 from mps_client.cli.commands.query import query_app
@@ -32,6 +33,7 @@ app = typer.Typer(no_args_is_help=True)
 app.add_typer(database_app)
 app.add_typer(query_app)
 app.add_typer(download_app)
+app.add_typer(cache_app)
 
 
 @app.callback()
@@ -11,3 +11,34 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
+import typer
+
+from mps_client.configuration import settings
+
+use_cache_option = typer.Option(
+    True, '--cache/--no-cache', help='Use the local cache for doi resolution, record json and archives.'
+)
+include_option = typer.Option(
+    None, '--include', help='Only extract archive members matching this glob, e.g. "*.fom". Can be repeated.'
+)
+exclude_option = typer.Option(
+    None, '--exclude', help='Do not extract archive members matching this glob. Can be repeated.'
+)
+processes_option = typer.Option(
+    settings.EXTRACT_PROCESSES,
+    '--processes',
+    '-j',
+    min=1,
+    help='Number of processes to extract archives with.',
+)
+force_option = typer.Option(
+    False,
+    '--force',
+    help='Download and extract even if an archive with a matching checksum is already extracted.',
+)
+stats_option = typer.Option(
+    False, '--stats', help='Print the time spent and throughput of each download stage.'
+)
+stats_json_option = typer.Option(
+    None, '--stats-json', help='Write a json report of the time spent and bytes moved in each download stage.'
+)
@@ -13,10 +13,11 @@
 #   limitations under the License.
 
 import os
+from pathlib import Path
 from textwrap import dedent
 from typing import Any, Dict, Optional, Union
 
-from pydantic import AnyUrl, BaseSettings, PostgresDsn, SecretStr, parse_obj_as, validator
+from pydantic import AnyUrl, BaseSettings, ByteSize, PostgresDsn, SecretStr, parse_obj_as, validator
 
 from mps_client._enums import LogLevel
 
@@ -57,9 +58,47 @@ class Settings(BaseSettings):
     POSTGRES_PORT: str = "5432"
     POSTGRES_SCHEMA: str = "production"
     POSTGRES_DSN: Optional[PostgresDsn]
+    # Connections pooled by each engine, recycled after POSTGRES_POOL_RECYCLE seconds (-1 to never)
+    POSTGRES_POOL_SIZE: int = 5
+    POSTGRES_MAX_OVERFLOW: int = 10
+    POSTGRES_POOL_PRE_PING: bool = True
+    POSTGRES_POOL_RECYCLE: int = 30 * 60
     NEO4J_DSN: Neo4jDsn = parse_obj_as(Neo4jDsn, 'neo4j://neo4j@localhost:7687/neo4j')
     NEO4J_PASSWORD: SecretStr = parse_obj_as(SecretStr, "")
 
+    # Rows fetched at once when streaming query results through a server side cursor
+    QUERY_FETCH_SIZE: int = 10000
+    # Keep run_raw_query results in the cache until a new release is loaded
+    QUERY_CACHE_ENABLED: bool = False
+
+    # Download settings
+    DOWNLOAD_CONCURRENCY: int = 8
+    DOWNLOAD_ATTEMPTS: int = 3
+    EXTRACT_PROCESSES: int = 1
+    # Local directory or http url of a mirror to serve doi.org and Caltech Data requests from
+    DOI_MIRROR: Optional[str] = None
+    # Concurrent doi resolutions and queue size between stages of the download pipeline
+    RESOLVE_CONCURRENCY: int = 4
+    PIPELINE_QUEUE_SIZE: int = 32
+
+    # Requests per second sent to each host, backed off automatically on 429 responses
+    RATE_LIMIT_MAX_RATE: float = 10.0
+    RATE_LIMIT_BURST: int = 10
+    RATE_LIMIT_RETRIES: int = 8
+    RATE_LIMIT_MAX_BACKOFF: float = 60.0
+
+    # Local cache for doi resolution, record json and archives
+    CACHE_ENABLED: bool = True
+    CACHE_DIR: Path = Path.home() / '.cache' / 'mps_client'
+    CACHE_TTL: Optional[int] = 7 * 24 * 60 * 60
+    CACHE_MAX_SIZE: Optional[ByteSize] = parse_obj_as(ByteSize, '10GiB')
+    # Seconds between the prunes run after downloads, 0 to only prune with mps-client cache prune
+    CACHE_PRUNE_INTERVAL: int = 60 * 60
+    # Seconds to remember dois that do not exist or redirect to a dead url, 0 to disable
+    CACHE_NEGATIVE_TTL: int = 24 * 60 * 60
+    # Hardlink extracted files to a single copy kept in the cache
+    CACHE_LINK_FILES: bool = False
+
     _always_set = {"POSTGRES_DSN"}
     _simple_params = {
         "POSTGRES_DSN",
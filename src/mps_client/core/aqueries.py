@@ -0,0 +1,124 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Asyncio counterparts of the queries in mps_client.core.queries.
+
+Queries run on an async engine using the asyncpg driver, installed with the async extra, so
+many lookups can be awaited concurrently from one event loop. Each event loop gets its own
+pool of connections, closed on leaving mps_client.database.connection.async_engines().
+"""
+
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+from uuid import UUID
+
+from sqlalchemy.engine import Row
+from sqlmodel import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from mps_client._enums import EntityType
+from mps_client.configuration import settings
+from mps_client.core.queries import ProcessHistory, _doi_stmt, _sample_process_history_stmt, _sample_stmt
+from mps_client.core.views import PROCESS_HISTORY, ahas_view
+from mps_client.database.session import get_async_engine
+from mps_client.schema.esamp import Sample
+
+logger = logging.getLogger(__name__)
+
+
+async def run_raw_query(query: str, params: Optional[Dict[str, Any]] = None) -> List[Row]:
+    """
+    Run a raw sql query.
+
+    Args:
+        query (str): The sql query to run
+        params (Optional[Dict[str, Any]]): Values for the :name parameters in the query
+
+    Returns:
+        List[Row]: The rows returned by the query
+    """
+    async with AsyncSession(get_async_engine()) as session:
+        result = await session.execute(text(query), params)
+        return result.all()
+
+
+async def stream_raw_query(
+    query: str, fetch_size: Optional[int] = None, batches: bool = False
+) -> AsyncIterator[Union[Row, List[Row]]]:
+    """
+    Stream the rows of a raw sql query through a server side cursor.
+
+    Args:
+        query (str): The sql query to run
+        fetch_size (Optional[int]): The number of rows fetched from the server at once, by default
+            QUERY_FETCH_SIZE
+        batches (bool): Yield lists of up to fetch_size rows instead of single rows
+    """
+    fetch_size = settings.QUERY_FETCH_SIZE if fetch_size is None else fetch_size
+    async with AsyncSession(get_async_engine()) as session:
+        result = await session.stream(text(query), execution_options={'yield_per': fetch_size})
+        if batches:
+            async for partition in result.partitions(fetch_size):
+                yield partition
+        else:
+            async for row in result:
+                yield row
+
+
+async def get_process_history(
+    sample_id: Optional[UUID] = None, sample_label: Optional[str] = None
+) -> ProcessHistory:
+    """
+    Get the process history of a given sample_id or sample_label.
+
+    Args:
+        sample_id (Optional[UUID]): The UUID of the sample to get the history for
+        sample_label (Optional[str]): The Label of the sample to get the history for
+
+    Returns:
+        ProcessHistory: The time ordered process ids, types and techniques of the sample.
+    """
+    stmt = _sample_process_history_stmt(sample_id, sample_label, from_view=await ahas_view(PROCESS_HISTORY))
+    async with AsyncSession(get_async_engine()) as session:
+        result = (await session.exec(stmt)).one_or_none()
+    if result is None:
+        return [], [], []
+    return result
+
+
+async def get_sample(
+    sample_id: Optional[UUID] = None, sample_label: Optional[str] = None
+) -> Optional[Sample]:
+    """
+    Get a sample by its ID or Label
+
+    Args:
+        sample_id (Optional[UUID]): The UUID of the sample
+        sample_label (Optional[str]): The Label of the sample
+
+    Returns:
+        Optional[Sample]: The sample, None if it does not exist
+    """
+    stmt = _sample_stmt(sample_id, sample_label)
+    async with AsyncSession(get_async_engine(), expire_on_commit=False) as session:
+        return (await session.exec(stmt)).one_or_none()
+
+
+async def get_doi(
+    entity_type: EntityType, entity_id: Optional[UUID] = None, entity_label: Optional[str] = None
+) -> Optional[str]:
+    stmt = _doi_stmt(entity_type, entity_id, entity_label)
+    async with AsyncSession(get_async_engine()) as session:
+        return (await session.exec(stmt)).one_or_none()
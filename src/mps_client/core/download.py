@@ -12,114 +12,902 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 import asyncio
-import io
+import fnmatch
+import hashlib
 import json
 import logging
 import re
+import tempfile
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import partial
+from itertools import repeat
 from pathlib import Path
-from typing import List, Optional
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+from urllib.parse import unquote, urlparse
 
+import aiofiles
 import httpx
 import requests
 from bs4 import BeautifulSoup
 
 from mps_client._exceptions import (
     CaltechJsonNotFound,
+    ChecksumMismatch,
     ConnectionTimeoutError,
     DeadUrlError,
     DOINotFound,
     RequestLimitation,
     UrlConnectionError,
 )
+from mps_client.configuration import settings
+from mps_client.utils.cache import DiskCache, get_cache
+from mps_client.utils.mirror import get_mirror_transport
+from mps_client.utils.profiling import StageReport, collect_report, stage
+from mps_client.utils.rate_limit import RateLimiter, get_rate_limiter, parse_retry_after
+from mps_client.utils.store import ContentStore, get_store
 
 logger = logging.getLogger(__name__)
+T = TypeVar('T')
 timeout = httpx.Timeout(60)
+# Size of the chunks archives are streamed to disk in, bounds the memory used per download
+CHUNK_SIZE = 1024 * 1024
+# Folder inside of a download path that archives are staged in before extraction
+STAGING_DIR = '.mps-download'
+# Cache namespaces for the resolved record url of a doi, the record json and the zip archives
+DOI_NAMESPACE = 'doi'
+RECORD_NAMESPACE = 'record'
+ARCHIVE_NAMESPACE = 'archive'
+FAILURE_NAMESPACE = 'failure'
+# Redirects followed with HEAD requests when resolving a doi
+MAX_REDIRECTS = 5
+# File written to a download path recording the archive that was extracted there
+MANIFEST_FILE = '.mps-manifest.json'
+
+
+@dataclass
+class DownloadResult:
+    """The outcome of downloading a single doi as part of a batch."""
+
+    doi: str
+    path: Path
+    error: Optional[BaseException] = None
+    report: Optional[StageReport] = None
+    skipped: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class FileChecksum:
+    """The checksum and size of a file listed in a Caltech Data record."""
+
+    algorithm: str
+    digest: str
+    size: Optional[int] = None
+
+    def __str__(self) -> str:
+        return f'{self.algorithm}:{self.digest}'
+
+    def hasher(self):
+        return hashlib.new(self.algorithm)
+
+
+def create_client(concurrency: Optional[int] = None) -> httpx.AsyncClient:
+    """Create a client pooling connections for concurrency downloads, DOWNLOAD_CONCURRENCY by default."""
+    concurrency = settings.DOWNLOAD_CONCURRENCY if concurrency is None else concurrency
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return httpx.AsyncClient(timeout=timeout, limits=limits, **_transport_kwargs(limits))
+
+
+def _transport_kwargs(limits: Optional[httpx.Limits] = None) -> Dict[str, Any]:
+    """Route clients through the mirror in the DOI_MIRROR setting when one is set."""
+    transport = get_mirror_transport(limits)
+    return {} if transport is None else {'transport': transport}
+
+
+def _get_rate_limiter(host: str) -> Optional[RateLimiter]:
+    """Get the rate limiter for requests to a host, None when requests are served by a mirror."""
+    return None if settings.DOI_MIRROR else get_rate_limiter(host)
 
 
-def download_doi(doi: str, path: Path) -> None:
+@asynccontextmanager
+async def _get_client(client: Optional[httpx.AsyncClient] = None) -> AsyncIterator[httpx.AsyncClient]:
+    """Yield the provided client or a new client that is closed on exit."""
+    if client is not None:
+        yield client
+    else:
+        async with httpx.AsyncClient(timeout=timeout, **_transport_kwargs()) as new_client:
+            yield new_client
+
+
+def download_doi(
+    doi: str,
+    path: Path,
+    chunk_size: int = CHUNK_SIZE,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+) -> None:
     logger.info(f'Getting the DOI webpage')
     URL = f"https://doi.org/{doi}"
     page = requests.get(URL)
     logger.info(f'Parsing DOI webpage for links.')
     zip_file_url = parse_webpage_for_zip_links(page.content, doi)
     logger.info(f'Downloading link {zip_file_url} found for doi')
-    r = requests.get(zip_file_url)
-    z = zipfile.ZipFile(io.BytesIO(r.content))
-    logger.info(f'Extracting to path {path}')
-    z.extractall(path)
+    path.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryFile(dir=path) as archive:
+        with requests.get(zip_file_url, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size):
+                archive.write(chunk)
+        archive.seek(0)
+        logger.info(f'Extracting to path {path}')
+        with zipfile.ZipFile(archive) as z:
+            z.extractall(path, select_members(z, include, exclude))
+
+
+async def async_download_doi(
+    doi: str,
+    path: Path,
+    chunk_size: int = CHUNK_SIZE,
+    client: Optional[httpx.AsyncClient] = None,
+    resume: bool = True,
+    use_cache: bool = True,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    processes: Optional[int] = None,
+    force: bool = False,
+) -> bool:
+    """
+    Asynchronously download a doi to a local path.
+
+    The archive is streamed to a staging folder inside of path in chunks of chunk_size bytes
+    and extracted from there, so memory usage does not grow with the size of the archive.
+    If the transfer fails the partial archive is kept and, when resume is True, the next
+    attempt continues from where it stopped. A client can be provided to reuse its connection
+    pool across many downloads.
+
+    When use_cache is True and caching is enabled in the settings the doi resolution, record
+    json and archive are read from and stored in the local cache, see mps_client.utils.cache.
+    The include, exclude and processes arguments are passed on to extract_archive.
+
+    When the record lists a checksum for the archive it is computed while streaming and a
+    mismatch raises ChecksumMismatch. The checksum is recorded in a manifest in path and if
+    the same archive was already extracted there with the same filters the transfer is
+    skipped, unless force is True.
+
+    Returns:
+        bool: False if the download was skipped because path is already up to date
+    """
+    download = await plan_download(doi, path, client, use_cache, include, exclude, force)
+    if download is None:
+        return False
+    await fetch_archive(download, client, chunk_size, resume)
+    await install_archive(download, include, exclude, processes)
+    return True
 
 
-async def async_download_doi(doi: str, path: Path) -> None:
-    """Asynchronously download a doi to a local path."""
+@dataclass
+class ArchiveDownload:
+    """The archive of a doi on its way to being extracted to path."""
+
+    doi: str
+    path: Path
+    link: str
+    checksum: Optional[FileChecksum]
+    manifest: Dict[str, Any]
+    # The cache to store the archive in, the archive is staged inside of path when None
+    cache: Optional[DiskCache] = None
+    archive: Optional[Path] = None
+    # The store to link extracted files from and the stored tree when already extracted once
+    store: Optional[ContentStore] = None
+    tree: Optional[Dict[str, str]] = None
+
+    @property
+    def tree_key(self) -> str:
+        return json.dumps(self.manifest, sort_keys=True)
+
+
+async def plan_download(
+    doi: str,
+    path: Path,
+    client: Optional[httpx.AsyncClient] = None,
+    use_cache: bool = True,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    force: bool = False,
+) -> Optional[ArchiveDownload]:
+    """
+    Resolve the archive of a doi, the first stage of async_download_doi.
+
+    Returns:
+        Optional[ArchiveDownload]: The archive to fetch, None if path is already up to date
+    """
     logger.info(f'Getting download links for doi  at https://doi.org/{doi}')
-    zip_links = await get_zip_links_from_doi(doi)
+    zip_link, checksum = await get_archive_from_doi(doi, client, use_cache=use_cache)
+    manifest = {
+        'doi': doi,
+        'link': zip_link,
+        'checksum': str(checksum) if checksum else None,
+        'include': list(include or []),
+        'exclude': list(exclude or []),
+    }
+    if not force and checksum is not None and read_manifest(path) == manifest:
+        logger.info(f'Archive for doi {doi} with checksum {checksum} already extracted to {path}, skipping')
+        with stage('skip'):
+            return None
+    cache = get_cache() if use_cache else None
+    download = ArchiveDownload(doi, path, zip_link, checksum, manifest, cache)
+    download.store = get_store() if cache is not None else None
+    if download.store is not None:
+        download.tree = download.store.get_tree(download.tree_key)
+    return download
+
+
+async def fetch_archive(
+    download: ArchiveDownload,
+    client: Optional[httpx.AsyncClient] = None,
+    chunk_size: int = CHUNK_SIZE,
+    resume: bool = True,
+) -> Optional[Path]:
+    """
+    Download the archive to the cache or a staging folder, the second stage of async_download_doi.
+
+    Concurrent downloads of the same archive to the cache share a single transfer. Nothing is
+    downloaded when the files of the archive are already in the store.
+
+    Returns:
+        Optional[Path]: The local copy of the archive, None when it is not needed
+    """
+    zip_link, cache = download.link, download.cache
+    if download.tree is not None:
+        logger.info(f'Files of {zip_link} are already in the store')
+        return None
+    if cache is None:
+        logger.info(f'Downloading link {zip_link} found for doi')
+        archive = download.path / STAGING_DIR / (_link_filename(zip_link) or 'archive.zip')
+        archive.parent.mkdir(parents=True, exist_ok=True)
+        async with _get_client(client) as active_client:
+            await download_file(
+                active_client, zip_link, archive, chunk_size, resume, checksum=download.checksum
+            )
+        download.archive = archive
+        return archive
+
+    archive = cache.path(ARCHIVE_NAMESPACE, zip_link, '.zip')
+
+    async def download_to_cache() -> None:
+        if cache.get(ARCHIVE_NAMESPACE, zip_link, '.zip') is not None:
+            logger.info(f'Using cached archive for {zip_link}')
+            return
+        logger.info(f'Downloading link {zip_link} found for doi to cache')
+        archive.parent.mkdir(parents=True, exist_ok=True)
+        async with _get_client(client) as active_client:
+            await download_file(
+                active_client, zip_link, archive, chunk_size, resume, checksum=download.checksum
+            )
+
+    await _coalesce(('archive', archive), download_to_cache)
+    download.archive = archive
+    return archive
+
+
+async def install_archive(
+    download: ArchiveDownload,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    processes: Optional[int] = None,
+) -> None:
+    """
+    Extract a fetched archive and record its manifest, the last stage of async_download_doi.
+
+    With a store the archive is extracted into the store once, concurrent installs of the same
+    archive waiting on the first, and its files are hardlinked into path. Archives are extracted
+    with EXTRACT_PROCESSES processes unless processes is given.
+    """
+    processes = settings.EXTRACT_PROCESSES if processes is None else processes
+    store = download.store
+    if download.archive is None and (store is None or download.tree is None):
+        raise ValueError(f'Archive for doi {download.doi} has not been fetched')
+    extract = partial(extract_archive, include=include, exclude=exclude, processes=processes)
+    loop = asyncio.get_running_loop()
+    if store is not None:
+        tree = download.tree
+        if tree is None:
+            tree = await _coalesce(('tree', download.tree_key), partial(_extract_to_store, download, extract))
+        with stage('link'):
+            await loop.run_in_executor(None, store.link_tree, tree, download.path)
+    else:
+        assert download.archive is not None
+        await _extract_in_thread(extract, download.archive, download.path)
+    write_manifest(download.path, download.manifest)
+    if download.cache is not None:
+        if settings.CACHE_PRUNE_INTERVAL > 0:
+            download.cache.prune_if_due(settings.CACHE_PRUNE_INTERVAL)
+        return
+    assert download.archive is not None
+    download.archive.unlink()
+    try:
+        download.archive.parent.rmdir()
+    except OSError:
+        # Other downloads are still staged in the folder
+        pass
+
+
+async def _extract_to_store(
+    download: ArchiveDownload, extract: Callable[[Path, Path], List[str]]
+) -> Dict[str, str]:
+    """Extract an archive into the store and record its tree."""
+    store, archive = download.store, download.archive
+    assert store is not None and archive is not None
+    # Extract next to the stored objects so they can be moved into place
+    store.cache.root.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix='.extract-', dir=store.cache.root) as tmp:
+        await _extract_in_thread(extract, archive, Path(tmp))
+        tree = await asyncio.get_running_loop().run_in_executor(None, store.add_tree, Path(tmp))
+    store.set_tree(download.tree_key, tree)
+    return tree
+
+
+_in_flight: Dict[Tuple[asyncio.AbstractEventLoop, Any], asyncio.Future] = {}
+
+
+async def _coalesce(key: Any, factory: Callable[[], Awaitable[T]]) -> T:
+    """Run factory once for concurrent callers with the same key, all of them sharing its outcome."""
+    loop_key = (asyncio.get_running_loop(), key)
+    task = _in_flight.get(loop_key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _in_flight[loop_key] = task
+        task.add_done_callback(lambda _: _in_flight.pop(loop_key, None))
+    else:
+        logger.info(f'Waiting on {key[0]} already in progress')
+    # Shield so one caller being cancelled does not cancel the others
+    return await asyncio.shield(task)
+
+
+def read_manifest(path: Path) -> Optional[Dict[str, Any]]:
+    """Read the manifest of the archive last extracted to path."""
+    try:
+        return json.loads((path / MANIFEST_FILE).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(path: Path, manifest: Dict[str, Any]) -> None:
+    (path / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2))
+
+
+async def _extract_in_thread(extract: Callable[[Path, Path], List[str]], archive: Path, path: Path) -> None:
+    """Extract in a worker thread so other downloads sharing the loop keep streaming."""
+    with stage('extract') as stats:
+        stats.bytes = archive.stat().st_size
+        await asyncio.get_running_loop().run_in_executor(None, extract, archive, path)
+
+
+async def async_download_dois(
+    downloads: Iterable[Tuple[str, Path]],
+    concurrency: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+    use_cache: bool = True,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    processes: Optional[int] = None,
+    force: bool = False,
+) -> List[DownloadResult]:
+    """
+    Concurrently download many dois through a single pooled client.
+
+    Args:
+        downloads (Iterable[Tuple[str, Path]]): Pairs of doi and the path to extract it to
+        concurrency (Optional[int]): The maximum number of dois downloaded at once, by default
+            DOWNLOAD_CONCURRENCY
+        chunk_size (int): The maximum number of bytes held in memory at once per download
+        use_cache (bool): Read from and write to the local cache when it is enabled
+        include (Optional[Sequence[str]]): Only extract members matching one of these globs
+        exclude (Optional[Sequence[str]]): Do not extract members matching any of these globs
+        processes (Optional[int]): Number of processes used to extract each archive, by default
+            EXTRACT_PROCESSES
+        force (bool): Download and extract dois even if their path is already up to date
+
+    Returns:
+        List[DownloadResult]: The outcome of each download in the order provided, failures are
+            recorded on the result instead of being raised. Each result has a report of the time
+            spent and bytes moved in each stage of its download, see mps_client.utils.profiling.
+    """
+    concurrency = settings.DOWNLOAD_CONCURRENCY if concurrency is None else concurrency
+    if concurrency < 1:
+        raise ValueError(f'concurrency must be at least 1, got {concurrency}')
+    semaphore = asyncio.Semaphore(concurrency)
+    results = [DownloadResult(doi, path) for doi, path in downloads]
+
+    async def download(result: DownloadResult, client: httpx.AsyncClient) -> None:
+        with collect_report(result.doi) as report:
+            result.report = report
+            with stage('queue'):
+                await semaphore.acquire()
+            try:
+                result.skipped = not await async_download_doi(
+                    result.doi,
+                    result.path,
+                    chunk_size,
+                    client,
+                    use_cache=use_cache,
+                    include=include,
+                    exclude=exclude,
+                    processes=processes,
+                    force=force,
+                )
+            except Exception as exc:
+                logger.error(f'Failed to download doi {result.doi}: {exc!r}')
+                result.error = exc
+            finally:
+                semaphore.release()
+
+    async with create_client(concurrency) as client:
+        await asyncio.gather(*(download(result, client) for result in results))
+    return results
+
+
+async def download_file(
+    client: httpx.AsyncClient,
+    url: str,
+    dest: Path,
+    chunk_size: int = CHUNK_SIZE,
+    resume: bool = True,
+    max_attempts: Optional[int] = None,
+    checksum: Optional[FileChecksum] = None,
+) -> int:
+    """
+    Download a url to dest through a partial file that survives interrupted transfers.
+
+    The body is written to a sibling file with a .part suffix which is renamed to dest once
+    complete. Interrupted transfers are retried up to max_attempts times, DOWNLOAD_ATTEMPTS by
+    default, each retry and any
+    later call with resume=True continue from the end of the partial file with a Range request.
+    If a checksum is provided it is computed as the file is streamed and verified before the
+    partial file is renamed.
+
+    Returns:
+        int: The size of the downloaded file
+
+    Raises:
+        ChecksumMismatch: If the downloaded file does not match checksum, the partial file is removed
+    """
+    max_attempts = settings.DOWNLOAD_ATTEMPTS if max_attempts is None else max_attempts
+    if max_attempts < 1:
+        raise ValueError(f'max_attempts must be at least 1, got {max_attempts}')
+    part = dest.with_name(f'{dest.name}.part')
+    if not resume and part.exists():
+        part.unlink()
+    for attempt in range(1, max_attempts + 1):
+        hasher = checksum.hasher() if checksum else None
+        try:
+            size = await stream_to_file(client, url, part, chunk_size, resume=True, hasher=hasher)
+            break
+        except (httpx.TransportError, TimeoutError, RequestLimitation) as exc:
+            if attempt == max_attempts:
+                raise
+            received = part.stat().st_size if part.exists() else 0
+            logger.warning(
+                f'Download of {url} interrupted after {received} bytes ({exc!r}), '
+                f'resuming (attempt {attempt + 1}/{max_attempts})'
+            )
+    if checksum is not None and hasher is not None:
+        if hasher.hexdigest() != checksum.digest or checksum.size not in (None, size):
+            part.unlink()
+            actual = f'{checksum.algorithm}:{hasher.hexdigest()}'
+            raise ChecksumMismatch(
+                f'Download of {url} has checksum {actual} and size {size}, '
+                f'expected {checksum} and size {checksum.size}',
+                url=url,
+                expected=str(checksum),
+                actual=actual,
+            )
+        logger.info(f'Verified checksum {checksum} of {url}')
+    part.replace(dest)
+    return size
+
+
+async def stream_to_file(
+    client: httpx.AsyncClient,
+    url: str,
+    dest: Path,
+    chunk_size: int = CHUNK_SIZE,
+    resume: bool = False,
+    hasher=None,
+) -> int:
+    """
+    Stream the body of a GET request to a file without holding it in memory.
+
+    Args:
+        client (httpx.AsyncClient): The client to send the request with
+        url (str): The url to download
+        dest (Path): The file to write the response body to
+        chunk_size (int): The maximum number of bytes held in memory at once
+        resume (bool): Request only the bytes missing from an existing dest with a Range header,
+            falls back to a full download if the server ignores the range.
+        hasher: A fresh hashlib hash object updated with every byte of dest, including those
+            already on disk when resuming
+
+    Returns:
+        int: The size of dest after the transfer
+    """
+    offset = dest.stat().st_size if resume and dest.exists() else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    limiter = _get_rate_limiter(httpx.URL(url).host)
+    if limiter is not None:
+        await limiter.acquire()
+    try:
+        async with client.stream('GET', url, headers=headers, follow_redirects=True) as response:
+            if limiter is not None and response.status_code == 429:
+                limiter.on_rate_limited(parse_retry_after(response.headers.get('Retry-After')))
+                raise RequestLimitation(f'Too many requests, download of {url} was rate limited')
+            if limiter is not None:
+                limiter.on_success()
+            if offset and response.status_code == 416:
+                # Range starts at or past the end of the body, either dest is complete or stale
+                if response.headers.get('Content-Range') == f'bytes */{offset}':
+                    if hasher is not None:
+                        await _hash_file(dest, hasher)
+                    return offset
+                logger.info(f'Partial download of {url} is larger than the remote file, restarting')
+                dest.unlink()
+                return await stream_to_file(client, url, dest, chunk_size, hasher=hasher)
+            response.raise_for_status()
+            if offset and not _resumes_at(response, offset):
+                logger.info(f'Server does not support resuming {url}, restarting download')
+                offset = 0
+            elif offset:
+                logger.info(f'Resuming download of {url} from byte {offset}')
+                if hasher is not None:
+                    await _hash_file(dest, hasher)
+            written = 0
+            with stage('transfer') as stats:
+                async with aiofiles.open(dest, 'ab' if offset else 'wb') as f:
+                    async for chunk in response.aiter_bytes(chunk_size):
+                        await f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+                        written += len(chunk)
+                        stats.bytes += len(chunk)
+    except httpx.ConnectTimeout:
+        raise TimeoutError(f'HTTP Request for {url} timed out.')
+    return offset + written
+
+
+async def _hash_file(path: Path, hasher) -> None:
+    """Update a hash with the contents of a file in a worker thread."""
+
+    def update() -> None:
+        with open(path, 'rb') as f:
+            for chunk in iter(partial(f.read, CHUNK_SIZE), b''):
+                hasher.update(chunk)
+
+    await asyncio.get_running_loop().run_in_executor(None, update)
+
+
+def _resumes_at(response: httpx.Response, offset: int) -> bool:
+    """Check that a response is a partial response starting at offset."""
+    if response.status_code != 206:
+        return False
+    match = re.match(r'bytes (\d+)-', response.headers.get('Content-Range', ''))
+    return match is not None and int(match.group(1)) == offset
+
+
+def extract_archive(
+    archive: Path,
+    path: Path,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    processes: int = 1,
+) -> List[str]:
+    """
+    Extract a zip archive on disk to path.
+
+    Args:
+        archive (Path): The zip archive to extract
+        path (Path): The directory to extract to
+        include (Optional[Sequence[str]]): Only extract members whose path matches one of these
+            globs, e.g. ['*.fom'], all members are extracted if not provided
+        exclude (Optional[Sequence[str]]): Do not extract members whose path matches any of these globs
+        processes (int): Number of processes to decompress members with, members are split
+            between the processes by compressed size
+
+    Returns:
+        List[str]: The names of the extracted members
+    """
+    with zipfile.ZipFile(archive) as z:
+        members = select_members(z, include, exclude)
+        logger.info(f'Extracting {len(members)} of {len(z.infolist())} members to path {path}')
+        if processes <= 1 or len(members) < 2:
+            z.extractall(path, members)
+            return [member.filename for member in members]
+
+    # Create every directory up front so workers never race on creating shared parents
+    files = []
+    for member in members:
+        if member.is_dir():
+            _member_path(path, member.filename).mkdir(parents=True, exist_ok=True)
+        else:
+            _member_path(path, member.filename).parent.mkdir(parents=True, exist_ok=True)
+            files.append(member)
+    if not files:
+        return [member.filename for member in members]
+
+    # Greedily assign the largest members to the least loaded process
+    groups: List[List[str]] = [[] for _ in range(min(processes, len(files)))]
+    loads = [0] * len(groups)
+    for member in sorted(files, key=lambda x: x.compress_size, reverse=True):
+        index = loads.index(min(loads))
+        groups[index].append(member.filename)
+        loads[index] += member.compress_size
+    with ProcessPoolExecutor(max_workers=len(groups)) as pool:
+        list(pool.map(_extract_members, repeat(archive), repeat(path), groups))
+    return [member.filename for member in members]
+
+
+def select_members(
+    z: zipfile.ZipFile, include: Optional[Sequence[str]] = None, exclude: Optional[Sequence[str]] = None
+) -> List[zipfile.ZipInfo]:
+    """Select the members of an archive matching the include globs and none of the exclude globs."""
+    members = z.infolist()
+    if include:
+        members = [
+            x for x in members if not x.is_dir() and any(fnmatch.fnmatch(x.filename, pat) for pat in include)
+        ]
+    if exclude:
+        members = [x for x in members if not any(fnmatch.fnmatch(x.filename, pat) for pat in exclude)]
+    return members
+
+
+def _member_path(path: Path, name: str) -> Path:
+    """The path a member is extracted to, dropping the same unsafe components as zipfile does."""
+    parts = [part for part in name.split('/') if part not in ('', '.', '..')]
+    return path.joinpath(*parts)
+
+
+def _extract_members(archive: Path, path: Path, names: List[str]) -> None:
+    """Extract a subset of an archive's members, run in a worker process."""
+    with zipfile.ZipFile(archive) as z:
+        z.extractall(path, names)
+
+
+async def get_zip_links_from_doi(
+    doi: str, client: Optional[httpx.AsyncClient] = None, use_cache: bool = True
+) -> List[str]:
+    """Get Zip Links From DOI."""
+    record_json = await get_record_json_from_doi(doi, client, use_cache=use_cache)
+    return parse_json(record_json)
+
+
+async def get_archive_from_doi(
+    doi: str, client: Optional[httpx.AsyncClient] = None, use_cache: bool = True
+) -> Tuple[str, Optional[FileChecksum]]:
+    """Get the zip link of a doi and the checksum of the zip listed in its record, if any."""
+    record_json = await get_record_json_from_doi(doi, client, use_cache=use_cache)
+    return parse_archive(record_json, doi)
+
+
+def parse_archive(record_json: dict, doi: str) -> Tuple[str, Optional[FileChecksum]]:
+    """Get the zip link in a record json and its checksum, if any."""
+    zip_links = parse_json(record_json)
     if len(zip_links) > 1:
         raise ValueError(f'Found two zip links for doi {doi}')
     zip_link = zip_links[0]
-    logger.info(f'Downloading link {zip_link} found for doi')
-    async with httpx.AsyncClient(timeout=timeout) as client:
+    return zip_link, parse_checksums(record_json).get(_link_filename(zip_link))
+
+
+async def get_record_json_from_doi(
+    doi: str, client: Optional[httpx.AsyncClient] = None, use_cache: bool = True
+) -> dict:
+    """
+    Get the Caltech Data record json of a doi.
+
+    Dois that do not exist or redirect to a dead url are remembered in the cache for
+    CACHE_NEGATIVE_TTL seconds and fail immediately until then.
+    """
+    cache = get_cache() if use_cache else None
+    record_url = cache.get_json(DOI_NAMESPACE, doi) if cache else None
+    if record_url is None:
+        if cache is not None:
+            _raise_cached_failure(cache, doi)
         try:
-            r: httpx.Response = await client.get(zip_link, follow_redirects=True)
-        except httpx.ConnectTimeout:
-            raise TimeoutError(f'HTTP Request for {zip_link} timed out.')
-    z = zipfile.ZipFile(io.BytesIO(r.content))
-    logger.info(f'Extracting to path {path}')
-    z.extractall(path)
+            record_url = await resolve_record_url(doi, client)
+        except (DOINotFound, DeadUrlError) as exc:
+            if cache is not None and settings.CACHE_NEGATIVE_TTL > 0:
+                failure = {'error': type(exc).__name__, 'message': str(exc)}
+                if isinstance(exc, DeadUrlError):
+                    failure['dead_url'] = exc.dead_url
+                cache.set_json(FAILURE_NAMESPACE, doi, failure)
+            raise
+        if cache is not None:
+            cache.set_json(DOI_NAMESPACE, doi, record_url)
+    else:
+        logger.info(f'Using cached record url {record_url} for doi {doi}')
 
+    logger.info(f'Downloading json from {record_url} found for doi')
+    return await get_json(record_url, client, use_cache=use_cache)
 
-async def get_zip_links_from_doi(doi: str) -> List[str]:
-    """Get Zip Links From DOI."""
+
+def _raise_cached_failure(cache: DiskCache, doi: str) -> None:
+    """Raise the error recorded the last time a doi failed to resolve, if it has not expired."""
+    if settings.CACHE_NEGATIVE_TTL <= 0:
+        return
+    failure = cache.get_json(FAILURE_NAMESPACE, doi, ttl=settings.CACHE_NEGATIVE_TTL)
+    if failure is None:
+        return
+    logger.info(f'Doi {doi} failed to resolve recently with {failure["error"]}, not retrying')
+    with stage('failure'):
+        if failure['error'] == DeadUrlError.__name__:
+            raise DeadUrlError(failure.get('dead_url'))
+        raise DOINotFound(failure.get('message') or f'DOI does not exist: {doi}')
+
+
+async def resolve_record_url(doi: str, client: Optional[httpx.AsyncClient] = None) -> str:
+    """
+    Follow the doi.org redirect for a doi to the url of its record.
+
+    The redirects are followed with HEAD requests until one points at a Caltech Data record,
+    which is normally the first. The landing page is only downloaded and parsed when the
+    redirects lead somewhere else.
+    """
     doi_url = f"https://doi.org/{doi}"
-    async with httpx.AsyncClient(timeout=timeout) as client:
+    async with _get_client(client) as active_client:
+        record_url = await resolve_record_url_from_redirects(doi, active_client)
+        if record_url is not None:
+            return record_url
+        logger.info(f'Redirects for doi {doi} do not lead to a record, parsing the landing page')
         try:
-            page: httpx.Response = await client.get(doi_url, follow_redirects=True, timeout=60)
+            with stage('resolve') as stats:
+                page: httpx.Response = await rate_limited_get(
+                    active_client, doi_url, follow_redirects=True, timeout=60
+                )
+                stats.bytes = len(page.content)
         except (httpx.TimeoutException):
             raise ConnectionTimeoutError(f'HTTP Request for {doi_url} timed out.')
         except (httpx.ConnectError) as exc:
-            redirect_link = await get_redirect_link_from_doi(doi)
+            redirect_link = await get_redirect_link_from_doi(doi, active_client)
             if redirect_link and 'www.mpsjcap.org' in redirect_link:
                 raise DeadUrlError(f'DOI {doi} redirects to a dead url at {redirect_link}')
             logger.error(f'Error occurred while trying to connect to {doi_url} for downloading', exc_info=exc)
             raise UrlConnectionError(f'HTTP Request for {doi_url} timed out.')
 
-    soup = BeautifulSoup(page.content, "html.parser")
-    title = soup.find('title')
+    with stage('parse'):
+        soup = BeautifulSoup(page.content, "html.parser")
+        title = soup.find('title')
     if 'DOI Not Found' in title.string:
         raise DOINotFound(f'DOI does not exist: {doi}')
+    return str(page.url)
 
-    logger.info(f'Downloading json from {page.url} found for doi')
-    record_json = await get_json(str(page.url))
-    zip_files = parse_json(record_json)
-    return zip_files
 
+async def resolve_record_url_from_redirects(doi: str, client: httpx.AsyncClient) -> Optional[str]:
+    """
+    Find the record url of a doi from the Location headers of its redirects.
 
-async def get_json(caltech_link: str) -> dict:
+    Returns:
+        Optional[str]: The record url, None if the redirects do not reach a Caltech Data record
+
+    Raises:
+        DOINotFound: If doi.org does not know the doi
+        DeadUrlError: If the doi redirects to the retired mpsjcap.org site
+    """
+    url = f'https://doi.org/{doi}'
+    with stage('resolve'):
+        for _ in range(MAX_REDIRECTS):
+            try:
+                response = await rate_limited_request(client, 'HEAD', url, timeout=60)
+            except httpx.HTTPError as exc:
+                logger.debug(f'HEAD request for {url} failed: {exc!r}')
+                return None
+            if response.status_code == 404 and response.url.host == 'doi.org':
+                raise DOINotFound(f'DOI does not exist: {doi}')
+            location = response.headers.get('Location')
+            if not response.is_redirect or not location:
+                return None
+            url = str(response.url.join(location))
+            match = record_url_regex.match(url)
+            if match:
+                return f'https://data.caltech.edu/records/{match.group(1)}'
+            if 'www.mpsjcap.org' in url:
+                raise DeadUrlError(url)
+    return None
+
+
+async def rate_limited_get(
+    client: httpx.AsyncClient, url: str, max_retries: Optional[int] = None, **kwargs
+) -> httpx.Response:
+    """Send a GET request through the process wide rate limiter of the url's host, see rate_limited_request."""
+    return await rate_limited_request(client, 'GET', url, max_retries, **kwargs)
+
+
+async def rate_limited_request(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    max_retries: Optional[int] = None,
+    **kwargs,
+) -> httpx.Response:
+    """
+    Send a request through the process wide rate limiter of the url's host.
+
+    Responses with status 429 slow down the limiter and the request is retried once the
+    limiter allows it, honoring any Retry-After header sent by the server, up to max_retries
+    times, RATE_LIMIT_RETRIES by default.
+
+    Raises:
+        RequestLimitation: If the request is still rate limited after max_retries retries
+    """
+    max_retries = settings.RATE_LIMIT_RETRIES if max_retries is None else max_retries
+    host = httpx.URL(url).host
+    limiter = _get_rate_limiter(host)
+    if limiter is None:
+        return await client.request(method, url, **kwargs)
+    # Redirects may be followed to a different host than the one requested, once that host rate
+    # limits the request the retries wait on its limiter as well
+    limiters = {host: limiter}
+    for _ in range(max_retries + 1):
+        for host_limiter in limiters.values():
+            await host_limiter.acquire()
+        response = await client.request(method, url, **kwargs)
+        if response.status_code != 429:
+            for host_limiter in limiters.values():
+                host_limiter.on_success()
+            return response
+        limited_host = response.url.host
+        if limited_host not in limiters:
+            limiters[limited_host] = get_rate_limiter(limited_host)
+        delay = limiters[limited_host].on_rate_limited(parse_retry_after(response.headers.get('Retry-After')))
+        logger.warning(f'Rate limited by {limited_host}, retrying {url} in {delay:.1f}s')
+    raise RequestLimitation(f'Too many requests, {url} was still rate limited after {max_retries} retries')
+
+
+async def get_json(
+    caltech_link: str, client: Optional[httpx.AsyncClient] = None, use_cache: bool = True
+) -> dict:
     """Get Caltech Record JSON and parse to dict."""
-    retries = 5
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        while retries > 0:
-            response = await client.get(f'{caltech_link}/export/json', follow_redirects=True)
-
-            if response.status_code == 429:
-                retries -= 1
-                await asyncio.sleep(1)
-                continue
-            else:
-                break
-
-    if response.status_code == 429:
-        raise RequestLimitation('Too many requests')
-    elif response.status_code != 200:
+    cache = get_cache() if use_cache else None
+    if cache is not None:
+        record_json = cache.get_json(RECORD_NAMESPACE, caltech_link)
+        if record_json is not None:
+            return record_json
+    async with _get_client(client) as active_client:
+        with stage('record_json') as stats:
+            response = await rate_limited_get(
+                active_client, f'{caltech_link}/export/json', follow_redirects=True
+            )
+            stats.bytes = len(response.content)
+
+    if response.status_code != 200:
         raise CaltechJsonNotFound(
             f'Getting json failed for url {caltech_link}/export/json, got status code {response.status_code}, {response.text}'
         )
 
-    return json.loads(response.text)
+    record_json = json.loads(response.text)
+    if cache is not None:
+        cache.set_json(RECORD_NAMESPACE, caltech_link, record_json)
+    return record_json
 
 
 url_pattern = r'href="(https:\/\/.*\.zip)"'
 regex = re.compile(url_pattern)
+record_url_regex = re.compile(r'^https?://data\.caltech\.edu/records/([^/?#]+)/?(?:[?#].*)?$')
 
 
 def parse_json(record_json: dict):
@@ -136,6 +924,35 @@ def parse_json(record_json: dict):
     return links
 
 
+def parse_checksums(record_json: dict) -> Dict[str, FileChecksum]:
+    """
+    Get the checksums of the files listed in a record json by file name.
+
+    Files are listed either as a mapping under files.entries or as a list of entries with a
+    key, each with a checksum of the form "md5:<hexdigest>" and a size.
+    """
+    files = record_json.get('files') or {}
+    entries = files.get('entries', {}) if isinstance(files, dict) else files
+    if isinstance(entries, dict):
+        items = list(entries.items())
+    else:
+        items = [(entry.get('key'), entry) for entry in entries if isinstance(entry, dict)]
+    checksums = {}
+    for key, entry in items:
+        value = entry.get('checksum') if isinstance(entry, dict) else None
+        if not key or not isinstance(value, str) or ':' not in value:
+            continue
+        algorithm, digest = value.split(':', 1)
+        if algorithm.lower() not in hashlib.algorithms_available:
+            continue
+        checksums[key] = FileChecksum(algorithm.lower(), digest.lower(), entry.get('size'))
+    return checksums
+
+
+def _link_filename(link: str) -> str:
+    return unquote(Path(urlparse(link).path).name)
+
+
 def parse_webpage_for_zip_links(page_contents: bytes, doi: str) -> str:
     soup = BeautifulSoup(page_contents, "html.parser")
     title = soup.find('title')
@@ -160,11 +977,14 @@ def parse_webpage_for_zip_links(page_contents: bytes, doi: str) -> str:
     return zip_file_url
 
 
-async def get_redirect_link_from_doi(doi: str) -> Optional[str]:
+async def get_redirect_link_from_doi(doi: str, client: Optional[httpx.AsyncClient] = None) -> Optional[str]:
     doi_url = f"https://doi.org/{doi}"
-    async with httpx.AsyncClient(timeout=timeout) as client:
+    async with _get_client(client) as active_client:
         try:
-            response = await client.get(doi_url, follow_redirects=False)
+            response = await rate_limited_request(active_client, 'HEAD', doi_url, follow_redirects=False)
+            if response.is_redirect and 'Location' in response.headers:
+                return response.headers['Location']
+            response = await rate_limited_get(active_client, doi_url, follow_redirects=False)
         except (httpx.ConnectTimeout, httpx.TimeoutException):
             return None
 
@@ -0,0 +1,284 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Indexes on the join keys and views used by the queries in mps_client.core.queries.
+
+The schema only indexes labels and types, these indexes cover the foreign keys joined from
+samples to their processes, analyses and plates, and the name of analyses. The materialized
+views are indexed on the columns the queries filter them by. Indexes are built with
+CREATE INDEX CONCURRENTLY so tables stay writable while they are built.
+"""
+
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.engine import Connection
+
+from mps_client._enums import EntityType, Fom, GroupBy
+from mps_client.configuration import settings
+from mps_client.core.queries import (
+    _doi_stmt,
+    _fom_source,
+    _foms_stmt,
+    _process_histories_stmt,
+    _sample_foms_stmt,
+    _sample_process_history_stmt,
+    _sample_stmt,
+)
+from mps_client.core.views import PROCESS_HISTORY, VIEWS, MaterializedView, has_view
+from mps_client.database.session import get_engine
+from mps_client.schema.esamp import (
+    Analysis,
+    Collection,
+    CollectionSample,
+    Process,
+    ProcessDataAnalysis,
+    Sample,
+    SampleProcess,
+    SampleProcessProcessData,
+)
+from mps_client.utils.sql import Explain
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    """An index on columns of a table, with extra columns included to answer joins from the index."""
+
+    name: str
+    table: str
+    keys: Tuple[str, ...]
+    include: Tuple[str, ...] = ()
+    unique: bool = False
+
+    def ddl(self, schema: str, concurrently: bool = True) -> str:
+        include = f' INCLUDE ({", ".join(self.include)})' if self.include else ''
+        keyword = ' CONCURRENTLY' if concurrently else ''
+        unique = ' UNIQUE' if self.unique else ''
+        keys = ', '.join(self.keys)
+        return f'CREATE{unique} INDEX{keyword} {self.name} ON {schema}.{self.table} ({keys}){include}'
+
+
+def _join_index(table: sa.Table, key: str, include: Sequence[str] = ()) -> IndexSpec:
+    return IndexSpec(f'ix_{table.name}_{key}', table.name, (key,), tuple(include))
+
+
+JOIN_INDEXES: List[IndexSpec] = [
+    _join_index(SampleProcess.__table__, 'sample_id', ['process_id']),
+    _join_index(SampleProcess.__table__, 'process_id', ['sample_id']),
+    _join_index(Process.__table__, 'process_detail_id'),
+    _join_index(SampleProcessProcessData.__table__, 'sample_process_id', ['process_data_id']),
+    _join_index(SampleProcessProcessData.__table__, 'process_data_id', ['sample_process_id']),
+    _join_index(ProcessDataAnalysis.__table__, 'analysis_id', ['process_data_id']),
+    _join_index(ProcessDataAnalysis.__table__, 'process_data_id', ['analysis_id']),
+    _join_index(CollectionSample.__table__, 'sample_id', ['collection_id']),
+    _join_index(CollectionSample.__table__, 'collection_id', ['sample_id']),
+    _join_index(Analysis.__table__, 'name'),
+]
+
+
+def view_indexes(view: MaterializedView) -> List[IndexSpec]:
+    """The indexes a view is created with, so ones that were dropped or failed to build can be recreated."""
+    return [
+        IndexSpec(index.name, view.name, tuple(column.name for column in index.columns), unique=index.unique)
+        for index in sorted(view.table.indexes, key=lambda x: x.name)
+    ]
+
+
+def curated_indexes(views: Sequence[MaterializedView] = ()) -> List[IndexSpec]:
+    """The join key indexes and the indexes of views, only pass views that have been created."""
+    return JOIN_INDEXES + [spec for view in views for spec in view_indexes(view)]
+
+
+@dataclass
+class IndexStatus:
+    spec: IndexSpec
+    # None if the index does not exist, False if a failed concurrent build left it invalid
+    valid: Optional[bool]
+
+
+@dataclass
+class QueryTiming:
+    """Planner costs and execution times in ms of a query before and after creating indexes."""
+
+    query: str
+    cost_before: float
+    cost_after: Optional[float] = None
+    ms_before: Optional[float] = None
+    ms_after: Optional[float] = None
+
+    @property
+    def estimated_speedup(self) -> Optional[float]:
+        return _ratio(self.cost_before, self.cost_after)
+
+    @property
+    def observed_speedup(self) -> Optional[float]:
+        return _ratio(self.ms_before, self.ms_after)
+
+
+@dataclass
+class IndexReport:
+    indexes: List[IndexStatus]
+    timings: List[QueryTiming] = field(default_factory=list)
+    # Whether the hypopg extension was used to estimate the costs of missing indexes
+    hypothetical: bool = False
+
+    @property
+    def missing(self) -> List[IndexSpec]:
+        return [status.spec for status in self.indexes if not status.valid]
+
+
+def _ratio(before: Optional[float], after: Optional[float]) -> Optional[float]:
+    if before is None or not after:
+        return None
+    return before / after
+
+
+def _index_status(connection: Connection, specs: Sequence[IndexSpec], schema: str) -> List[IndexStatus]:
+    rows = connection.execute(
+        sa.text(
+            'SELECT c.relname, i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+            'JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = :schema'
+        ),
+        {'schema': schema},
+    ).all()
+    existing: Dict[str, bool] = {name: valid for name, valid in rows}
+    return [IndexStatus(spec, existing.get(spec.name)) for spec in specs]
+
+
+def _workloads(connection: Connection) -> List[Tuple[str, sa.sql.Executable]]:
+    """
+    The statements run by the queries in mps_client.core.queries for a sample and plate in the database.
+
+    The statements read the views once they exist, as the queries do.
+    """
+    sample = connection.execute(sa.select(Sample.id, Sample.label).limit(1)).first()
+    plate_label = connection.execute(sa.select(Collection.label).limit(1)).scalar()
+    analysis_name = connection.execute(sa.select(Analysis.name).limit(1)).scalar()
+    from_view = has_view(PROCESS_HISTORY)
+    workloads: List[Tuple[str, sa.sql.Executable]] = []
+    if sample is not None:
+        sample_id, sample_label = sample
+        workloads += [
+            ('sample', _sample_stmt(None, sample_label)),
+            ('process history', _sample_process_history_stmt(sample_id, None, from_view)),
+            ('process histories', _process_histories_stmt([sample_id], [sample_label], from_view)),
+        ]
+    if plate_label is not None:
+        workloads.append(('plate doi', _doi_stmt(EntityType.PLATE, None, plate_label)))
+    if plate_label is not None and analysis_name is not None:
+        source = _fom_source()
+        workloads += [
+            ('sample foms', _sample_foms_stmt(source, plate_label, analysis_name)),
+            ('foms', _foms_stmt(source, plate_label, analysis_name, Fom.I_A_AVE, GroupBy.MAX)),
+        ]
+    return workloads
+
+
+def _created_views(connection: Connection) -> List[MaterializedView]:
+    return [view for view in VIEWS.values() if view.exists(connection)]
+
+
+def _explain(connection: Connection, stmt, analyze: bool = False) -> Tuple[float, Optional[float]]:
+    """Get the planner cost of a statement, and its execution time in ms if analyze is set."""
+    plan = connection.execute(Explain(stmt, analyze)).scalar()[0]
+    return plan['Plan']['Total Cost'], plan.get('Execution Time')
+
+
+def _has_hypopg(connection: Connection) -> bool:
+    return (
+        connection.execute(sa.text("SELECT 1 FROM pg_extension WHERE extname = 'hypopg'")).first() is not None
+    )
+
+
+def plan_indexes(schema: Optional[str] = None) -> IndexReport:
+    """
+    Check which indexes are missing and estimate how they change the cost of the queries.
+
+    Costs with the missing indexes are estimated from hypothetical indexes when the hypopg
+    extension is installed in the database, nothing is created.
+
+    Args:
+        schema (Optional[str]): The schema of the tables, by default POSTGRES_SCHEMA
+    """
+    schema = schema or settings.POSTGRES_SCHEMA
+    # A transaction so failed hypothetical indexes can be rolled back to a savepoint
+    with get_engine().connect() as connection, connection.begin():
+        report = IndexReport(_index_status(connection, curated_indexes(_created_views(connection)), schema))
+        workloads = _workloads(connection)
+        report.timings = [QueryTiming(name, _explain(connection, stmt)[0]) for name, stmt in workloads]
+        report.hypothetical = bool(report.missing) and _has_hypopg(connection)
+        if report.hypothetical:
+            for spec in report.missing:
+                try:
+                    with connection.begin_nested():
+                        connection.execute(
+                            sa.text('SELECT * FROM hypopg_create_index(:ddl)'),
+                            {'ddl': spec.ddl(schema, False)},
+                        )
+                except sa.exc.DBAPIError as exc:
+                    logger.warning(f'Could not create hypothetical index {spec.name}: {exc.orig}')
+            for timing, (_, stmt) in zip(report.timings, workloads):
+                timing.cost_after = _explain(connection, stmt)[0]
+            connection.execute(sa.text('SELECT hypopg_reset()'))
+    return report
+
+
+def apply_indexes(schema: Optional[str] = None, benchmark: bool = True) -> IndexReport:
+    """
+    Create the missing indexes, rebuilding any left invalid by a failed concurrent build.
+
+    Args:
+        schema (Optional[str]): The schema of the tables, by default POSTGRES_SCHEMA
+        benchmark (bool): Run the queries with EXPLAIN ANALYZE before and after
+            creating the indexes to report the observed speedups
+
+    Returns:
+        IndexReport: The indexes as they were before being created and the timings of the queries
+    """
+    schema = schema or settings.POSTGRES_SCHEMA
+    engine = get_engine()
+    with engine.connect() as connection:
+        report = IndexReport(_index_status(connection, curated_indexes(_created_views(connection)), schema))
+        workloads = _workloads(connection) if benchmark and report.missing else []
+        for name, stmt in workloads:
+            cost, ms = _explain(connection, stmt, analyze=True)
+            report.timings.append(QueryTiming(name, cost, ms_before=ms))
+    if not report.missing:
+        return report
+
+    # Concurrent builds cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for status in report.indexes:
+            if status.valid:
+                continue
+            if status.valid is False:
+                logger.info(f'Dropping invalid index {status.spec.name}')
+                connection.execute(sa.text(f'DROP INDEX CONCURRENTLY IF EXISTS {schema}.{status.spec.name}'))
+            logger.info(f'Creating index {status.spec.name}')
+            start = time.perf_counter()
+            connection.execute(sa.text(status.spec.ddl(schema)))
+            logger.info(f'Created index {status.spec.name} in {time.perf_counter() - start:.1f}s')
+        for table in sorted({spec.table for spec in report.missing}):
+            connection.execute(sa.text(f'ANALYZE {schema}.{table}'))
+
+    with engine.connect() as connection:
+        for timing, (_, stmt) in zip(report.timings, workloads):
+            timing.cost_after, timing.ms_after = _explain(connection, stmt, analyze=True)
+    return report
@@ -0,0 +1,64 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Copy doi records and archives into a mirror served with the DOI_MIRROR setting."""
+
+import json
+import logging
+from pathlib import Path
+
+import httpx
+
+from mps_client.core.download import CHUNK_SIZE, download_file, get_json, parse_archive, resolve_record_url
+from mps_client.utils.mirror import mirror_path
+
+logger = logging.getLogger(__name__)
+
+
+async def mirror_doi(doi: str, root: Path, client: httpx.AsyncClient, chunk_size: int = CHUNK_SIZE) -> Path:
+    """
+    Copy the redirect, record json and archive of a doi into a mirror directory.
+
+    See mps_client.utils.mirror for the layout. An archive already in the mirror with the size
+    listed in the record is not downloaded again.
+
+    Args:
+        doi (str): The doi to mirror
+        root (Path): The mirror directory
+        client (httpx.AsyncClient): A client sending requests to the real doi.org and Caltech Data
+
+    Returns:
+        Path: The location of the archive in the mirror
+    """
+    record_url = await resolve_record_url(doi, client)
+    record_json = await get_json(record_url, client, use_cache=False)
+    zip_link, checksum = parse_archive(record_json, doi)
+
+    _mirror_file(root, f'https://doi.org/{doi}').write_text(record_url)
+    _mirror_file(root, f'{record_url}/export/json').write_text(json.dumps(record_json))
+    archive = _mirror_file(root, zip_link)
+    if archive.exists() and checksum is not None and archive.stat().st_size == checksum.size:
+        logger.info(f'Archive {zip_link} is already mirrored at {archive}')
+        return archive
+    logger.info(f'Mirroring archive {zip_link} to {archive}')
+    await download_file(client, zip_link, archive, chunk_size, checksum=checksum)
+    return archive
+
+
+def _mirror_file(root: Path, url: str) -> Path:
+    path = mirror_path(root, httpx.URL(url))
+    if path is None:
+        raise ValueError(f'Url {url} is outside of the mirror at {root}')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
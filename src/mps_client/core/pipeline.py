@@ -0,0 +1,253 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Streaming pipeline from rows of dois to extracted archives."""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from sqlalchemy.engine import Row
+
+from mps_client.configuration import settings
+from mps_client.core import aqueries
+from mps_client.core.download import (
+    CHUNK_SIZE,
+    ArchiveDownload,
+    DownloadResult,
+    create_client,
+    fetch_archive,
+    install_archive,
+    plan_download,
+)
+from mps_client.core.queries import stream_raw_query
+from mps_client.utils.profiling import StageReport, use_report
+
+logger = logging.getLogger(__name__)
+
+# Passed along a queue once everything before it has been queued
+_DONE = object()
+
+_Downloads = Union[Iterable[Tuple[str, Path]], AsyncIterable[Tuple[str, Path]]]
+_Work = Callable[[DownloadResult, Optional[ArchiveDownload]], Awaitable[Optional[ArchiveDownload]]]
+
+
+async def download_pipeline(
+    downloads: _Downloads,
+    resolvers: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    extractors: int = 1,
+    queue_size: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+    use_cache: bool = True,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    processes: Optional[int] = None,
+    force: bool = False,
+) -> List[DownloadResult]:
+    """
+    Download and extract dois in a pipeline of concurrent stages.
+
+    Each doi passes through resolution, transfer and extraction, the stages run side by side
+    connected by queues of at most queue_size dois so resolving later dois overlaps with
+    transferring and extracting earlier ones. A full queue holds back the stage feeding it,
+    down to reading downloads, which may be a lazy iterator such as the rows of a query and is
+    read from a separate thread, or an async iterator read on the event loop.
+
+    Args:
+        downloads (Union[Iterable[Tuple[str, Path]], AsyncIterable[Tuple[str, Path]]]): Pairs of
+            doi and the path to extract it to
+        resolvers (Optional[int]): The number of dois resolved at once, by default RESOLVE_CONCURRENCY
+        concurrency (Optional[int]): The number of archives transferred at once, by default
+            DOWNLOAD_CONCURRENCY
+        extractors (int): The number of archives extracted at once
+        queue_size (Optional[int]): The maximum number of dois waiting between two stages, by
+            default PIPELINE_QUEUE_SIZE
+
+    The remaining arguments are those of async_download_doi.
+
+    Returns:
+        List[DownloadResult]: The outcome of each download in the order read, failures are
+            recorded on the result instead of being raised. Time spent waiting between stages
+            is recorded in the queue stage of each report.
+    """
+    resolvers = settings.RESOLVE_CONCURRENCY if resolvers is None else resolvers
+    concurrency = settings.DOWNLOAD_CONCURRENCY if concurrency is None else concurrency
+    queue_size = settings.PIPELINE_QUEUE_SIZE if queue_size is None else queue_size
+    if min(resolvers, concurrency, extractors, queue_size) < 1:
+        raise ValueError('resolvers, concurrency, extractors and queue_size must be at least 1')
+    results: List[DownloadResult] = []
+    resolve_queue: asyncio.Queue = asyncio.Queue(queue_size)
+    transfer_queue: asyncio.Queue = asyncio.Queue(queue_size)
+    extract_queue: asyncio.Queue = asyncio.Queue(queue_size)
+
+    async def resolve(result: DownloadResult, _: Optional[ArchiveDownload]) -> Optional[ArchiveDownload]:
+        download = await plan_download(result.doi, result.path, client, use_cache, include, exclude, force)
+        result.skipped = download is None
+        return download
+
+    async def transfer(result: DownloadResult, download: Optional[ArchiveDownload]) -> ArchiveDownload:
+        assert download is not None
+        await fetch_archive(download, client, chunk_size)
+        return download
+
+    async def extract(result: DownloadResult, download: Optional[ArchiveDownload]) -> None:
+        assert download is not None
+        await install_archive(download, include, exclude, processes)
+
+    async with create_client(resolvers + concurrency) as client:
+        source_error, *_ = await asyncio.gather(
+            _read_downloads(downloads, results, resolve_queue),
+            _run_stage(resolve, resolve_queue, transfer_queue, resolvers),
+            _run_stage(transfer, transfer_queue, extract_queue, concurrency),
+            _run_stage(extract, extract_queue, None, extractors),
+        )
+    if source_error is not None:
+        raise source_error
+    return results
+
+
+async def _read_downloads(
+    downloads: _Downloads, results: List[DownloadResult], queue: asyncio.Queue
+) -> Optional[BaseException]:
+    """Feed downloads into the first queue, returning rather than raising any error so the stages drain."""
+
+    async def add(doi: str, path: Path) -> None:
+        result = DownloadResult(doi, path, report=StageReport(doi))
+        results.append(result)
+        await queue.put((result, None, time.perf_counter()))
+
+    loop = asyncio.get_running_loop()
+    try:
+        if isinstance(downloads, AsyncIterable):
+            async for doi, path in downloads:
+                await add(doi, path)
+            return None
+        iterator = iter(downloads)
+        # Read from one thread so iterators holding a database cursor are only used from one thread
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                item = await loop.run_in_executor(executor, next, iterator, _DONE)
+                if item is _DONE:
+                    break
+                await add(*item)
+    except Exception as exc:
+        logger.error(f'Failed to read downloads: {exc!r}')
+        return exc
+    finally:
+        await queue.put(_DONE)
+    return None
+
+
+async def _run_stage(
+    work: _Work, inbox: asyncio.Queue, outbox: Optional[asyncio.Queue], workers: int
+) -> None:
+    """Run workers taking dois from inbox until it is done, passing unfinished downloads to outbox."""
+
+    async def worker() -> None:
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                # Leave the marker for the other workers
+                await inbox.put(_DONE)
+                return
+            result, download, queued = item
+            report = result.report
+            assert report is not None
+            report.add('queue', time.perf_counter() - queued)
+            with use_report(report):
+                try:
+                    download = await work(result, download)
+                except Exception as exc:
+                    logger.error(f'Failed to download doi {result.doi}: {exc!r}')
+                    result.error = exc
+                    download = None
+            if download is None or outbox is None:
+                report.finished = time.perf_counter()
+            else:
+                await outbox.put((result, download, time.perf_counter()))
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    if outbox is not None:
+        await outbox.put(_DONE)
+
+
+def query_downloads(query: str, path: Path, doi_column: Optional[str] = None) -> Iterator[Tuple[str, Path]]:
+    """
+    Stream the dois returned by a sql query as downloads to a folder per doi under path.
+
+    Rows are fetched through a server side cursor as they are consumed, rows without a doi
+    and repeats of a doi already seen are skipped.
+
+    Args:
+        query (str): The sql query to run
+        path (Path): The root folder to download to
+        doi_column (Optional[str]): The column holding the doi, by default the first column
+            named doi or ending in _doi
+    """
+    to_download = _RowDownloads(path, doi_column)
+    for row in stream_raw_query(query):
+        download = to_download(row)
+        if download is not None:
+            yield download
+
+
+async def aquery_downloads(
+    query: str, path: Path, doi_column: Optional[str] = None
+) -> AsyncIterator[Tuple[str, Path]]:
+    """Stream the dois returned by a sql query like query_downloads, running the query on the event loop."""
+    to_download = _RowDownloads(path, doi_column)
+    async for row in aqueries.stream_raw_query(query):
+        download = to_download(row)
+        if download is not None:
+            yield download
+
+
+class _RowDownloads:
+    """Turn the rows of a query into downloads, None for rows without a doi or with a doi already seen."""
+
+    def __init__(self, path: Path, doi_column: Optional[str]) -> None:
+        self.path = path
+        self.doi_column = doi_column
+        self.index: Optional[int] = None
+        self.seen: Set[str] = set()
+
+    def __call__(self, row: Row) -> Optional[Tuple[str, Path]]:
+        if self.index is None:
+            columns = list(row._fields)
+            column = self.doi_column or next((x for x in columns if x == 'doi' or x.endswith('_doi')), None)
+            if column not in columns:
+                raise ValueError(f'Query has no doi column {column or ""}, columns are {columns}')
+            self.index = columns.index(column)
+        doi = row[self.index]
+        if not doi or doi in self.seen:
+            return None
+        self.seen.add(doi)
+        return doi, self.path / doi.replace('/', '_')
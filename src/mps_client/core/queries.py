@@ -12,28 +12,233 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import gzip
+import json
 import logging
-from typing import Optional, Type, Union
+import pickle
+import re
+import tempfile
+from collections import defaultdict
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    Union,
+)
 from uuid import UUID
 
-from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy import String, any_, bindparam, cast, distinct, literal, or_, union_all
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
+from sqlalchemy.engine import Row
 from sqlmodel import Session, func, select, text
 
-from mps_client._enums import EntityType
+from mps_client._enums import EntityType, Fom, GroupBy
+from mps_client.configuration import settings
+from mps_client.core.views import (
+    FOM_COLUMNS,
+    FOM_FACTS,
+    PROCESS_HISTORY,
+    fom_fact_stmt,
+    has_view,
+    process_history_stmt,
+)
 from mps_client.database.session import get_engine
-from mps_client.schema.esamp import Collection, Process, ProcessDetail, Sample, SampleProcess
+from mps_client.schema.esamp import Collection, Sample
 from mps_client.schema.jcap import JcapAnalysis, JcapRun
+from mps_client.utils.cache import get_cache
+
+if TYPE_CHECKING:
+    import numpy as np
 
 logger = logging.getLogger(__name__)
-engine = get_engine()
 
+QUERY_NAMESPACE = 'query'
+
+
+def run_raw_query(
+    query: str,
+    as_frame: bool = False,
+    params: Optional[Dict[str, Any]] = None,
+    use_cache: Optional[bool] = None,
+    **read_csv_kwargs: Any,
+):
+    """
+    Run a raw sql query.
+
+    Results can be kept in the query cache, a namespace of the download cache, keyed by the
+    normalized query and its parameters. Entries are also keyed by the latest updated_on and the
+    release names of the plates and runs in the database, so they are not reused once a new
+    release is loaded.
+
+    Args:
+        query (str): The sql query to run
+        as_frame (bool): Return a pandas DataFrame built from the output of
+            COPY (query) TO STDOUT instead of a list of rows, which avoids creating a python
+            object per row. Values are parsed from csv, so uuids, arrays and json are returned as
+            strings, and read_csv_kwargs such as dtype or parse_dates are passed to pandas.read_csv.
+        params (Optional[Dict[str, Any]]): Values for the :name parameters in the query
+        use_cache (Optional[bool]): Read and store the result in the query cache, by default the
+            QUERY_CACHE_ENABLED setting
+
+    Returns:
+        Union[List[Row], pd.DataFrame]: The rows returned by the query
+    """
+    use_cache = settings.QUERY_CACHE_ENABLED if use_cache is None else use_cache
+    cache = get_cache() if use_cache else None
+    key = _query_cache_key(query, params, as_frame) if cache else None
+    cached = cache.get(QUERY_NAMESPACE, key, '.gz') if cache and key else None
+    if cached is not None:
+        logger.debug(f'Query result found in cache at {cached}')
+
+    if as_frame:
+        # Imported here to keep importing mps_client fast
+        import pandas as pd
+
+        if cached is not None:
+            return pd.read_csv(cached, compression='gzip', **read_csv_kwargs)
+        with tempfile.TemporaryFile() as buffer:
+            copy_raw_query(query, buffer, params)
+            if cache and key:
+                buffer.seek(0)
+                cache.set_bytes(QUERY_NAMESPACE, key, gzip.compress(buffer.read()), '.gz')
+            buffer.seek(0)
+            return pd.read_csv(buffer, **read_csv_kwargs)
 
-def run_raw_query(query: str):
-    with Session(engine) as session:
-        result = session.exec(text(query)).all()
+    if cached is not None:
+        return pickle.loads(gzip.decompress(cached.read_bytes()))
+    with Session(get_engine()) as session:
+        result = session.exec(text(query), params=params).all()
+    if cache and key:
+        cache.set_bytes(QUERY_NAMESPACE, key, gzip.compress(pickle.dumps(result)), '.gz')
     return result
 
 
+def copy_raw_query(query: str, file: IO[bytes], params: Optional[Dict[str, Any]] = None) -> None:
+    """Write the result of a raw sql query to a binary file as csv with a header, using COPY."""
+    with Session(get_engine()) as session:
+        connection = session.connection()
+        cursor = connection.connection.cursor()
+        try:
+            query = _copy_query(query)
+            if params:
+                # COPY does not take parameters so they are bound into the query by the driver
+                compiled = text(query).bindparams(**params).compile(dialect=connection.dialect)
+                query = cursor.mogrify(str(compiled), compiled.params).decode()
+            # The closing paren is on its own line so a line comment left in the query cannot hide it
+            cursor.copy_expert(f'COPY ({query}\n) TO STDOUT WITH (FORMAT csv, HEADER)', file)
+        finally:
+            cursor.close()
+
+
+_QUERY_TOKENS = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|\s+")
+
+
+def _strip_query(query: str) -> str:
+    return query.strip().rstrip(';').strip()
+
+
+_SQL_TOKENS = re.compile(
+    r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/|\s+|;|[^'\"\s;\-/]+|.", re.DOTALL
+)
+
+
+def _copy_query(query: str) -> str:
+    """
+    Strip the trailing semicolons and comments of a query so it can be wrapped in COPY (...).
+
+    Raises:
+        ValueError: If the query holds more than one statement
+    """
+    end = 0
+    terminated = False
+    for match in _SQL_TOKENS.finditer(query):
+        token = match.group()
+        if token == ';':
+            terminated = True
+        elif not (token.isspace() or token.startswith('--') or token.startswith('/*')):
+            if terminated:
+                raise ValueError(f'Only a single statement can be copied, got {query!r}')
+            end = match.end()
+    return query[:end].strip()
+
+
+def _normalize_query(query: str) -> str:
+    """Collapse runs of whitespace outside of quoted strings and identifiers and drop any trailing semicolon."""
+    return _QUERY_TOKENS.sub(lambda match: match.group(1) or ' ', _strip_query(query))
+
+
+def _data_version() -> Optional[str]:
+    """Summarize the loaded releases, changing whenever a plate or run is added or updated."""
+    with Session(get_engine()) as session:
+        summaries = [
+            session.exec(
+                select(func.max(table.updated_on), func.array_agg(distinct(table.release_name)))
+            ).one()
+            for table in (Collection, JcapRun)
+        ]
+    return json.dumps(
+        [[updated_on, sorted(releases or [])] for updated_on, releases in summaries], default=str
+    )
+
+
+def _query_cache_key(query: str, params: Optional[Dict[str, Any]], as_frame: bool) -> Optional[str]:
+    try:
+        version = _data_version()
+    except Exception as exc:
+        logger.warning(f'Not caching query, failed to read the data version: {exc!r}')
+        return None
+    return json.dumps(
+        {
+            'database': f'{settings.POSTGRES_DSN}/{settings.POSTGRES_SCHEMA}',
+            'version': version,
+            'query': _normalize_query(query),
+            'params': sorted((params or {}).items()),
+            'format': 'csv' if as_frame else 'rows',
+        },
+        default=str,
+    )
+
+
+def stream_raw_query(
+    query: str, fetch_size: Optional[int] = None, batches: bool = False
+) -> Iterator[Union[Row, List[Row]]]:
+    """
+    Stream the rows of a raw sql query through a server side cursor.
+
+    Rows are fetched from the server fetch_size at a time so memory use does not grow with the
+    size of the result. The connection is held until the generator is exhausted or closed.
+
+    Args:
+        query (str): The sql query to run
+        fetch_size (Optional[int]): The number of rows fetched from the server at once, by default
+            QUERY_FETCH_SIZE
+        batches (bool): Yield lists of up to fetch_size rows instead of single rows
+    """
+    fetch_size = settings.QUERY_FETCH_SIZE if fetch_size is None else fetch_size
+    with Session(get_engine()) as session:
+        result = session.execute(
+            text(query), execution_options={'stream_results': True, 'yield_per': fetch_size}
+        )
+        if batches:
+            for partition in result.partitions(fetch_size):
+                yield partition
+        else:
+            yield from result
+
+
+ProcessHistory = Tuple[List[UUID], List[str], List[str]]
+
+
 def get_process_history(sample_id: Optional[UUID] = None, sample_label: Optional[str] = None):
     """
     Get the process history of a given sample_id or sample_id.
@@ -47,35 +252,217 @@ def get_process_history(sample_id: Optional[UUID] = None, sample_label: Optional
     Returns:
         Tuple[List[str],List[str]]: A tuple of the list of time ordered types, and list of time ordered techniques.
     """
-    with Session(engine) as session:
-        stmt = (
-            select(
-                func.ARRAY_AGG(aggregate_order_by(Process.id, Process.timestamp, Process.ordering)).label(
-                    'process_id'
-                ),
-                func.ARRAY_AGG(
-                    aggregate_order_by(ProcessDetail.type, Process.timestamp, Process.ordering)
-                ).label('process_type'),
-                func.ARRAY_AGG(
-                    aggregate_order_by(ProcessDetail.technique, Process.timestamp, Process.ordering)
-                ).label('process_technique'),
-            )
-            .select_from(Sample)
-            .join(SampleProcess)
-            .join(Process)
-            .join(ProcessDetail)
-        )
-        if sample_id:
-            stmt = stmt.where(Sample.id == sample_id)
-        elif sample_label:
-            stmt = stmt.where(Sample.label == sample_label)
-        stmt = stmt.group_by(Sample.id)
+    with Session(get_engine()) as session:
+        stmt = _sample_process_history_stmt(sample_id, sample_label, from_view=has_view(PROCESS_HISTORY))
         result = session.exec(stmt).one_or_none()
         if result is None:
             return [], [], []
     return result
 
 
+def _sample_process_history_stmt(
+    sample_id: Optional[UUID], sample_label: Optional[str], from_view: bool = False
+):
+    if from_view:
+        view = PROCESS_HISTORY.table
+        stmt = select(view.c.process_id, view.c.process_type, view.c.process_technique)
+        if sample_id:
+            return stmt.where(view.c.sample_id == sample_id)
+        elif sample_label:
+            return stmt.where(view.c.sample_label == sample_label)
+        return stmt
+    stmt = process_history_stmt()
+    if sample_id:
+        stmt = stmt.where(Sample.id == sample_id)
+    elif sample_label:
+        stmt = stmt.where(Sample.label == sample_label)
+    return stmt.group_by(Sample.id)
+
+
+def get_process_histories(
+    sample_ids: Optional[Sequence[UUID]] = None, sample_labels: Optional[Sequence[str]] = None
+) -> Dict[Union[UUID, str], ProcessHistory]:
+    """
+    Get the process histories of many samples with a single query.
+
+    Args:
+        sample_ids (Optional[Sequence[UUID]]): The UUIDs of the samples to get the histories for
+        sample_labels (Optional[Sequence[str]]): The labels of the samples to get the histories for
+
+    Returns:
+        Dict[Union[UUID, str], ProcessHistory]: The time ordered process ids, types and techniques
+            of each sample keyed by the id or label it was requested by. Samples that do not exist
+            or have no processes are left out.
+    """
+    sample_ids, sample_labels = list(sample_ids or []), list(sample_labels or [])
+    if not sample_ids and not sample_labels:
+        return {}
+    stmt = _process_histories_stmt(sample_ids, sample_labels, from_view=has_view(PROCESS_HISTORY))
+    with Session(get_engine()) as session:
+        rows = session.exec(stmt).all()
+
+    requested_ids, requested_labels = set(sample_ids), set(sample_labels)
+    histories: Dict[Union[UUID, str], ProcessHistory] = {}
+    for process_ids, types, techniques, sample_id, sample_label in rows:
+        history = (process_ids, types, techniques)
+        if sample_id in requested_ids:
+            histories[sample_id] = history
+        if sample_label in requested_labels:
+            histories[sample_label] = history
+    return histories
+
+
+def _process_histories_stmt(
+    sample_ids: Sequence[UUID], sample_labels: Sequence[str], from_view: bool = False
+):
+    # Each list is sent as a single array parameter so the statement is the same for any number of samples
+    ids_param = bindparam('sample_ids', [str(x) for x in sample_ids], type_=ARRAY(String))
+    labels_param = bindparam('sample_labels', sample_labels, type_=ARRAY(String))
+    if from_view:
+        view = PROCESS_HISTORY.table
+        return select(
+            view.c.process_id,
+            view.c.process_type,
+            view.c.process_technique,
+            view.c.sample_id,
+            view.c.sample_label,
+        ).where(
+            or_(
+                view.c.sample_id == any_(cast(ids_param, ARRAY(PG_UUID))),
+                view.c.sample_label == any_(labels_param),
+            )
+        )
+    return (
+        process_history_stmt()
+        .add_columns(Sample.id, Sample.label)
+        .where(or_(Sample.id == any_(cast(ids_param, ARRAY(PG_UUID))), Sample.label == any_(labels_param)))
+        .group_by(Sample.id)
+    )
+
+
+def get_sample_foms(
+    plate_label: Optional[str] = None,
+    analysis_name: Optional[str] = None,
+    sample_ids: Optional[Sequence[UUID]] = None,
+    foms: Optional[Sequence[Fom]] = None,
+) -> List[Row]:
+    """
+    Get the foms of the analyses of samples from the sample_fom view.
+
+    The view is read once it exists, until then the same rows are computed from the
+    underlying tables.
+
+    Args:
+        plate_label (Optional[str]): Only get samples on this plate
+        analysis_name (Optional[str]): Only get analyses with this name, e.g. CA_FOMS_standard
+        sample_ids (Optional[Sequence[UUID]]): Only get these samples
+        foms (Optional[Sequence[Fom]]): The foms to get, by default all of them
+
+    Returns:
+        List[Row]: A row per analysis of each sample process on each plate with the sample, plate,
+            process and analysis, and a column per fom named as in FOM_COLUMNS holding None
+            where the analysis did not output a number for it.
+    """
+    stmt = _sample_foms_stmt(_fom_source(), plate_label, analysis_name, sample_ids, foms)
+    with Session(get_engine()) as session:
+        return session.exec(stmt).all()
+
+
+def _sample_foms_stmt(
+    source,
+    plate_label: Optional[str] = None,
+    analysis_name: Optional[str] = None,
+    sample_ids: Optional[Sequence[UUID]] = None,
+    foms: Optional[Sequence[Fom]] = None,
+):
+    stmt = select(
+        source.c.sample_id,
+        source.c.sample_label,
+        source.c.plate_label,
+        source.c.process_type,
+        source.c.process_technique,
+        source.c.process_timestamp,
+        source.c.analysis_name,
+        *(source.c[FOM_COLUMNS[fom]] for fom in foms or list(Fom)),
+    )
+    if plate_label is not None:
+        stmt = stmt.where(source.c.plate_label == plate_label)
+    if analysis_name is not None:
+        stmt = stmt.where(source.c.analysis_name == analysis_name)
+    if sample_ids is not None:
+        ids_param = bindparam('sample_ids', [str(x) for x in sample_ids], type_=ARRAY(String))
+        stmt = stmt.where(source.c.sample_id == any_(cast(ids_param, ARRAY(PG_UUID))))
+    return stmt.order_by(source.c.sample_label, source.c.process_timestamp, source.c.analysis_name)
+
+
+class SampleFoms(NamedTuple):
+    """A fom aggregated per sample, each array has an entry per sample in the same order."""
+
+    sample_ids: 'np.ndarray'
+    sample_labels: 'np.ndarray'
+    values: 'np.ndarray'
+    # The number of measurements of the fom aggregated into each value
+    counts: 'np.ndarray'
+
+
+def get_foms(plate_label: str, analysis_name: str, fom: Fom, group_by: GroupBy = GroupBy.MAX) -> SampleFoms:
+    """
+    Get a fom of every sample on a plate, aggregating repeated measurements in the database.
+
+    Reads the sample_fom view like get_sample_foms, only a row per sample is sent back.
+
+    Args:
+        plate_label (str): The label of the plate
+        analysis_name (str): The name of the analyses to get the fom from, e.g. CA_FOMS_standard
+        fom (Fom): The fom to get
+        group_by (GroupBy): How to combine the measurements of a sample
+
+    Returns:
+        SampleFoms: The samples ordered by label, with the aggregated fom as floats, NaN for
+            samples without a numeric value.
+    """
+    # Imported here to keep importing mps_client fast
+    import numpy as np
+
+    stmt = _foms_stmt(_fom_source(), plate_label, analysis_name, fom, group_by)
+    with Session(get_engine()) as session:
+        rows = session.exec(stmt).all()
+    sample_ids, sample_labels, values, counts = zip(*rows) if rows else ((), (), (), ())
+    return SampleFoms(
+        np.array(sample_ids, dtype=object),
+        np.array(sample_labels, dtype=object),
+        np.array(values, dtype=float),
+        np.array(counts, dtype=int),
+    )
+
+
+def _foms_stmt(source, plate_label: str, analysis_name: str, fom: Fom, group_by: GroupBy):
+    column = source.c[FOM_COLUMNS[fom]]
+    if group_by == GroupBy.MAX:
+        value = func.max(column)
+    elif group_by == GroupBy.MEAN:
+        value = func.avg(column)
+    elif group_by == GroupBy.MEDIAN:
+        value = func.percentile_cont(0.5).within_group(column)
+    elif group_by == GroupBy.MIN:
+        value = func.min(column)
+    else:
+        raise ValueError(f'Unknown group_by: {group_by}')
+    return (
+        select(source.c.sample_id, source.c.sample_label, value, func.count(column))
+        .where(source.c.plate_label == plate_label, source.c.analysis_name == analysis_name)
+        .group_by(source.c.sample_id, source.c.sample_label)
+        .order_by(source.c.sample_label, source.c.sample_id)
+    )
+
+
+def _fom_source():
+    """Get the sample_fom view, or the query defining it while the view has not been created."""
+    if has_view(FOM_FACTS):
+        return FOM_FACTS.table
+    return fom_fact_stmt().subquery(FOM_FACTS.name)
+
+
 def get_sample(sample_id: Optional[UUID] = None, sample_label: Optional[str] = None) -> Optional[Sample]:
     """
     Get a sample by its ID or Label
@@ -89,30 +476,32 @@ def get_sample(sample_id: Optional[UUID] = None, sample_label: Optional[str] = N
     Returns:
         Tuple[List[str],List[str]]: A tuple of the list of time ordered types, and list of time ordered techniques.
     """
+    with Session(get_engine()) as session:
+        result = session.exec(_sample_stmt(sample_id, sample_label)).one_or_none()
+    return result
+
+
+def _sample_stmt(sample_id: Optional[UUID], sample_label: Optional[str]):
     if not sample_label and not sample_id:
         raise ValueError('Need to provide sample_label or sample_id.')
     elif sample_label and sample_id:
         raise ValueError('Need to provide sample_label or sample_id, not both.')
-    with Session(engine) as session:
-        stmt = select(Sample)
-        if sample_id:
-            stmt = stmt.where(Sample.id == sample_id)
-        elif sample_label:
-            stmt = stmt.where(Sample.label == sample_label)
-        result = session.exec(stmt).one_or_none()
-    return result
+    stmt = select(Sample)
+    if sample_id:
+        stmt = stmt.where(Sample.id == sample_id)
+    elif sample_label:
+        stmt = stmt.where(Sample.label == sample_label)
+    return stmt
 
 
 def get_doi(entity_type: EntityType, entity_id: Optional[UUID], entity_label: Optional[str]) -> Optional[str]:
-    table: Union[Type[Collection], Type[JcapRun], Type[JcapAnalysis]]
-    if entity_type == EntityType.PLATE:
-        table = Collection
-    elif entity_type == EntityType.RUN:
-        table = JcapRun
-    elif entity_type == EntityType.ANALYSIS:
-        table = JcapAnalysis
-    else:
-        raise ValueError(f'Unknown entity_type: {entity_type}')
+    with Session(get_engine()) as session:
+        result = session.exec(_doi_stmt(entity_type, entity_id, entity_label)).one_or_none()
+    return result
+
+
+def _doi_stmt(entity_type: EntityType, entity_id: Optional[UUID], entity_label: Optional[str]):
+    table = _doi_table(entity_type)
 
     # Ensure we have at least an id or label
     if not (entity_label or entity_id):
@@ -126,7 +515,78 @@ def get_doi(entity_type: EntityType, entity_id: Optional[UUID], entity_label: Op
         stmt = stmt.where(table.id == entity_id)
     elif entity_label:
         stmt = stmt.where(table.label == entity_label)
+    return stmt
 
-    with Session(engine) as session:
-        result = session.exec(stmt).one_or_none()
-    return result
+
+def _doi_table(entity_type: EntityType) -> Union[Type[Collection], Type[JcapRun], Type[JcapAnalysis]]:
+    if entity_type == EntityType.PLATE:
+        return Collection
+    elif entity_type == EntityType.RUN:
+        return JcapRun
+    elif entity_type == EntityType.ANALYSIS:
+        return JcapAnalysis
+    raise ValueError(f'Unknown entity_type: {entity_type}')
+
+
+EntityKey = Tuple[EntityType, Union[UUID, str]]
+
+
+def get_dois(entities: Iterable[EntityKey]) -> Tuple[Dict[EntityKey, Optional[str]], List[EntityKey]]:
+    """
+    Get the dois of many plates, runs and analyses with a single query.
+
+    Args:
+        entities (Iterable[EntityKey]): Pairs of entity type and the UUID of the entity, or the
+            label for plates
+
+    Returns:
+        Tuple[Dict[EntityKey, Optional[str]], List[EntityKey]]: The doi of each entity found, None
+            for those without a doi, and the entities that do not exist in the order requested.
+    """
+    entities = list(dict.fromkeys(entities))
+    ids: Dict[EntityType, List[str]] = defaultdict(list)
+    labels: List[str] = []
+    for entity_type, key in entities:
+        _doi_table(entity_type)
+        if isinstance(key, UUID):
+            ids[entity_type].append(str(key))
+        elif entity_type == EntityType.PLATE:
+            labels.append(key)
+        else:
+            raise ValueError(f'Cannot provide a label for entity: {entity_type}')
+
+    # One select per table and kind of key, each taking its keys as a single array parameter
+    selects = []
+    for entity_type, entity_ids in ids.items():
+        table = _doi_table(entity_type)
+        param = bindparam(f'{entity_type.value}_ids', entity_ids, type_=ARRAY(String))
+        selects.append(
+            select(
+                literal(entity_type.value).label('entity_type'),
+                literal(True).label('by_id'),
+                cast(table.id, String).label('key'),
+                table.doi,
+            ).where(table.id == any_(cast(param, ARRAY(PG_UUID))))
+        )
+    if labels:
+        param = bindparam('plate_labels', labels, type_=ARRAY(String))
+        selects.append(
+            select(
+                literal(EntityType.PLATE.value).label('entity_type'),
+                literal(False).label('by_id'),
+                Collection.label.label('key'),
+                Collection.doi,
+            ).where(Collection.label == any_(param))
+        )
+    if not selects:
+        return {}, []
+    with Session(get_engine()) as session:
+        rows = session.exec(union_all(*selects) if len(selects) > 1 else selects[0]).all()
+
+    dois: Dict[EntityKey, Optional[str]] = {}
+    for entity_type, by_id, key, doi in rows:
+        entity = (EntityType(entity_type), UUID(key) if by_id else key)
+        # Plates sharing a label resolve to the first one with a doi
+        if dois.get(entity) is None:
+            dois[entity] = doi
+    return dois, [entity for entity in entities if entity not in dois]
@@ -0,0 +1,300 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Random access into zip archives on a remote server using http range requests."""
+
+import asyncio
+import io
+import logging
+import struct
+import zipfile
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Set, Tuple, TypeVar, Union
+
+import httpx
+
+from mps_client._exceptions import RangeRequestsNotSupported
+from mps_client.core.download import (
+    ARCHIVE_NAMESPACE,
+    _get_client,
+    extract_archive,
+    get_zip_links_from_doi,
+    rate_limited_get,
+    select_members,
+)
+from mps_client.utils.cache import get_cache
+
+logger = logging.getLogger(__name__)
+T = TypeVar('T')
+
+# The end of central directory record is 22 bytes followed by a comment of up to 65535 bytes
+_EOCD = struct.Struct('<4s4H2LH')
+_EOCD_SIGNATURE = b'PK\x05\x06'
+_TAIL_SIZE = _EOCD.size + (1 << 16)
+_ZIP64_LOCATOR = struct.Struct('<4sLQL')
+_ZIP64_EOCD = struct.Struct('<4sQ2H2L4Q')
+_LOCAL_HEADER_SIZE = 30
+# Extra bytes requested after each member for local header extra fields and data descriptors
+_MEMBER_SLACK = 1024
+_EXTRACT_CONCURRENCY = 4
+
+
+class _MissingRange(Exception):
+    """Raised when a read touches bytes of the remote file that have not been fetched."""
+
+    def __init__(self, start: int, end: int) -> None:
+        super().__init__(f'Bytes {start}-{end} have not been fetched')
+        self.start = start
+        self.end = end
+
+
+class _SparseFile(io.RawIOBase):
+    """A read only file of a known size holding only the byte ranges fetched so far."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.position = 0
+        self.ranges: List[Tuple[int, bytes]] = []
+        self.pinned: Set[int] = set()
+
+    def add(self, start: int, data: bytes) -> None:
+        self.ranges.append((start, data))
+
+    def discard(self, *starts: int) -> None:
+        """Drop fetched ranges beginning at starts, unless they are pinned."""
+        drop = set(starts) - self.pinned
+        self.ranges = [(start, data) for start, data in self.ranges if start not in drop]
+
+    def missing(self, start: int, end: int) -> bool:
+        return not any(s <= start and end <= s + len(data) for s, data in self.ranges)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        start = self.position
+        for range_start, data in self.ranges:
+            if range_start <= start and end <= range_start + len(data):
+                self.position = end
+                return data[start - range_start : end - range_start]
+        raise _MissingRange(start, end)
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+class RemoteZip:
+    """
+    A zip archive on a server that supports range requests.
+
+    Opening the archive reads the central directory from the end of the file, normally with a
+    single request, after which the bytes of each member are fetched with one request each.
+    The compressed bytes of a member are held in memory while it is extracted and dropped once
+    it is written to disk.
+    """
+
+    def __init__(
+        self, url: str, client: httpx.AsyncClient, sparse: _SparseFile, directory_offset: int
+    ) -> None:
+        self.url = url
+        self.client = client
+        self.size = sparse.size
+        self.zipfile = zipfile.ZipFile(sparse)
+        self._sparse = sparse
+        self._directory_offset = directory_offset
+
+    @classmethod
+    async def open(cls, url: str, client: httpx.AsyncClient) -> 'RemoteZip':
+        response = await _get_range(client, url, f'-{_TAIL_SIZE}')
+        size = int(response.headers['Content-Range'].rsplit('/', 1)[-1])
+        tail = response.content
+        tail_start = size - len(tail)
+        directory_offset = _find_directory_offset(tail, tail_start)
+        if directory_offset < tail_start:
+            logger.debug(f'Fetching central directory of {url} from byte {directory_offset}')
+            response = await _get_range(client, url, f'{directory_offset}-{tail_start - 1}')
+            # Kept as one range since the directory is read with a single read spanning both requests
+            tail = response.content + tail
+            tail_start = directory_offset
+        sparse = _SparseFile(size)
+        sparse.add(tail_start, tail)
+        sparse.pinned.add(tail_start)
+        return cls(url, client, sparse, directory_offset)
+
+    def infolist(self) -> List[zipfile.ZipInfo]:
+        return self.zipfile.infolist()
+
+    def select(
+        self, include: Optional[Sequence[str]] = None, exclude: Optional[Sequence[str]] = None
+    ) -> List[zipfile.ZipInfo]:
+        return select_members(self.zipfile, include, exclude)
+
+    async def read(self, member: zipfile.ZipInfo) -> bytes:
+        return await self._with_member(member, self.zipfile.read)
+
+    async def extract(self, member: zipfile.ZipInfo, path: Path) -> Path:
+        return Path(await self._with_member(member, lambda x: self.zipfile.extract(x, path)))
+
+    async def extract_all(
+        self, members: Sequence[zipfile.ZipInfo], path: Path, concurrency: int = _EXTRACT_CONCURRENCY
+    ) -> List[Path]:
+        """Fetch and extract the members to path, holding the bytes of at most concurrency members at once."""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def extract(member: zipfile.ZipInfo) -> Path:
+            async with semaphore:
+                return await self.extract(member, path)
+
+        return list(await asyncio.gather(*(extract(member) for member in members)))
+
+    async def _with_member(self, member: zipfile.ZipInfo, func: Callable[[zipfile.ZipInfo], T]) -> T:
+        """Run func on a member once its bytes are fetched, then drop them from memory."""
+        start = await self._fetch_member(member)
+        try:
+            # The local header may be larger than expected, fetch any bytes read past it
+            for _ in range(3):
+                try:
+                    return func(member)
+                except _MissingRange as exc:
+                    logger.debug(f'Fetching unexpected bytes {exc.start}-{exc.end} of {member.filename}')
+                    start = exc.start
+                    await self._fetch(start, min(self.size, exc.end + _MEMBER_SLACK))
+            raise zipfile.BadZipFile(f'Could not read member {member.filename} of {self.url}')
+        finally:
+            self._sparse.discard(member.header_offset, start)
+
+    async def _fetch_member(self, member: zipfile.ZipInfo) -> int:
+        start = member.header_offset
+        name_length = len(member.orig_filename.encode('utf-8'))
+        end = start + _LOCAL_HEADER_SIZE + name_length + len(member.extra) + member.compress_size
+        end = min(end + _MEMBER_SLACK, self._next_offset(member))
+        if self._sparse.missing(start, end):
+            await self._fetch(start, end)
+        return start
+
+    async def _fetch(self, start: int, end: int) -> None:
+        response = await _get_range(self.client, self.url, f'{start}-{end - 1}')
+        self._sparse.add(start, response.content)
+
+    def _next_offset(self, member: zipfile.ZipInfo) -> int:
+        """Get the offset of whatever follows a member, the next member or the central directory."""
+        following = [x.header_offset for x in self.infolist() if x.header_offset > member.header_offset]
+        return min(following, default=self._directory_offset)
+
+
+async def open_remote_archive(
+    doi: str, client: httpx.AsyncClient, use_cache: bool = True
+) -> Tuple[str, Union[RemoteZip, Path]]:
+    """
+    Open the archive of a doi for random access.
+
+    Returns:
+        Tuple[str, Union[RemoteZip, Path]]: The archive link and the cached copy of the archive
+            if there is one, otherwise a RemoteZip reading from the archive link.
+    """
+    zip_links = await get_zip_links_from_doi(doi, client, use_cache=use_cache)
+    if len(zip_links) > 1:
+        raise ValueError(f'Found two zip links for doi {doi}')
+    zip_link = zip_links[0]
+    cache = get_cache() if use_cache else None
+    cached = cache.get(ARCHIVE_NAMESPACE, zip_link, '.zip') if cache else None
+    if cached is not None:
+        logger.info(f'Using cached archive for {zip_link}')
+        return zip_link, cached
+    logger.info(f'Reading central directory of {zip_link}')
+    return zip_link, await RemoteZip.open(zip_link, client)
+
+
+async def list_archive_members(
+    doi: str,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    client: Optional[httpx.AsyncClient] = None,
+    use_cache: bool = True,
+) -> List[zipfile.ZipInfo]:
+    """List the members of the archive of a doi without downloading the whole archive."""
+    async with _get_client(client) as active_client:
+        _, archive = await open_remote_archive(doi, active_client, use_cache)
+    if isinstance(archive, RemoteZip):
+        return archive.select(include, exclude)
+    with zipfile.ZipFile(archive) as z:
+        return select_members(z, include, exclude)
+
+
+async def extract_archive_members(
+    doi: str,
+    path: Path,
+    include: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    client: Optional[httpx.AsyncClient] = None,
+    use_cache: bool = True,
+) -> List[str]:
+    """
+    Extract the members of the archive of a doi matching the include and exclude globs.
+
+    Only the bytes of the selected members are fetched from the server, see RemoteZip.
+
+    Returns:
+        List[str]: The names of the extracted members
+    """
+    async with _get_client(client) as active_client:
+        _, archive = await open_remote_archive(doi, active_client, use_cache)
+        if isinstance(archive, RemoteZip):
+            members = archive.select(include, exclude)
+            logger.info(f'Extracting {len(members)} of {len(archive.infolist())} members to path {path}')
+            await archive.extract_all(members, path)
+            return [member.filename for member in members]
+    return extract_archive(archive, path, include, exclude)
+
+
+async def _get_range(client: httpx.AsyncClient, url: str, byte_range: str) -> httpx.Response:
+    headers = {'Range': f'bytes={byte_range}'}
+    response = await rate_limited_get(client, url, headers=headers, follow_redirects=True)
+    if response.status_code != 206 or 'Content-Range' not in response.headers:
+        raise RangeRequestsNotSupported(f'Server for {url} does not support range requests')
+    return response
+
+
+def _find_directory_offset(tail: bytes, tail_start: int) -> int:
+    """Find the offset of the central directory from the end of a zip archive."""
+    eocd_index = tail.rfind(_EOCD_SIGNATURE)
+    if eocd_index < 0 or len(tail) - eocd_index < _EOCD.size:
+        raise zipfile.BadZipFile('Cannot find the end of central directory record')
+    _, _, _, _, total, size, offset, _ = _EOCD.unpack_from(tail, eocd_index)
+    if 0xFFFFFFFF not in (size, offset) and total != 0xFFFF:
+        return offset
+    locator_index = eocd_index - _ZIP64_LOCATOR.size
+    signature, _, zip64_offset, _ = _ZIP64_LOCATOR.unpack_from(tail, locator_index)
+    if signature != b'PK\x06\x07':
+        raise zipfile.BadZipFile('Cannot find the zip64 end of central directory locator')
+    record = _ZIP64_EOCD.unpack_from(tail, zip64_offset - tail_start)
+    return record[-1]
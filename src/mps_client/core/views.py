@@ -0,0 +1,256 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Materialized views of the expensive joins behind the queries in mps_client.core.queries.
+
+Views are created and refreshed with mps-client database refresh-views, queries read from a
+view once it exists and fall back to the underlying join otherwise. A view holds the data as
+of its last refresh.
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.engine import Connection
+from sqlmodel import func, select
+
+from mps_client._enums import Fom
+from mps_client.configuration import settings
+from mps_client.database.session import get_async_engine, get_engine
+from mps_client.schema.esamp import (
+    Analysis,
+    Collection,
+    CollectionSample,
+    Process,
+    ProcessDataAnalysis,
+    ProcessDetail,
+    Sample,
+    SampleProcess,
+    SampleProcessProcessData,
+)
+from mps_client.utils.sql import create_mat_view
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MaterializedView:
+    """A materialized view defined with create_mat_view in a metadata of its own so it is created alone."""
+
+    table: sa.Table
+    metadata: sa.MetaData
+
+    @property
+    def name(self) -> str:
+        return self.table.name
+
+    @property
+    def qualified_name(self) -> str:
+        return f'{self.table.schema}.{self.table.name}'
+
+    def exists(self, connection: Connection, populated: bool = False) -> bool:
+        """Check whether the view has been created, and populated so it can be read if populated is set."""
+        stmt = sa.text(
+            'SELECT ispopulated FROM pg_matviews WHERE schemaname = :schema AND matviewname = :name'
+        )
+        row = connection.execute(stmt, {'schema': self.table.schema, 'name': self.name}).first()
+        return row is not None and (row[0] or not populated)
+
+    def create(self, connection: Connection) -> None:
+        """Create and populate the view and its indexes."""
+        self.metadata.create_all(connection)
+
+    def refresh(self, connection: Connection, concurrently: bool = True) -> None:
+        """
+        Recompute the view.
+
+        A concurrent refresh does not block reads of the view while it runs, at the cost of
+        diffing the old and new contents, it needs the unique index every view here has.
+        """
+        keyword = 'CONCURRENTLY ' if concurrently else ''
+        connection.execute(sa.text(f'REFRESH MATERIALIZED VIEW {keyword}{self.qualified_name}'))
+
+
+def _define_view(
+    name: str, selectable, indexes: Sequence[Tuple[Sequence[str], bool]] = ()
+) -> MaterializedView:
+    """Define a view in the configured schema with an index on each list of columns, flagged if unique."""
+    metadata = sa.MetaData()
+    columns = [sa.Column(column.name, column.type) for column in selectable.selected_columns]
+    table = create_mat_view(name, selectable, settings.POSTGRES_SCHEMA, metadata, columns)
+    for index_columns, unique in indexes:
+        sa.Index(f'ix_{name}_{"_".join(index_columns)}', *(table.c[x] for x in index_columns), unique=unique)
+    return MaterializedView(table, metadata)
+
+
+def process_history_stmt():
+    """Select the time ordered process ids, types and techniques of each sample."""
+    return (
+        select(
+            func.ARRAY_AGG(aggregate_order_by(Process.id, Process.timestamp, Process.ordering)).label(
+                'process_id'
+            ),
+            func.ARRAY_AGG(aggregate_order_by(ProcessDetail.type, Process.timestamp, Process.ordering)).label(
+                'process_type'
+            ),
+            func.ARRAY_AGG(
+                aggregate_order_by(ProcessDetail.technique, Process.timestamp, Process.ordering)
+            ).label('process_technique'),
+        )
+        .select_from(Sample)
+        .join(SampleProcess)
+        .join(Process)
+        .join(ProcessDetail)
+    )
+
+
+PROCESS_HISTORY = _define_view(
+    'sample_process_history',
+    process_history_stmt()
+    .add_columns(Sample.id.label('sample_id'), Sample.label.label('sample_label'))
+    .group_by(Sample.id),
+    indexes=[(['sample_id'], True), (['sample_label'], False)],
+)
+
+# Column of the sample_fom view holding each fom
+FOM_COLUMNS: Dict[Fom, str] = {fom: fom.name.lower() for fom in Fom}
+_NUMBER = '^[[:space:]]*[-+]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][-+]?[0-9]+)?[[:space:]]*$'
+
+
+def _fom_value(fom: Fom):
+    """Read a fom from the output of an analysis as a float, null if it is missing or not a number."""
+    value = Analysis.output[fom.value].as_string()
+    return sa.case((value.op('~')(_NUMBER), sa.cast(value, sa.Float)), else_=None).label(FOM_COLUMNS[fom])
+
+
+def fom_fact_stmt():
+    """
+    Select the foms of every analysis of each sample on each plate it belongs to.
+
+    Rows are unique by analysis, sample process and plate.
+    """
+    return (
+        select(
+            Sample.id.label('sample_id'),
+            Sample.label.label('sample_label'),
+            Collection.id.label('plate_id'),
+            Collection.label.label('plate_label'),
+            Collection.type.label('plate_type'),
+            SampleProcess.id.label('sample_process_id'),
+            Process.id.label('process_id'),
+            Process.timestamp.label('process_timestamp'),
+            ProcessDetail.id.label('process_detail_id'),
+            ProcessDetail.type.label('process_type'),
+            ProcessDetail.technique.label('process_technique'),
+            Analysis.id.label('analysis_id'),
+            Analysis.name.label('analysis_name'),
+            *(_fom_value(fom) for fom in Fom),
+        )
+        # An analysis of several files of the same sample process is listed once
+        .distinct()
+        .select_from(Analysis)
+        .join(ProcessDataAnalysis, ProcessDataAnalysis.analysis_id == Analysis.id)
+        .join(
+            SampleProcessProcessData,
+            SampleProcessProcessData.process_data_id == ProcessDataAnalysis.process_data_id,
+        )
+        .join(SampleProcess, SampleProcess.id == SampleProcessProcessData.sample_process_id)
+        .join(Sample, Sample.id == SampleProcess.sample_id)
+        .join(Process, Process.id == SampleProcess.process_id)
+        .join(ProcessDetail, ProcessDetail.id == Process.process_detail_id)
+        .join(CollectionSample, CollectionSample.sample_id == Sample.id)
+        .join(Collection, Collection.id == CollectionSample.collection_id)
+    )
+
+
+FOM_FACTS = _define_view(
+    'sample_fom',
+    fom_fact_stmt(),
+    indexes=[
+        (['analysis_id', 'sample_process_id', 'plate_id'], True),
+        (['plate_label', 'analysis_name'], False),
+        (['sample_id'], False),
+    ],
+)
+
+VIEWS: Dict[str, MaterializedView] = {view.name: view for view in [PROCESS_HISTORY, FOM_FACTS]}
+
+# Whether each view exists by database url, checked once per process
+_existing: Dict[Tuple[str, str], bool] = {}
+
+
+def has_view(view: MaterializedView) -> bool:
+    """Check whether a view has been created in the configured database, caching the answer."""
+    engine = get_engine()
+    key = (str(engine.url), view.qualified_name)
+    if key not in _existing:
+        try:
+            with engine.connect() as connection:
+                _existing[key] = view.exists(connection, populated=True)
+        except sa.exc.DBAPIError as exc:
+            logger.warning(f'Could not check for view {view.qualified_name}: {exc!r}')
+            return False
+    return _existing[key]
+
+
+async def ahas_view(view: MaterializedView) -> bool:
+    """Check whether a view has been created like has_view, using the async engine of the running loop."""
+    engine = get_async_engine()
+    # Keyed by the url of the sync driver so both checks and refresh_views share the answer
+    key = (str(engine.url.set(drivername=engine.url.get_backend_name())), view.qualified_name)
+    if key not in _existing:
+        try:
+            async with engine.connect() as connection:
+                _existing[key] = await connection.run_sync(view.exists, populated=True)
+        # asyncpg raises connection failures as OSError rather than through the dbapi exceptions
+        except (sa.exc.DBAPIError, OSError) as exc:
+            logger.warning(f'Could not check for view {view.qualified_name}: {exc!r}')
+            return False
+    return _existing[key]
+
+
+def refresh_views(names: Optional[Sequence[str]] = None, concurrently: bool = True) -> List[Tuple[str, str]]:
+    """
+    Create missing views and refresh the others.
+
+    Args:
+        names (Optional[Sequence[str]]): The views to refresh, by default all of them
+        concurrently (bool): Refresh without blocking reads of the views
+
+    Returns:
+        List[Tuple[str, str]]: The name of each view and whether it was created or refreshed
+    """
+    unknown = set(names or []) - set(VIEWS)
+    if unknown:
+        raise ValueError(f'Unknown views {sorted(unknown)}, views are {sorted(VIEWS)}')
+    engine = get_engine()
+    actions = []
+    for name in names or list(VIEWS):
+        view = VIEWS[name]
+        with engine.begin() as connection:
+            if view.exists(connection):
+                logger.info(f'Refreshing view {view.qualified_name}')
+                # A view that has never been populated can only be refreshed in full
+                view.refresh(connection, concurrently and view.exists(connection, populated=True))
+                actions.append((name, 'refreshed'))
+            else:
+                logger.info(f'Creating view {view.qualified_name}')
+                view.create(connection)
+                actions.append((name, 'created'))
+        _existing[(str(engine.url), view.qualified_name)] = True
+    return actions
@@ -12,9 +12,13 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import asyncio
 import logging
+import threading
 import urllib
-from typing import Optional, Union, cast
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncIterator, Dict, Optional, Tuple, Union, cast
+from weakref import WeakKeyDictionary
 
 from pydantic import BaseModel, Field
 from pydantic.networks import PostgresDsn
@@ -23,10 +27,24 @@ from pydantic.types import SecretStr
 from sqlalchemy import create_engine
 from sqlalchemy.exc import OperationalError
 
+from mps_client.configuration import settings
 from mps_client.utils.type_coercion import json_dumps
 
+if TYPE_CHECKING:
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.ext.asyncio import AsyncEngine
+
 logger = logging.getLogger(__name__)
 
+# Engines shared by every Connection with the same dsn and schema
+_engines: Dict[Tuple[str, str, bool], 'Engine'] = {}
+_engines_lock = threading.Lock()
+# asyncpg connections belong to the event loop that opened them so async engines are kept per loop,
+# engines of loops that have since closed are discarded when the next async engine is requested
+_async_engines: 'WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str, bool], AsyncEngine]]' = (
+    WeakKeyDictionary()
+)
+
 
 class Connection(BaseModel):
     scheme: str = "postgresql"
@@ -74,15 +92,73 @@ class Connection(BaseModel):
         )
 
     def get_engine(self, echo: bool = False):
+        """Create a new engine with a connection pool sized by the POSTGRES_POOL settings."""
         return create_engine(
             url=self.url(mask_password=False),
             connect_args={"options": f"-csearch_path={self.schema_}"},
             json_serializer=json_dumps,
             echo=echo,
+            pool_size=settings.POSTGRES_POOL_SIZE,
+            max_overflow=settings.POSTGRES_MAX_OVERFLOW,
+            pool_pre_ping=settings.POSTGRES_POOL_PRE_PING,
+            pool_recycle=settings.POSTGRES_POOL_RECYCLE,
         )
 
+    def get_shared_engine(self, echo: bool = False) -> 'Engine':
+        """
+        Get the engine shared by every connection to the same database and schema.
+
+        The engine is created on first use and kept for the life of the process so its pooled
+        connections are reused across calls.
+        """
+        key = (self.url(mask_password=False), self.schema_, echo)
+        with _engines_lock:
+            engine = _engines.get(key)
+            if engine is None:
+                logger.debug(f"Creating engine for {self.url(with_schema=True)}")
+                engine = _engines[key] = self.get_engine(echo)
+        return engine
+
+    def get_async_engine(self, echo: bool = False) -> 'AsyncEngine':
+        """Create a new asyncio engine using the asyncpg driver."""
+        from sqlalchemy.ext.asyncio import create_async_engine
+
+        try:
+            return create_async_engine(
+                self.copy(update={'scheme': 'postgresql+asyncpg'}).url(mask_password=False),
+                connect_args={"server_settings": {"search_path": self.schema_}},
+                json_serializer=json_dumps,
+                echo=echo,
+                pool_size=settings.POSTGRES_POOL_SIZE,
+                max_overflow=settings.POSTGRES_MAX_OVERFLOW,
+                pool_pre_ping=settings.POSTGRES_POOL_PRE_PING,
+                pool_recycle=settings.POSTGRES_POOL_RECYCLE,
+            )
+        except ImportError as exc:
+            raise ImportError(
+                'Async queries need asyncpg, install it with pip install mps-client[async]'
+            ) from exc
+
+    def get_shared_async_engine(self, echo: bool = False) -> 'AsyncEngine':
+        """
+        Get the asyncio engine shared by every connection to the same database and schema in the running loop.
+
+        Wrap the body of the loop in async_engines() to close the pooled connections before the loop
+        closes, engines left behind by closed loops are discarded without closing their connections.
+        """
+        loop = asyncio.get_running_loop()
+        key = (self.url(mask_password=False), self.schema_, echo)
+        with _engines_lock:
+            _discard_closed_loops()
+            engines = _async_engines.setdefault(loop, {})
+            engine = engines.get(key)
+            if engine is None:
+                logger.debug(f"Creating async engine for {self.url(with_schema=True)}")
+                engine = engines[key] = self.get_async_engine(echo)
+        return engine
+
     def test(self):
-        engine = self.get_engine()
+        engine = self.get_shared_engine()
         try:
             with engine.connect() as conn:
                 conn.execute("select 1")
@@ -90,3 +166,45 @@ class Connection(BaseModel):
             logger.error(f"Trouble connecting to database at {self}.\n{exc}")
             return False
         return True
+
+
+def dispose_engines() -> None:
+    """Close the pooled connections of every shared engine, e.g. after forking a worker."""
+    with _engines_lock:
+        engines = list(_engines.values())
+        _engines.clear()
+    for engine in engines:
+        engine.dispose()
+
+
+async def dispose_async_engines() -> None:
+    """Close the pooled connections of every shared async engine of the running loop."""
+    with _engines_lock:
+        engines = _async_engines.pop(asyncio.get_running_loop(), {})
+    for engine in engines.values():
+        await engine.dispose()
+
+
+@asynccontextmanager
+async def async_engines() -> AsyncIterator[None]:
+    """
+    Dispose the shared async engines of the running loop on exit.
+
+    Example:
+        >>> async def main():
+        ...     async with async_engines():
+        ...         return await aqueries.get_sample(1)
+        >>> asyncio.run(main())
+    """
+    try:
+        yield
+    finally:
+        await dispose_async_engines()
+
+
+def _discard_closed_loops() -> None:
+    """Drop the async engines of closed loops, their connections can no longer be closed cleanly."""
+    closed = [loop for loop in _async_engines if loop.is_closed()]
+    for loop in closed:
+        for engine in _async_engines.pop(loop).values():
+            engine.sync_engine.dispose(close=False)
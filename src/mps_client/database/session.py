@@ -19,6 +19,7 @@ from mps_client.configuration import settings
 from mps_client.database.connection import Connection
 
 if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncEngine
     from sqlalchemy.future import Engine
 
 logger = logging.getLogger(__name__)
@@ -34,5 +35,12 @@ def get_connection() -> Connection:
 
 
 def get_engine(echo: bool = False) -> 'Engine':
+    """Get the shared engine for the configured database, creating it on first use."""
     connection = get_connection()
-    return connection.get_engine(echo)
+    return connection.get_shared_engine(echo)
+
+
+def get_async_engine(echo: bool = False) -> 'AsyncEngine':
+    """Get the shared asyncio engine for the configured database in the running event loop."""
+    connection = get_connection()
+    return connection.get_shared_async_engine(echo)
@@ -0,0 +1,194 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Persistent on disk cache with expiry and size bounded LRU eviction."""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from stat import S_ISREG
+from typing import Any, List, Optional
+
+from mps_client.configuration import settings
+
+logger = logging.getLogger(__name__)
+
+# File at the root of the cache whose mtime records the last prune_if_due
+_PRUNE_MARKER = '.last_prune'
+
+
+@dataclass
+class CacheEntry:
+    namespace: str
+    path: Path
+    size: int
+    created: float
+    accessed: float
+
+
+class DiskCache:
+    """
+    A directory of cached files grouped into namespaces.
+
+    Each entry is a single file named by the hash of its key. The file's mtime records when
+    the entry was written and its atime when it was last read, atime is set explicitly on each
+    hit so least recently used eviction does not depend on how the filesystem is mounted.
+
+    Args:
+        root (Path): Directory to store the cache in
+        ttl (Optional[float]): Seconds after which entries expire, None to never expire
+        max_size (Optional[int]): Total bytes to keep when pruning, None for no limit
+    """
+
+    def __init__(self, root: Path, ttl: Optional[float] = None, max_size: Optional[int] = None) -> None:
+        self.root = Path(root)
+        self.ttl = ttl
+        self.max_size = max_size
+
+    def __repr__(self) -> str:
+        return f'DiskCache(root={str(self.root)!r}, ttl={self.ttl}, max_size={self.max_size})'
+
+    def path(self, namespace: str, key: str, suffix: str = '') -> Path:
+        """Get the location of an entry whether or not it exists."""
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self.root / namespace / f'{digest}{suffix}'
+
+    def get(self, namespace: str, key: str, suffix: str = '', ttl: Optional[float] = None) -> Optional[Path]:
+        """
+        Get the path to a live entry marking it as recently used, or None on a miss.
+
+        ttl overrides the ttl of the cache for this entry.
+        """
+        path = self.path(namespace, key, suffix)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        if self._expired(stat.st_mtime, ttl):
+            logger.debug(f'Cache entry {path} for {key!r} has expired')
+            path.unlink(missing_ok=True)
+            return None
+        os.utime(path, (time.time(), stat.st_mtime))
+        return path
+
+    def get_json(self, namespace: str, key: str, ttl: Optional[float] = None) -> Optional[Any]:
+        path = self.get(namespace, key, '.json', ttl)
+        if path is None:
+            return None
+        try:
+            return json.loads(path.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def set_bytes(self, namespace: str, key: str, data: bytes, suffix: str = '') -> Path:
+        """Atomically write an entry so concurrent readers never see a partial file."""
+        path = self.path(namespace, key, suffix)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+        return path
+
+    def set_json(self, namespace: str, key: str, value: Any) -> Path:
+        return self.set_bytes(namespace, key, json.dumps(value).encode(), '.json')
+
+    def entries(self) -> List[CacheEntry]:
+        """List all entries in the cache including partially downloaded files."""
+        entries = []
+        if not self.root.exists():
+            return entries
+        for namespace_dir in self.root.iterdir():
+            # Hidden folders hold work in progress such as archives being extracted
+            if not namespace_dir.is_dir() or namespace_dir.name.startswith('.'):
+                continue
+            for path in namespace_dir.iterdir():
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                if not S_ISREG(stat.st_mode):
+                    continue
+                # Files still being written count as accessed at their last write
+                accessed = max(stat.st_atime, stat.st_mtime)
+                entries.append(CacheEntry(namespace_dir.name, path, stat.st_size, stat.st_mtime, accessed))
+        return entries
+
+    def prune(
+        self, ttl: Optional[float] = None, max_size: Optional[int] = None, namespace: Optional[str] = None
+    ) -> List[CacheEntry]:
+        """
+        Remove expired entries then evict least recently used entries until under max_size.
+
+        ttl and max_size default to those of the cache.
+
+        Returns:
+            List[CacheEntry]: The entries that were removed
+        """
+        ttl = self.ttl if ttl is None else ttl
+        max_size = self.max_size if max_size is None else max_size
+        entries = [entry for entry in self.entries() if namespace in (None, entry.namespace)]
+        now = time.time()
+        removed = [entry for entry in entries if ttl is not None and now - entry.created > ttl]
+        remaining = sorted((entry for entry in entries if entry not in removed), key=lambda x: x.accessed)
+        total = sum(entry.size for entry in remaining)
+        while max_size is not None and remaining and total > max_size:
+            entry = remaining.pop(0)
+            total -= entry.size
+            removed.append(entry)
+        for entry in removed:
+            entry.path.unlink(missing_ok=True)
+        if removed:
+            logger.debug(f'Removed {len(removed)} entries from cache at {self.root}')
+        return removed
+
+    def prune_if_due(self, interval: float) -> List[CacheEntry]:
+        """
+        Prune the cache unless it was pruned less than interval seconds ago.
+
+        Listing every entry is slow for a large cache so callers that prune after each write use this
+        rather than prune. The time of the last prune is kept in a file at the root of the cache.
+
+        Returns:
+            List[CacheEntry]: The entries that were removed, empty if pruning was not due
+        """
+        marker = self.root / _PRUNE_MARKER
+        try:
+            if time.time() - marker.stat().st_mtime < interval:
+                return []
+        except FileNotFoundError:
+            pass
+        self.root.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+        return self.prune()
+
+    def clear(self, namespace: Optional[str] = None) -> List[CacheEntry]:
+        removed = [entry for entry in self.entries() if namespace in (None, entry.namespace)]
+        for entry in removed:
+            entry.path.unlink(missing_ok=True)
+        return removed
+
+    def _expired(self, created: float, ttl: Optional[float] = None) -> bool:
+        ttl = self.ttl if ttl is None else ttl
+        return ttl is not None and time.time() - created > ttl
+
+
+def get_cache() -> Optional[DiskCache]:
+    """Get the cache configured in the settings, None if caching is disabled."""
+    if not settings.CACHE_ENABLED:
+        return None
+    return DiskCache(settings.CACHE_DIR, ttl=settings.CACHE_TTL, max_size=settings.CACHE_MAX_SIZE)
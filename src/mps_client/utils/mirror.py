@@ -0,0 +1,147 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Serve doi.org and Caltech Data requests from a local mirror.
+
+A mirror holds each remote url at <mirror>/<host>/<path>, ignoring any query string, e.g.
+the record json of https://data.caltech.edu/records/abc/export/json is read from
+<mirror>/data.caltech.edu/records/abc/export/json. A file at <mirror>/doi.org/<doi> holds the
+url the doi redirects to. The mirror is either a local directory or the url of an http
+server serving such a directory, e.g. python -m http.server.
+"""
+
+import logging
+import re
+from pathlib import Path
+from typing import AsyncIterator, Optional, Tuple
+
+import aiofiles
+import httpx
+
+from mps_client.configuration import settings
+
+logger = logging.getLogger(__name__)
+
+DOI_HOST = 'doi.org'
+_CHUNK_SIZE = 1024 * 1024
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def mirror_path(root: Path, url: httpx.URL) -> Optional[Path]:
+    """Get the location of a url in a mirror directory, None if it would be outside of the mirror."""
+    path = (root / url.host / url.path.lstrip('/')).resolve()
+    root = root.resolve()
+    if path != root and root not in path.parents:
+        return None
+    return path
+
+
+class _FileStream(httpx.AsyncByteStream):
+    def __init__(self, path: Path, start: int, end: int) -> None:
+        self.path = path
+        self.start = start
+        self.end = end
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async with aiofiles.open(self.path, 'rb') as f:
+            await f.seek(self.start)
+            remaining = self.end - self.start
+            while remaining > 0:
+                chunk = await f.read(min(_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+class DirectoryMirrorTransport(httpx.AsyncBaseTransport):
+    """Answer requests from a mirror directory, supporting HEAD and single byte range requests."""
+
+    def __init__(self, root: Path) -> None:
+        self.root = Path(root)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        path = mirror_path(self.root, request.url)
+        if path is not None and path.is_dir():
+            path = path / 'index.html'
+        if path is None or not path.is_file():
+            logger.debug(f'{request.url} is not in the mirror at {self.root}')
+            return httpx.Response(404, request=request)
+        if request.url.host == DOI_HOST:
+            return httpx.Response(302, headers={'Location': path.read_text().strip()}, request=request)
+
+        size = path.stat().st_size
+        headers = {'Accept-Ranges': 'bytes'}
+        byte_range = _parse_range(request.headers.get('Range'), size)
+        if byte_range is None:
+            status, start, end = 200, 0, size
+        elif byte_range[0] >= size or byte_range[0] >= byte_range[1]:
+            headers['Content-Range'] = f'bytes */{size}'
+            return httpx.Response(416, headers=headers, request=request)
+        else:
+            status, (start, end) = 206, byte_range
+            headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        headers['Content-Length'] = str(end - start)
+        if request.method == 'HEAD':
+            return httpx.Response(status, headers=headers, request=request)
+        return httpx.Response(status, headers=headers, stream=_FileStream(path, start, end), request=request)
+
+
+class HttpMirrorTransport(httpx.AsyncBaseTransport):
+    """Forward requests to an http server serving a mirror directory."""
+
+    def __init__(self, base_url: str, limits: Optional[httpx.Limits] = None) -> None:
+        self.base_url = httpx.URL(base_url.rstrip('/') + '/')
+        self.transport = httpx.AsyncHTTPTransport(limits=limits or httpx.Limits())
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        url = self.base_url.join(f'{request.url.host}/{request.url.path.lstrip("/")}')
+        is_doi = request.url.host == DOI_HOST
+        # Static servers answer with the contents of the doi file rather than a redirect
+        method = 'GET' if is_doi else request.method
+        headers = {'Range': request.headers['Range']} if 'Range' in request.headers else None
+        response = await self.transport.handle_async_request(httpx.Request(method, url, headers=headers))
+        if not is_doi or response.status_code != 200:
+            return httpx.Response(
+                response.status_code, headers=response.headers, stream=response.stream, request=request
+            )
+        body = b''.join([chunk async for chunk in response.stream])
+        await response.aclose()
+        return httpx.Response(302, headers={'Location': body.decode().strip()}, request=request)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def _parse_range(value: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single byte range header into the start and exclusive end, None to send everything."""
+    match = _RANGE.match(value or '')
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        return max(0, size - int(last)), size
+    end = min(size, int(last) + 1) if last else size
+    return int(first), end
+
+
+def get_mirror_transport(limits: Optional[httpx.Limits] = None) -> Optional[httpx.AsyncBaseTransport]:
+    """Get a transport serving requests from the DOI_MIRROR setting, None if it is not set."""
+    mirror = settings.DOI_MIRROR
+    if not mirror:
+        return None
+    if re.match(r'^https?://', mirror):
+        return HttpMirrorTransport(mirror, limits)
+    return DirectoryMirrorTransport(Path(mirror).expanduser())
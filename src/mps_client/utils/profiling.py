@@ -0,0 +1,122 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Timing and byte counts for the stages of a pipeline."""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+
+@dataclass
+class StageStats:
+    count: int = 0
+    seconds: float = 0.0
+    bytes: int = 0
+
+    @property
+    def mb_per_s(self) -> Optional[float]:
+        if not self.bytes or not self.seconds:
+            return None
+        return self.bytes / 1e6 / self.seconds
+
+    def add(self, other: 'StageStats') -> None:
+        self.count += other.count
+        self.seconds += other.seconds
+        self.bytes += other.bytes
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'count': self.count, 'seconds': self.seconds, 'bytes': self.bytes, 'mb_per_s': self.mb_per_s}
+
+
+class StageReport:
+    """The time spent and bytes moved in each stage of a single run."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.stages: Dict[str, StageStats] = {}
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+
+    @property
+    def seconds(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageStats]:
+        """Time a stage, bytes can be added to the yielded stats."""
+        stats = StageStats(count=1)
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.seconds = time.perf_counter() - start
+            self.stages.setdefault(name, StageStats()).add(stats)
+
+    def add(self, name: str, seconds: float, bytes: int = 0) -> None:
+        """Record a stage timed elsewhere."""
+        self.stages.setdefault(name, StageStats()).add(StageStats(1, seconds, bytes))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'seconds': self.seconds,
+            'stages': {name: stats.to_dict() for name, stats in self.stages.items()},
+        }
+
+
+_current_report: ContextVar[Optional[StageReport]] = ContextVar('current_report', default=None)
+
+
+@contextmanager
+def collect_report(name: str) -> Iterator[StageReport]:
+    """Record the stages run in the current context, including tasks started from it."""
+    report = StageReport(name)
+    try:
+        with use_report(report):
+            yield report
+    finally:
+        report.finished = time.perf_counter()
+
+
+@contextmanager
+def use_report(report: StageReport) -> Iterator[StageReport]:
+    """Record the stages run in the current context into an existing report."""
+    token = _current_report.set(report)
+    try:
+        yield report
+    finally:
+        _current_report.reset(token)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[StageStats]:
+    """Time a stage in the report being collected, if any."""
+    report = _current_report.get()
+    if report is None:
+        yield StageStats()
+        return
+    with report.stage(name) as stats:
+        yield stats
+
+
+def summarize(reports: Iterable[StageReport]) -> Dict[str, StageStats]:
+    """Sum the stages of many reports."""
+    totals: Dict[str, StageStats] = {}
+    for report in reports:
+        for name, stats in report.stages.items():
+            totals.setdefault(name, StageStats()).add(stats)
+    return totals
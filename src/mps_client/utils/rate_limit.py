@@ -0,0 +1,136 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Adaptive token bucket rate limiting for http requests."""
+
+import asyncio
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+from mps_client.configuration import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    A token bucket shared by every request sent to a host.
+
+    Each request takes a token before it is sent, tokens refill at the current rate up to burst.
+    When the server responds with 429 the rate is halved and all requests are held back until
+    the Retry-After time, or an exponential backoff with jitter when no Retry-After is given.
+    Each successful response then raises the rate back towards max_rate.
+
+    The bookkeeping never awaits while holding its lock so one limiter can be shared by
+    every event loop and thread in the process.
+
+    Args:
+        max_rate (float): The highest number of requests per second to send
+        burst (int): The number of requests that can be sent at once after being idle
+        min_rate (float): The lowest rate the limiter will back off to
+        max_backoff (float): The longest time in seconds to back off after a 429 response
+    """
+
+    def __init__(
+        self, max_rate: float, burst: int = 1, min_rate: float = 0.1, max_backoff: float = 60.0
+    ) -> None:
+        if max_rate <= 0 or burst < 1:
+            raise ValueError(f'max_rate must be positive and burst at least 1, got {max_rate} and {burst}')
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.burst = burst
+        self.max_backoff = max_backoff
+        self.rate = max_rate
+        self.failures = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token and get the number of seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._blocked_until - now)
+
+    async def acquire(self) -> None:
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def on_rate_limited(self, retry_after: Optional[float] = None) -> float:
+        """
+        Back off after a 429 response.
+
+        Returns:
+            float: The number of seconds requests are held back for
+        """
+        with self._lock:
+            self.failures += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after is None:
+                backoff = min(self.max_backoff, 2 ** (self.failures - 1))
+                retry_after = backoff / 2 + random.uniform(0, backoff / 2)
+            # Drop tokens saved up before the 429 so the retry does not arrive as a burst
+            self._tokens = min(self._tokens, 0.0)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            logger.debug(f'Rate limited, backing off for {retry_after:.2f}s at {self.rate:.2f} requests/s')
+            return retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header given in seconds or as an http date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(host: str) -> RateLimiter:
+    """Get the process wide rate limiter for a host, creating it from the settings if needed."""
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = RateLimiter(
+                settings.RATE_LIMIT_MAX_RATE,
+                burst=settings.RATE_LIMIT_BURST,
+                max_backoff=settings.RATE_LIMIT_MAX_BACKOFF,
+            )
+        return _limiters[host]
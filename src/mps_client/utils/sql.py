@@ -17,6 +17,8 @@ from typing import List, Optional
 import sqlalchemy as sa
 from sqlalchemy.ext import compiler
 from sqlalchemy.schema import DDLElement, PrimaryKeyConstraint
+from sqlalchemy.sql.base import Executable
+from sqlalchemy.sql.elements import ClauseElement
 
 
 class CreateMaterializedView(DDLElement):
@@ -63,5 +65,21 @@ def create_mat_view(
         for idx in t.indexes:
             idx.create(connection)
 
-    sa.event.listen(metadata, "before_drop", sa.DDL(f"DROP VIEW IF EXISTS {schema}.{name}"))
+    sa.event.listen(metadata, "before_drop", sa.DDL(f"DROP MATERIALIZED VIEW IF EXISTS {schema}.{name}"))
     return t
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN a statement, returning its plan as json and running it as well if analyze is set."""
+
+    inherit_cache = False
+
+    def __init__(self, statement, analyze: bool = False):
+        self.statement = statement
+        self.analyze = analyze
+
+
+@compiler.compiles(Explain, "postgresql")
+def compile_explain(element, compiler, **kw):
+    options = "ANALYZE, FORMAT JSON" if element.analyze else "FORMAT JSON"
+    return f"EXPLAIN ({options}) {compiler.process(element.statement, **kw)}"
@@ -0,0 +1,104 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Content addressed storage of extracted files in the download cache."""
+
+import hashlib
+import logging
+import os
+import shutil
+from functools import partial
+from pathlib import Path
+from typing import Dict, Optional
+
+from mps_client.configuration import settings
+from mps_client.utils.cache import DiskCache, get_cache
+
+logger = logging.getLogger(__name__)
+
+OBJECT_NAMESPACE = 'object'
+TREE_NAMESPACE = 'tree'
+_CHUNK_SIZE = 1024 * 1024
+
+
+class ContentStore:
+    """
+    Extracted files kept once in the cache by the sha256 of their contents.
+
+    A tree maps the relative paths of the files extracted from an archive to the digests of
+    their contents. Linking a tree into a folder hardlinks each file to its stored object so
+    every copy of an archive extracted on the same filesystem shares the same disk space,
+    falling back to copying across filesystems. Hardlinked files share their contents, editing
+    one in place edits all of them.
+
+    Objects and trees are ordinary cache entries and expire and are evicted like the others,
+    a tree missing any of its objects is treated as a miss.
+    """
+
+    def __init__(self, cache: DiskCache) -> None:
+        self.cache = cache
+
+    def get_tree(self, key: str) -> Optional[Dict[str, str]]:
+        tree = self.cache.get_json(TREE_NAMESPACE, key)
+        if tree is None:
+            return None
+        if any(self.cache.get(OBJECT_NAMESPACE, digest) is None for digest in tree.values()):
+            logger.debug(f'Objects of tree {key!r} have been evicted')
+            return None
+        return tree
+
+    def set_tree(self, key: str, tree: Dict[str, str]) -> None:
+        self.cache.set_json(TREE_NAMESPACE, key, tree)
+
+    def add_tree(self, root: Path) -> Dict[str, str]:
+        """Move every file under root into the store, returning their digests by relative path."""
+        return {
+            path.relative_to(root).as_posix(): self.add(path)
+            for path in sorted(root.rglob('*'))
+            if path.is_file() and not path.is_symlink()
+        }
+
+    def add(self, path: Path) -> str:
+        """Move a file into the store, it must be on the same filesystem as the cache."""
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(partial(f.read, _CHUNK_SIZE), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        target = self.cache.path(OBJECT_NAMESPACE, digest)
+        if target.exists():
+            path.unlink()
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path, target)
+        return digest
+
+    def link_tree(self, tree: Dict[str, str], dest: Path) -> None:
+        for name, digest in tree.items():
+            target = dest / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.unlink(missing_ok=True)
+            source = self.cache.path(OBJECT_NAMESPACE, digest)
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copyfile(source, target)
+
+
+def get_store() -> Optional[ContentStore]:
+    """Get the store in the configured cache, None unless both caching and CACHE_LINK_FILES are enabled."""
+    cache = get_cache()
+    if cache is None or not settings.CACHE_LINK_FILES:
+        return None
+    return ContentStore(cache)
@@ -20,6 +20,7 @@ from sqlmodel import Session, create_engine
 
 from mps_client.configuration import settings
 from mps_client.schema.base import sa_registry
+from mps_client.utils import rate_limit
 
 
 @pytest.fixture(scope="session", autouse=True)
@@ -32,6 +33,22 @@ def database_engine():
         engine.dispose()
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keep the local cache of each test isolated from the user's cache."""
+    path = tmp_path / 'cache'
+    monkeypatch.setattr(settings, 'CACHE_DIR', path)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def rate_limiters(monkeypatch):
+    """Start each test with fresh process wide rate limiters."""
+    limiters: dict = {}
+    monkeypatch.setattr(rate_limit, '_limiters', limiters)
+    return limiters
+
+
 @pytest.fixture(scope='session')
 def build_database_session(database_engine):
     metadata = MetaData(database_engine)
@@ -0,0 +1,127 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import asyncio
+from uuid import uuid4
+
+import pytest
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import make_url
+
+from mps_client._enums import EntityType
+from mps_client.core import aqueries, views
+
+
+class FakeAsyncSession:
+    """Records the statements executed and answers them with canned rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.statements = []
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def exec(self, stmt):
+        self.statements.append(stmt)
+        return self
+
+    async def stream(self, stmt, execution_options=None):
+        self.statements.append(stmt)
+        self.execution_options = execution_options
+        return self
+
+    def one_or_none(self):
+        return self.rows[0] if self.rows else None
+
+    async def partitions(self, size):
+        for start in range(0, len(self.rows), size):
+            yield self.rows[start : start + size]
+
+
+@pytest.fixture
+def fake_session(monkeypatch):
+    session = FakeAsyncSession([])
+    monkeypatch.setattr(aqueries, 'AsyncSession', session)
+    monkeypatch.setattr(aqueries, 'get_async_engine', lambda: None)
+    monkeypatch.setattr(aqueries, 'ahas_view', _has_view(False))
+    return session
+
+
+def _has_view(exists):
+    async def ahas_view(view):
+        return exists
+
+    return ahas_view
+
+
+def test_concurrent_lookups(fake_session):
+    fake_session.rows = ['10.1/a']
+    run_id = uuid4()
+
+    async def lookups():
+        return await asyncio.gather(
+            aqueries.get_doi(EntityType.PLATE, entity_label='plate_1'),
+            aqueries.get_doi(EntityType.RUN, entity_id=run_id),
+            aqueries.get_process_history(sample_label='missing'),
+        )
+
+    assert asyncio.run(lookups()) == ['10.1/a', '10.1/a', '10.1/a']
+    compiled = [str(stmt.compile(dialect=postgresql.dialect())) for stmt in fake_session.statements]
+    assert 'collection.label = %(label_1)s' in compiled[0]
+    assert 'jcap_run.id = %(id_1)s' in compiled[1]
+    fake_session.rows = []
+    assert asyncio.run(aqueries.get_process_history(sample_label='missing')) == ([], [], [])
+
+
+def test_stream_raw_query_batches(fake_session):
+    fake_session.rows = [(i,) for i in range(3)]
+
+    async def collect():
+        return [batch async for batch in aqueries.stream_raw_query('select 1', fetch_size=2, batches=True)]
+
+    assert asyncio.run(collect()) == [[(0,), (1,)], [(2,)]]
+    assert fake_session.execution_options == {'yield_per': 2}
+
+
+def test_process_history_from_view(fake_session, monkeypatch):
+    monkeypatch.setattr(aqueries, 'ahas_view', _has_view(True))
+
+    asyncio.run(aqueries.get_process_history(sample_label='plate_1'))
+
+    compiled = str(fake_session.statements[0].compile(dialect=postgresql.dialect()))
+    assert 'FROM production.sample_process_history' in compiled
+    assert 'JOIN' not in compiled
+
+
+class FakeAsyncEngine:
+    url = make_url('postgresql+asyncpg://postgres@localhost:5432/mps')
+
+    def connect(self):
+        raise ConnectionRefusedError('Connect call failed')
+
+
+def test_ahas_view_shares_sync_cache(monkeypatch):
+    monkeypatch.setattr(views, '_existing', {})
+    monkeypatch.setattr(views, 'get_async_engine', FakeAsyncEngine)
+
+    assert asyncio.run(views.ahas_view(views.PROCESS_HISTORY)) is False
+    views._existing[('postgresql://postgres@localhost:5432/mps', views.PROCESS_HISTORY.qualified_name)] = True
+    assert asyncio.run(views.ahas_view(views.PROCESS_HISTORY)) is True
@@ -0,0 +1,65 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import time
+
+from mps_client.utils.cache import DiskCache
+
+
+def test_json_round_trip(tmp_path):
+    cache = DiskCache(tmp_path)
+    assert cache.get_json('record', 'https://example.com') is None
+    cache.set_json('record', 'https://example.com', {'a': 1})
+    assert cache.get_json('record', 'https://example.com') == {'a': 1}
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = DiskCache(tmp_path, ttl=60)
+    path = cache.set_bytes('archive', 'key', b'data')
+    assert cache.get('archive', 'key') == path
+    old = time.time() - 120
+    os.utime(path, (old, old))
+    assert cache.get('archive', 'key') is None
+    assert not path.exists()
+
+
+def test_prune_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(tmp_path, max_size=25)
+    now = time.time()
+    for i, key in enumerate(['a', 'b', 'c']):
+        path = cache.set_bytes('archive', key, b'x' * 10)
+        os.utime(path, (now - 100 + i, now - 100 + i))
+    # Reading a marks it as the most recently used entry
+    cache.get('archive', 'a')
+
+    removed = cache.prune()
+
+    assert [entry.path for entry in removed] == [cache.path('archive', 'b')]
+    assert sum(entry.size for entry in cache.entries()) == 20
+    assert cache.get('archive', 'a') is not None
+    assert cache.get('archive', 'c') is not None
+
+
+def test_prune_if_due(tmp_path):
+    cache = DiskCache(tmp_path, max_size=15)
+    cache.set_bytes('archive', 'a', b'x' * 10)
+    cache.set_bytes('archive', 'b', b'x' * 10)
+
+    assert len(cache.prune_if_due(60)) == 1
+    cache.set_bytes('archive', 'c', b'x' * 10)
+    # Pruned within the last minute so the cache is left over its size until the interval passes
+    assert cache.prune_if_due(60) == []
+    assert len(cache.entries()) == 2
+    assert len(cache.prune_if_due(0)) == 1
@@ -0,0 +1,657 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import asyncio
+import hashlib
+import io
+import os
+import re
+import threading
+import tracemalloc
+import zipfile
+from collections import namedtuple
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from mps_client._exceptions import (
+    ChecksumMismatch,
+    DeadUrlError,
+    DOINotFound,
+    RangeRequestsNotSupported,
+    RequestLimitation,
+)
+from mps_client.configuration import settings
+from mps_client.core import download, pipeline, remote_archive
+from mps_client.core.download import download_file, extract_archive, stream_to_file
+from mps_client.core.mirror import mirror_doi
+from mps_client.core.pipeline import download_pipeline
+from mps_client.core.remote_archive import RemoteZip, list_archive_members
+from mps_client.utils.rate_limit import RateLimiter
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """File handler supporting single open ended byte ranges and simulated dropped connections."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.range_headers.append(self.headers.get('Range'))
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range') or '')
+        if match and server.support_ranges:
+            first, last = match.groups()
+            if not first:
+                start = max(0, size - int(last))
+            else:
+                start = int(first)
+                end = min(size, int(last) + 1) if last else size
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start))
+        self.end_headers()
+        server.bytes_sent += end - start
+        with open(path, 'rb') as f:
+            f.seek(start)
+            if server.drop_after is not None:
+                # Send part of the body then drop the connection once
+                self.wfile.write(f.read(server.drop_after))
+                server.drop_after = None
+                self.close_connection = True
+                return
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(remaining, 64 * 1024))
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+
+@pytest.fixture
+def file_server(tmp_path):
+    """Serve the files in a temporary directory over http on localhost."""
+    root = tmp_path / 'served'
+    root.mkdir()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeHandler, directory=str(root)))
+    server.range_headers = []
+    server.support_ranges = True
+    server.drop_after = None
+    server.bytes_sent = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield root, f'http://127.0.0.1:{server.server_address[1]}', server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def make_zip(path, members):
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as z:
+        for name, contents in members.items():
+            z.writestr(name, contents)
+    return path
+
+
+def test_stream_to_file_bounded_memory(file_server, tmp_path):
+    root, url, _ = file_server
+    payload = os.urandom(16 * 1024 * 1024)
+    make_zip(root / 'big.zip', {'run/data.bin': payload})
+
+    async def download():
+        async with httpx.AsyncClient() as client:
+            return await stream_to_file(client, f'{url}/big.zip', tmp_path / 'big.zip', chunk_size=64 * 1024)
+
+    tracemalloc.start()
+    try:
+        written = asyncio.run(download())
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert written == (root / 'big.zip').stat().st_size
+    assert peak < len(payload) / 4
+    extract_archive(tmp_path / 'big.zip', tmp_path / 'out')
+    assert (tmp_path / 'out' / 'run' / 'data.bin').read_bytes() == payload
+
+
+class FakeCaltech:
+    """An in memory stand in for doi.org and data.caltech.edu."""
+
+    def __init__(self) -> None:
+        self.archives: dict = {}
+        self.checksums: dict = {}
+        self.requests: list = []
+        self.clients = 0
+        # Number of upcoming record json requests to answer with 429
+        self.rate_limited = 0
+        # Dois redirected somewhere other than their record
+        self.redirects: dict = {}
+
+    def add_record(self, doi: str, members: dict) -> str:
+        record_id = doi.replace('/', '-')
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as z:
+            for name, contents in members.items():
+                z.writestr(name, contents)
+        self.archives[record_id] = buffer.getvalue()
+        self.checksums[record_id] = 'md5:' + hashlib.md5(buffer.getvalue()).hexdigest()
+        return record_id
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        url = request.url
+        if url.host == 'doi.org' and url.path.lstrip('/') in self.redirects:
+            return httpx.Response(302, headers={'Location': self.redirects[url.path.lstrip('/')]})
+        if url.host == 'doi.org':
+            record_id = url.path.lstrip('/').replace('/', '-')
+            if record_id not in self.archives:
+                return httpx.Response(404, html='<html><title>DOI Not Found</title></html>')
+            location = f'https://data.caltech.edu/records/{record_id}'
+            return httpx.Response(302, headers={'Location': location}, html=f'<a href="{location}">x</a>')
+        parts = url.path.strip('/').split('/')
+        if parts[0] == 'records' and parts[2:] in ([], ['landing']):
+            return httpx.Response(200, html='<html><title>Record</title></html>')
+        if parts[0] == 'records' and parts[2:] == ['export', 'json']:
+            if self.rate_limited > 0:
+                self.rate_limited -= 1
+                return httpx.Response(429, headers={'Retry-After': '0'})
+            link = f'https://data.caltech.edu/files/{parts[1]}.zip'
+            description = {'description': f'<a href="{link}">Download</a>'}
+            entry = {'checksum': self.checksums[parts[1]], 'size': len(self.archives[parts[1]])}
+            record = {
+                'metadata': {'additional_descriptions': [description]},
+                'files': {'entries': {f'{parts[1]}.zip': entry}},
+            }
+            return httpx.Response(200, json=record)
+        if parts[0] == 'files':
+            return httpx.Response(200, content=self.archives[parts[1][: -len('.zip')]])
+        return httpx.Response(404)
+
+
+@pytest.fixture
+def fake_caltech(monkeypatch):
+    """Route all clients created by the download module to a FakeCaltech."""
+    fake = FakeCaltech()
+    async_client = httpx.AsyncClient
+
+    def create_async_client(**kwargs):
+        fake.clients += 1
+        return async_client(transport=httpx.MockTransport(fake.handler), **kwargs)
+
+    monkeypatch.setattr(httpx, 'AsyncClient', create_async_client)
+    return fake
+
+
+def test_async_download_dois(fake_caltech, tmp_path):
+    fake_caltech.add_record('10.1/a', {'a.txt': 'a'})
+    fake_caltech.add_record('10.1/b', {'b.txt': 'b'})
+    downloads = [('10.1/a', tmp_path / 'a'), ('10.1/b', tmp_path / 'b'), ('10.1/missing', tmp_path / 'c')]
+
+    results = asyncio.run(download.async_download_dois(downloads, concurrency=2))
+
+    assert [result.ok for result in results] == [True, True, False]
+    assert fake_caltech.clients == 1
+    assert isinstance(results[2].error, DOINotFound)
+    assert (tmp_path / 'a' / 'a.txt').read_text() == 'a'
+    assert (tmp_path / 'b' / 'b.txt').read_text() == 'b'
+    assert not (tmp_path / 'a' / download.STAGING_DIR).exists()
+
+    stages = results[0].report.stages
+    assert {'queue', 'resolve', 'record_json', 'transfer', 'extract'} <= set(stages)
+    assert stages['transfer'].bytes == stages['extract'].bytes > 0
+    assert results[0].report.to_dict()['name'] == '10.1/a'
+
+
+def test_download_pipeline(fake_caltech, tmp_path):
+    for name in 'abcde':
+        fake_caltech.add_record(f'10.1/{name}', {f'{name}.txt': name})
+    read = []
+
+    def downloads():
+        for name in 'abxcde':
+            read.append(name)
+            yield f'10.1/{name}', tmp_path / name
+
+    results = asyncio.run(download_pipeline(downloads(), resolvers=2, concurrency=2, queue_size=1))
+
+    assert read == list('abxcde')
+    assert [result.doi for result in results] == [f'10.1/{name}' for name in 'abxcde']
+    assert [result.ok for result in results] == [True, True, False, True, True, True]
+    assert isinstance(results[2].error, DOINotFound)
+    for name in 'abcde':
+        assert (tmp_path / name / f'{name}.txt').read_text() == name
+    assert {'queue', 'resolve', 'transfer', 'extract'} <= set(results[0].report.stages)
+    assert results[0].report.finished is not None
+
+
+def test_download_pipeline_source_error(fake_caltech, tmp_path):
+    fake_caltech.add_record('10.1/a', {'a.txt': 'a'})
+
+    def downloads():
+        yield '10.1/a', tmp_path / 'a'
+        raise RuntimeError('cursor closed')
+
+    with pytest.raises(RuntimeError, match='cursor closed'):
+        asyncio.run(download_pipeline(downloads()))
+    # Dois read before the error are still downloaded
+    assert (tmp_path / 'a' / 'a.txt').read_text() == 'a'
+
+
+def test_download_pipeline_async_source(fake_caltech, tmp_path, monkeypatch):
+    fake_caltech.add_record('10.1/a', {'a.txt': 'a'})
+    Row = namedtuple('Row', ['label', 'run_doi'])
+
+    async def stream_raw_query(query):
+        for row in [Row('x', '10.1/a'), Row('y', None), Row('z', '10.1/a')]:
+            yield row
+
+    monkeypatch.setattr(pipeline.aqueries, 'stream_raw_query', stream_raw_query)
+
+    results = asyncio.run(download_pipeline(pipeline.aquery_downloads('select', tmp_path)))
+
+    assert [(result.doi, result.ok) for result in results] == [('10.1/a', True)]
+    assert (tmp_path / '10.1_a' / 'a.txt').read_text() == 'a'
+
+
+def _file_requests(fake: FakeCaltech) -> int:
+    return sum(request.url.path.startswith('/files') for request in fake.requests)
+
+
+def test_identical_dois_share_one_transfer(fake_caltech, tmp_path):
+    fake_caltech.add_record('10.1/a', {'a.txt': 'a'})
+    downloads = [('10.1/a', tmp_path / str(i)) for i in range(3)]
+
+    results = asyncio.run(download.async_download_dois(downloads, concurrency=3))
+
+    assert all(result.ok for result in results)
+    assert _file_requests(fake_caltech) == 1
+    assert all((tmp_path / str(i) / 'a.txt').read_text() == 'a' for i in range(3))
+
+
+def test_store_links_repeat_extractions(fake_caltech, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'CACHE_LINK_FILES', True)
+    fake_caltech.add_record('10.1/a', {'a.txt': 'a', 'sub/b.txt': 'b'})
+    downloads = [('10.1/a', tmp_path / str(i)) for i in range(3)]
+
+    results = asyncio.run(download.async_download_dois(downloads, concurrency=3))
+
+    assert all(result.ok for result in results)
+    assert sum('extract' in result.report.stages for result in results) == 1
+    inodes = {(tmp_path / str(i) / 'sub' / 'b.txt').stat().st_ino for i in range(3)}
+    assert len(inodes) == 1
+    assert (tmp_path / '2' / 'sub' / 'b.txt').read_text() == 'b'
+
+    # Later downloads link from the store without the archive
+    settings.CACHE_DIR.joinpath(download.ARCHIVE_NAMESPACE).rename(tmp_path / 'archives')
+    assert asyncio.run(download.async_download_doi('10.1/a', tmp_path / 'later'))
+    assert _file_requests(fake_caltech) == 1
+    assert (tmp_path / 'later' / 'a.txt').stat().st_ino == (tmp_path / '0' / 'a.txt').stat().st_ino
+
+
+def test_resolve_record_url_from_redirect(fake_caltech):
+    record_id = fake_caltech.add_record('10.1/a', {'a.txt': 'a'})
+    fake_caltech.redirects['10.1/dead'] = 'https://www.mpsjcap.org/records/1'
+
+    assert (
+        asyncio.run(download.resolve_record_url('10.1/a')) == f'https://data.caltech.edu/records/{record_id}'
+    )
+    assert [request.method for request in fake_caltech.requests] == ['HEAD']
+    with pytest.raises(DOINotFound):
+        asyncio.run(download.resolve_record_url('10.1/missing'))
+    with pytest.raises(DeadUrlError) as exc_info:
+        asyncio.run(download.resolve_record_url('10.1/dead'))
+    assert exc_info.value.dead_url == 'https://www.mpsjcap.org/records/1'
+
+
+def test_resolve_record_url_falls_back_to_landing_page(fake_caltech):
+    record_id = fake_caltech.add_record('10.1/a', {'a.txt': 'a'})
+    fake_caltech.redirects['10.1/other'] = f'https://data.caltech.edu/records/{record_id}/landing'
+
+    url = asyncio.run(download.resolve_record_url('10.1/other'))
+
+    assert url == f'https://data.caltech.edu/records/{record_id}/landing'
+    assert [request.method for request in fake_caltech.requests][-2:] == ['GET', 'GET']
+
+
+def test_failed_resolution_is_cached(fake_caltech):
+    fake_caltech.redirects['10.1/dead'] = 'https://www.mpsjcap.org/records/1'
+    for _ in range(2):
+        with pytest.raises(DOINotFound):
+            asyncio.run(download.get_zip_links_from_doi('10.1/missing'))
+        with pytest.raises(DeadUrlError) as exc_info:
+            asyncio.run(download.get_zip_links_from_doi('10.1/dead'))
+        assert exc_info.value.dead_url == 'https://www.mpsjcap.org/records/1'
+    assert len(fake_caltech.requests) == 2
+
+    with pytest.raises(DOINotFound):
+        asyncio.run(download.get_zip_links_from_doi('10.1/missing', use_cache=False))
+    assert len(fake_caltech.requests) == 3
+
+    # Expired failures are retried
+    for path in settings.CACHE_DIR.joinpath(download.FAILURE_NAMESPACE).iterdir():
+        os.utime(path, (0, 0))
+    fake_caltech.add_record('10.1/missing', {'a.txt': 'a'})
+    assert asyncio.run(download.get_zip_links_from_doi('10.1/missing'))
+
+
+def test_download_file_resumes_partial_download(file_server, tmp_path):
+    root, url, server = file_server
+    payload = os.urandom(256 * 1024)
+    (root / 'data.zip').write_bytes(payload)
+    dest = tmp_path / 'data.zip'
+    server.drop_after = 100 * 1024
+
+    async def fetch(**kwargs):
+        async with httpx.AsyncClient() as client:
+            return await download_file(client, f'{url}/data.zip', dest, chunk_size=1024, **kwargs)
+
+    # The first transfer is dropped and the partial file is kept for the next call
+    with pytest.raises(httpx.TransportError):
+        asyncio.run(fetch(max_attempts=1))
+    part = tmp_path / 'data.zip.part'
+    assert part.stat().st_size == 100 * 1024
+    assert not dest.exists()
+
+    assert asyncio.run(fetch()) == len(payload)
+    assert server.range_headers == [None, f'bytes={100 * 1024}-']
+    assert dest.read_bytes() == payload
+    assert not part.exists()
+
+
+def test_download_file_retries_within_call(file_server, tmp_path):
+    root, url, server = file_server
+    payload = os.urandom(64 * 1024)
+    (root / 'data.zip').write_bytes(payload)
+    server.drop_after = 1024
+
+    async def fetch():
+        async with httpx.AsyncClient() as client:
+            return await download_file(
+                client, f'{url}/data.zip', tmp_path / 'data.zip', chunk_size=256, max_attempts=2
+            )
+
+    asyncio.run(fetch())
+    assert server.range_headers == [None, 'bytes=1024-']
+    assert (tmp_path / 'data.zip').read_bytes() == payload
+
+
+def test_stream_to_file_restarts_without_range_support(file_server, tmp_path):
+    root, url, server = file_server
+    payload = os.urandom(10 * 1024)
+    (root / 'data.zip').write_bytes(payload)
+    server.support_ranges = False
+    dest = tmp_path / 'data.zip'
+    dest.write_bytes(b'stale partial content')
+
+    async def fetch():
+        async with httpx.AsyncClient() as client:
+            return await stream_to_file(client, f'{url}/data.zip', dest, resume=True)
+
+    assert asyncio.run(fetch()) == len(payload)
+    assert dest.read_bytes() == payload
+
+
+def test_repeated_download_uses_cache(fake_caltech, tmp_path):
+    fake_caltech.add_record('10.1/a', {'a.txt': 'a'})
+    asyncio.run(download.async_download_doi('10.1/a', tmp_path / 'first'))
+    assert len(fake_caltech.requests) == 3
+
+    asyncio.run(download.async_download_doi('10.1/a', tmp_path / 'second'))
+    assert len(fake_caltech.requests) == 3
+    assert (tmp_path / 'second' / 'a.txt').read_text() == 'a'
+
+    asyncio.run(download.async_download_doi('10.1/a', tmp_path / 'third', use_cache=False))
+    assert len(fake_caltech.requests) == 6
+
+
+def test_download_skipped_when_checksum_matches(fake_caltech, tmp_path):
+    fake_caltech.add_record('10.1/a', {'a.txt': 'a'})
+    assert asyncio.run(download.async_download_doi('10.1/a', tmp_path, use_cache=False))
+    assert len(fake_caltech.requests) == 3
+
+    # Only the record json is fetched to compare checksums
+    assert not asyncio.run(download.async_download_doi('10.1/a', tmp_path, use_cache=False))
+    assert len(fake_caltech.requests) == 5
+    assert not any(request.url.path.startswith('/files') for request in fake_caltech.requests[3:])
+
+    # Different filters or force extract again
+    assert asyncio.run(download.async_download_doi('10.1/a', tmp_path, use_cache=False, include=['*.txt']))
+    assert asyncio.run(
+        download.async_download_doi('10.1/a', tmp_path, use_cache=False, include=['*.txt'], force=True)
+    )
+    assert (tmp_path / 'a.txt').read_text() == 'a'
+
+
+def test_download_checksum_mismatch(fake_caltech, tmp_path):
+    record_id = fake_caltech.add_record('10.1/a', {'a.txt': 'a'})
+    fake_caltech.archives[record_id] = make_zip(tmp_path / 'other.zip', {'a.txt': 'b'}).read_bytes()
+
+    with pytest.raises(ChecksumMismatch) as exc_info:
+        asyncio.run(download.async_download_doi('10.1/a', tmp_path / 'out'))
+    assert exc_info.value.url == f'https://data.caltech.edu/files/{record_id}.zip'
+    assert exc_info.value.expected == fake_caltech.checksums[record_id]
+    assert exc_info.value.actual == 'md5:' + hashlib.md5(fake_caltech.archives[record_id]).hexdigest()
+    assert not (tmp_path / 'out' / 'a.txt').exists()
+    assert not list(settings.CACHE_DIR.glob(f'{download.ARCHIVE_NAMESPACE}/*'))
+
+
+def test_parse_checksums():
+    entries = [{'key': 'a.zip', 'checksum': 'MD5:ABC', 'size': 3}, {'key': 'b.zip', 'checksum': 'unknown:1'}]
+    assert download.parse_checksums({'files': entries}) == {'a.zip': download.FileChecksum('md5', 'abc', 3)}
+    assert download.parse_checksums({'metadata': {}}) == {}
+
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_extract_archive_filters(tmp_path, processes):
+    members = {
+        'run_1/a.fom': 'a',
+        'run_1/raw.csv': 'raw',
+        'run_2/b.fom': 'b',
+        'run_2/skip.fom': 'skip',
+        'readme.txt': 'readme',
+    }
+    archive = make_zip(tmp_path / 'data.zip', members)
+
+    extracted = extract_archive(
+        archive, tmp_path / 'out', include=['*.fom'], exclude=['*/skip.*'], processes=processes
+    )
+
+    assert sorted(extracted) == ['run_1/a.fom', 'run_2/b.fom']
+    files = sorted(str(p.relative_to(tmp_path / 'out')) for p in (tmp_path / 'out').rglob('*') if p.is_file())
+    assert files == ['run_1/a.fom', 'run_2/b.fom']
+    assert (tmp_path / 'out' / 'run_2' / 'b.fom').read_text() == 'b'
+
+
+def test_extract_archive_shared_nested_dirs(tmp_path):
+    members = {f'plate_{i % 3}/run_{i % 5}/sample_{i}.fom': str(i) for i in range(60)}
+    members['plate_0/empty/'] = ''
+    archive = make_zip(tmp_path / 'data.zip', members)
+
+    extracted = extract_archive(archive, tmp_path / 'out', processes=4)
+
+    assert sorted(extracted) == sorted(members)
+    assert (tmp_path / 'out' / 'plate_0' / 'empty').is_dir()
+    for name, content in members.items():
+        if not name.endswith('/'):
+            assert (tmp_path / 'out' / name).read_text() == content
+
+
+def test_get_json_retries_rate_limited_requests(fake_caltech, rate_limiters):
+    record_id = fake_caltech.add_record('10.1/a', {'a.txt': 'a'})
+    fake_caltech.rate_limited = 2
+    url = f'https://data.caltech.edu/records/{record_id}'
+
+    record_json = asyncio.run(download.get_json(url, use_cache=False))
+
+    assert 'metadata' in record_json
+    assert len(fake_caltech.requests) == 3
+    limiter = rate_limiters['data.caltech.edu']
+    assert limiter.rate < limiter.max_rate
+
+
+def test_redirected_retries_wait_on_the_limiting_host(fake_caltech, rate_limiters, monkeypatch):
+    record_id = fake_caltech.add_record('10.1/a', {'a.txt': 'a'})
+    fake_caltech.redirects['10.1/json'] = f'https://data.caltech.edu/records/{record_id}/export/json'
+    fake_caltech.rate_limited = 1
+    acquired = []
+    acquire = RateLimiter.acquire
+
+    async def record_acquire(self):
+        acquired.append(self)
+        await acquire(self)
+
+    monkeypatch.setattr(RateLimiter, 'acquire', record_acquire)
+
+    async def get_json():
+        async with httpx.AsyncClient() as client:
+            return await download.rate_limited_get(client, 'https://doi.org/10.1/json', follow_redirects=True)
+
+    response = asyncio.run(get_json())
+
+    assert response.status_code == 200
+    doi_limiter, caltech_limiter = rate_limiters['doi.org'], rate_limiters['data.caltech.edu']
+    assert acquired == [doi_limiter, doi_limiter, caltech_limiter]
+    assert caltech_limiter.failures == 0
+    assert caltech_limiter.rate < caltech_limiter.max_rate
+    assert doi_limiter.rate == doi_limiter.max_rate
+
+
+def test_get_json_gives_up_when_rate_limited(fake_caltech, monkeypatch):
+    record_id = fake_caltech.add_record('10.1/a', {'a.txt': 'a'})
+    fake_caltech.rate_limited = 10
+    monkeypatch.setattr(settings, 'RATE_LIMIT_RETRIES', 2)
+
+    async def get_json():
+        async with httpx.AsyncClient() as client:
+            url = f'https://data.caltech.edu/records/{record_id}/export/json'
+            return await download.rate_limited_get(client, url)
+
+    with pytest.raises(RequestLimitation):
+        asyncio.run(get_json())
+    assert len(fake_caltech.requests) == 3
+
+
+def test_remote_zip_fetches_only_selected_members(file_server, tmp_path):
+    root, url, server = file_server
+    big = os.urandom(4 * 1024 * 1024)
+    members = {'run_1/a.fom': b'fom data' * 100, 'run_2/b.fom': b'b', 'run_1/raw.bin': big}
+    with zipfile.ZipFile(root / 'data.zip', 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        for name, contents in members.items():
+            z.writestr(name, contents)
+
+    async def extract():
+        async with httpx.AsyncClient() as client:
+            remote = await RemoteZip.open(f'{url}/data.zip', client)
+            names = [info.filename for info in remote.infolist()]
+            assert await remote.read(remote.zipfile.getinfo('run_2/b.fom')) == b'b'
+            await remote.extract_all(remote.select(include=['run_1/*.fom']), tmp_path / 'out')
+            return names
+
+    names = asyncio.run(extract())
+
+    assert names == list(members)
+    assert (tmp_path / 'out' / 'run_1' / 'a.fom').read_bytes() == members['run_1/a.fom']
+    assert not (tmp_path / 'out' / 'run_1' / 'raw.bin').exists()
+    # One request for the central directory and one for each member read
+    assert len(server.range_headers) == 3
+    assert server.bytes_sent < len(big) / 10
+
+
+def test_remote_zip_large_central_directory(file_server, tmp_path):
+    root, url, server = file_server
+    members = {f'run_{i // 100}/sample_{i:05d}.txt': f'sample {i}' for i in range(3000)}
+    make_zip(root / 'data.zip', members)
+    selected = [f'run_{i // 100}/sample_{i:05d}.txt' for i in range(0, 3000, 150)]
+
+    async def extract():
+        async with httpx.AsyncClient() as client:
+            remote = await RemoteZip.open(f'{url}/data.zip', client)
+            assert remote.size - remote._directory_offset > remote_archive._TAIL_SIZE
+            infos = [remote.zipfile.getinfo(name) for name in selected]
+            await remote.extract_all(infos, tmp_path / 'out', concurrency=2)
+            return remote
+
+    remote = asyncio.run(extract())
+
+    assert len(remote.infolist()) == 3000
+    for name in selected:
+        assert (tmp_path / 'out' / name).read_text() == members[name]
+    # Only the central directory is still held once every member is written
+    assert [start for start, _ in remote._sparse.ranges] == [remote._directory_offset]
+
+
+def test_remote_zip_requires_range_support(file_server):
+    root, url, server = file_server
+    make_zip(root / 'data.zip', {'a.txt': 'a'})
+    server.support_ranges = False
+
+    async def open_remote():
+        async with httpx.AsyncClient() as client:
+            await RemoteZip.open(f'{url}/data.zip', client)
+
+    with pytest.raises(RangeRequestsNotSupported):
+        asyncio.run(open_remote())
+
+
+def _build_mirror(root, dois):
+    fake = FakeCaltech()
+    for doi in dois:
+        fake.add_record(doi, {'a.txt': doi, 'b.txt': 'b'})
+
+    async def mirror():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(fake.handler)) as client:
+            for doi in dois:
+                await mirror_doi(doi, root, client)
+
+    asyncio.run(mirror())
+    return fake
+
+
+@pytest.mark.parametrize('served', [False, True])
+def test_download_from_mirror(file_server, tmp_path, monkeypatch, served):
+    root, url, server = file_server
+    fake = _build_mirror(root, ['10.1/a', '10.1/b'])
+    assert (root / 'doi.org' / '10.1' / 'a').read_text() == 'https://data.caltech.edu/records/10.1-a'
+    monkeypatch.setattr(settings, 'DOI_MIRROR', url if served else str(root))
+
+    results = asyncio.run(
+        download.async_download_dois([('10.1/a', tmp_path / 'a'), ('10.1/b', tmp_path / 'b')])
+    )
+
+    assert all(result.ok for result in results)
+    assert (tmp_path / 'b' / 'a.txt').read_text() == '10.1/b'
+    assert len(fake.requests) == 6
+    assert (server.bytes_sent > 0) == served
+    with pytest.raises(DOINotFound):
+        asyncio.run(download.async_download_doi('10.1/missing', tmp_path / 'missing'))
+    # Range requests are served for random access into archives
+    members = asyncio.run(list_archive_members('10.1/a', use_cache=False))
+    assert [member.filename for member in members] == ['a.txt', 'b.txt']
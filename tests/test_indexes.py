@@ -0,0 +1,102 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from uuid import uuid4
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from mps_client.core import indexes, queries, views
+from mps_client.core.queries import _sample_process_history_stmt
+from mps_client.utils.sql import Explain
+
+
+def test_join_index_ddl():
+    spec = indexes.JOIN_INDEXES[0]
+
+    assert spec.ddl('production') == (
+        'CREATE INDEX CONCURRENTLY ix_sample_process_sample_id ON production.sample_process (sample_id)'
+        ' INCLUDE (process_id)'
+    )
+    assert spec.ddl('production', concurrently=False).startswith(
+        'CREATE INDEX ix_sample_process_sample_id ON'
+    )
+    assert indexes.curated_indexes() == indexes.JOIN_INDEXES
+
+
+def test_view_indexes_ddl():
+    specs = indexes.view_indexes(views.FOM_FACTS)
+
+    assert [spec.name for spec in specs] == [
+        'ix_sample_fom_analysis_id_sample_process_id_plate_id',
+        'ix_sample_fom_plate_label_analysis_name',
+        'ix_sample_fom_sample_id',
+    ]
+    assert specs[0].ddl('production') == (
+        'CREATE UNIQUE INDEX CONCURRENTLY ix_sample_fom_analysis_id_sample_process_id_plate_id'
+        ' ON production.sample_fom (analysis_id, sample_process_id, plate_id)'
+    )
+    assert not specs[1].unique
+    curated = indexes.curated_indexes([views.PROCESS_HISTORY, views.FOM_FACTS])
+    assert len({spec.name for spec in curated}) == len(indexes.JOIN_INDEXES) + 5
+
+
+class FakeConnection:
+    """Answers the lookups of a sample, plate and analysis name."""
+
+    def execute(self, stmt):
+        return self
+
+    def first(self):
+        return uuid4(), 'sample_1'
+
+    def scalar(self):
+        return 'value'
+
+
+@pytest.mark.parametrize('from_view', [False, True])
+def test_workloads_match_queries(monkeypatch, from_view):
+    monkeypatch.setattr(indexes, 'has_view', lambda view: from_view)
+    monkeypatch.setattr(queries, 'has_view', lambda view: from_view)
+
+    workloads = dict(indexes._workloads(FakeConnection()))
+
+    assert list(workloads) == [
+        'sample',
+        'process history',
+        'process histories',
+        'plate doi',
+        'sample foms',
+        'foms',
+    ]
+    for name in ('process history', 'process histories', 'sample foms', 'foms'):
+        compiled = str(workloads[name].compile(dialect=postgresql.dialect()))
+        # The views are read without joins, the tables they are defined from only with them
+        assert ('JOIN' not in compiled) == from_view
+
+
+def test_explain():
+    stmt = _sample_process_history_stmt(uuid4(), None)
+
+    compiled = str(Explain(stmt, analyze=True).compile(dialect=postgresql.dialect()))
+
+    assert compiled.startswith('EXPLAIN (ANALYZE, FORMAT JSON) SELECT array_agg(')
+    assert str(Explain(stmt).compile(dialect=postgresql.dialect())).startswith('EXPLAIN (FORMAT JSON) SELECT')
+
+
+def test_speedups():
+    timing = indexes.QueryTiming('q', cost_before=100.0, cost_after=4.0, ms_before=30.0)
+
+    assert timing.estimated_speedup == 25.0
+    assert timing.observed_speedup is None
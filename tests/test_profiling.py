@@ -0,0 +1,47 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import asyncio
+
+from mps_client.utils.profiling import collect_report, stage, summarize
+
+
+def test_stages_outside_report_are_ignored():
+    with stage('transfer') as stats:
+        stats.bytes += 10
+
+
+def test_reports_are_isolated_between_tasks():
+    async def work(name, size):
+        with collect_report(name) as report:
+            with stage('transfer') as stats:
+                await asyncio.sleep(0.01)
+                stats.bytes += size
+            with stage('transfer') as stats:
+                stats.bytes += size
+        return report
+
+    async def main():
+        return await asyncio.gather(work('a', 1), work('b', 100))
+
+    a, b = asyncio.run(main())
+    assert a.stages['transfer'].count == 2
+    assert a.stages['transfer'].bytes == 2
+    assert b.stages['transfer'].bytes == 200
+    assert a.stages['transfer'].seconds >= 0.01
+
+    totals = summarize([a, b])
+    assert totals['transfer'].count == 4
+    assert totals['transfer'].bytes == 202
+    assert totals['transfer'].mb_per_s > 0
@@ -0,0 +1,325 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from uuid import uuid4
+
+import numpy as np
+import pytest
+from sqlalchemy import create_mock_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.elements import TextClause
+
+from mps_client._enums import EntityType, Fom, GroupBy
+from mps_client.configuration import settings
+from mps_client.core import queries, views
+
+
+class FakeSession:
+    """Records the statements executed and answers them with canned rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.statements = []
+        # The latest updated_on and release names answering every aggregate query
+        self.version = (None, [])
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def exec(self, stmt, params=None):
+        self.statements.append(stmt)
+        self.params = params
+        return self
+
+    def all(self):
+        return self.rows
+
+    def one(self):
+        return self.version
+
+    def one_or_none(self):
+        return self.rows[0] if self.rows else None
+
+    def execute(self, stmt, execution_options=None):
+        self.statements.append(stmt)
+        self.execution_options = execution_options
+        return self
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def connection(self):
+        return FakeConnection(self)
+
+    def partitions(self, size):
+        for start in range(0, len(self.rows), size):
+            yield self.rows[start : start + size]
+
+
+class FakeConnection:
+    """Stands in for both the sqlalchemy connection and the psycopg2 connection and cursor under it."""
+
+    def __init__(self, session):
+        self.session = session
+        self.connection = self
+
+    def cursor(self):
+        return self
+
+    def copy_expert(self, sql, file):
+        self.session.statements.append(sql)
+        file.write(b'id,label\n1,a\n2,\n')
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_session(monkeypatch):
+    session = FakeSession([])
+    monkeypatch.setattr(queries, 'Session', session)
+    monkeypatch.setattr(queries, 'has_view', lambda view: False)
+    return session
+
+
+def compile_postgres(stmt):
+    return stmt.compile(dialect=postgresql.dialect())
+
+
+def test_get_process_histories_single_query(fake_session):
+    first, second = uuid4(), uuid4()
+    history = ([uuid4()], ['anneal'], ['furnace'])
+    fake_session.rows = [(*history, first, 'plate_1'), ([], [], [], second, 'plate_2')]
+
+    histories = queries.get_process_histories([first, uuid4()], ['plate_2', 'missing'])
+
+    assert histories == {first: history, 'plate_2': ([], [], [])}
+    assert len(fake_session.statements) == 1
+    compiled = compile_postgres(fake_session.statements[0])
+    assert 'sample.id = ANY (CAST(%(sample_ids)s::VARCHAR[] AS UUID[]))' in str(compiled)
+    assert 'sample.label = ANY (%(sample_labels)s::VARCHAR[])' in str(compiled)
+    assert compiled.params['sample_labels'] == ['plate_2', 'missing']
+
+
+def test_get_process_histories_empty(fake_session):
+    assert queries.get_process_histories() == {}
+    assert fake_session.statements == []
+
+
+def test_stream_raw_query(fake_session):
+    fake_session.rows = [(i,) for i in range(5)]
+
+    assert list(queries.stream_raw_query('select 1', fetch_size=2)) == fake_session.rows
+    assert fake_session.execution_options == {'stream_results': True, 'yield_per': 2}
+    batches = list(queries.stream_raw_query('select 1', fetch_size=2, batches=True))
+    assert batches == [[(0,), (1,)], [(2,), (3,)], [(4,)]]
+
+
+def test_run_raw_query_as_frame(fake_session):
+    frame = queries.run_raw_query('select id, label from sample;\n', as_frame=True, dtype={'label': str})
+
+    assert fake_session.statements == [
+        'COPY (select id, label from sample\n) TO STDOUT WITH (FORMAT csv, HEADER)'
+    ]
+    assert list(frame.columns) == ['id', 'label']
+    assert frame['id'].tolist() == [1, 2]
+    assert frame['label'].isna().tolist() == [False, True]
+
+
+@pytest.mark.parametrize(
+    'query',
+    [
+        'select id from sample;',
+        'select id from sample -- trailing comment',
+        'select id from sample; -- trailing comment\n',
+        'select id from sample /* block; comment */ ;;\n',
+    ],
+)
+def test_copy_query_strips_statement_end(query):
+    assert queries._copy_query(query) == query[: len('select id from sample')]
+
+
+def test_copy_query_keeps_quoted_text():
+    query = "select ';' as a, '--' as \"b;\" from sample"
+    assert queries._copy_query(query + ';') == query
+
+
+def test_copy_query_rejects_multiple_statements():
+    with pytest.raises(ValueError, match='single statement'):
+        queries._copy_query('select 1; drop table sample')
+
+
+def test_run_raw_query_cache(fake_session, monkeypatch):
+    monkeypatch.setattr(settings, 'QUERY_CACHE_ENABLED', True)
+    fake_session.rows = [(1, 'a')]
+    fake_session.version = ('2022-01-01', ['release_1'])
+
+    def run_count():
+        return sum(isinstance(stmt, TextClause) for stmt in fake_session.statements)
+
+    assert queries.run_raw_query('select *\n  from sample where label = :label', params={'label': 'a'}) == [
+        (1, 'a')
+    ]
+    assert fake_session.params == {'label': 'a'}
+    fake_session.rows = [(2, 'b')]
+    assert queries.run_raw_query('select * from sample where label = :label;', params={'label': 'a'}) == [
+        (1, 'a')
+    ]
+    assert run_count() == 1
+    # Different parameters, an explicit opt out and a new release all run the query again
+    assert queries.run_raw_query('select * from sample where label = :label', params={'label': 'b'}) == [
+        (2, 'b')
+    ]
+    assert queries.run_raw_query(
+        'select * from sample where label = :label', params={'label': 'a'}, use_cache=False
+    )
+    fake_session.version = ('2022-01-01', ['release_1', 'release_2'])
+    assert queries.run_raw_query('select * from sample where label = :label', params={'label': 'a'}) == [
+        (2, 'b')
+    ]
+    assert run_count() == 4
+
+
+def test_run_raw_query_cache_frame(fake_session):
+    first = queries.run_raw_query('select id, label from sample', as_frame=True, use_cache=True)
+    second = queries.run_raw_query('select id, label from sample', as_frame=True, use_cache=True)
+
+    assert len([stmt for stmt in fake_session.statements if isinstance(stmt, str)]) == 1
+    assert second.equals(first)
+
+
+def test_get_dois_single_query(fake_session):
+    plate, run, analysis, missing_run = uuid4(), uuid4(), uuid4(), uuid4()
+    fake_session.rows = [
+        ('plate', True, str(plate), '10.1/plate'),
+        ('run', True, str(run), None),
+        ('analysis', True, str(analysis), '10.1/analysis'),
+        ('plate', False, 'plate_1', '10.1/plate_1'),
+    ]
+    entities = [
+        (EntityType.PLATE, plate),
+        (EntityType.RUN, run),
+        (EntityType.RUN, missing_run),
+        (EntityType.ANALYSIS, analysis),
+        (EntityType.PLATE, 'plate_1'),
+        (EntityType.PLATE, 'plate_2'),
+    ]
+
+    dois, missing = queries.get_dois(entities)
+
+    assert dois == {
+        (EntityType.PLATE, plate): '10.1/plate',
+        (EntityType.RUN, run): None,
+        (EntityType.ANALYSIS, analysis): '10.1/analysis',
+        (EntityType.PLATE, 'plate_1'): '10.1/plate_1',
+    }
+    assert missing == [(EntityType.RUN, missing_run), (EntityType.PLATE, 'plate_2')]
+    assert len(fake_session.statements) == 1
+    compiled = compile_postgres(fake_session.statements[0])
+    assert str(compiled).count('UNION ALL') == 3
+    assert compiled.params['run_ids'] == [str(run), str(missing_run)]
+    assert compiled.params['plate_labels'] == ['plate_1', 'plate_2']
+
+
+def test_get_dois_label_for_run(fake_session):
+    with pytest.raises(ValueError, match='Cannot provide a label'):
+        queries.get_dois([(EntityType.RUN, 'run_1')])
+    assert queries.get_dois([]) == ({}, [])
+    assert fake_session.statements == []
+
+
+def test_process_history_from_view(fake_session, monkeypatch):
+    monkeypatch.setattr(queries, 'has_view', lambda view: view is views.PROCESS_HISTORY)
+    sample_id = uuid4()
+
+    queries.get_process_history(sample_label='plate_1')
+    queries.get_process_histories([sample_id])
+
+    for stmt in fake_session.statements:
+        compiled = str(compile_postgres(stmt))
+        assert 'FROM production.sample_process_history' in compiled
+        assert 'JOIN' not in compiled
+
+
+def test_process_history_view_ddl():
+    statements = []
+    engine = create_mock_engine('postgresql://', lambda sql, *args, **kwargs: statements.append(sql))
+
+    views.PROCESS_HISTORY.create(engine)
+
+    create, *indexes = [str(statement.compile(dialect=engine.dialect)) for statement in statements]
+    assert create.startswith('CREATE MATERIALIZED VIEW production.sample_process_history AS SELECT')
+    assert create.endswith('GROUP BY production.sample.id WITH DATA')
+    assert sorted(indexes) == [
+        'CREATE INDEX ix_sample_process_history_sample_label ON production.sample_process_history (sample_label)',
+        'CREATE UNIQUE INDEX ix_sample_process_history_sample_id ON production.sample_process_history (sample_id)',
+    ]
+
+
+def test_get_sample_foms(fake_session, monkeypatch):
+    queries.get_sample_foms('plate_1', 'CA_FOMS_standard', foms=[Fom.I_A_AVE])
+    monkeypatch.setattr(queries, 'has_view', lambda view: True)
+    queries.get_sample_foms('plate_1', 'CA_FOMS_standard', foms=[Fom.I_A_AVE])
+
+    assert 'I.A_ave' in compile_postgres(fake_session.statements[0]).params.values()
+    join, view = [str(compile_postgres(stmt)) for stmt in fake_session.statements]
+    assert 'JOIN production.collection__sample' in join
+    assert 'FROM production.sample_fom' in view
+    assert 'JOIN' not in view
+    for compiled in (join, view):
+        assert 'sample_fom.plate_label = %(plate_label_1)s' in compiled
+        assert 'sample_fom.analysis_name = %(analysis_name_1)s' in compiled
+        assert 'sample_fom.i_a_ave' in compiled
+        assert 'sample_fom.q_c' not in compiled
+
+
+@pytest.mark.parametrize(
+    'group_by, aggregate',
+    [
+        (GroupBy.MAX, 'max(production.sample_fom.i_a_ave)'),
+        (GroupBy.MEAN, 'avg(production.sample_fom.i_a_ave)'),
+        (
+            GroupBy.MEDIAN,
+            'percentile_cont(%(percentile_cont_1)s) WITHIN GROUP (ORDER BY production.sample_fom.i_a_ave)',
+        ),
+        (GroupBy.MIN, 'min(production.sample_fom.i_a_ave)'),
+    ],
+)
+def test_get_foms(fake_session, monkeypatch, group_by, aggregate):
+    monkeypatch.setattr(queries, 'has_view', lambda view: True)
+    first, second = uuid4(), uuid4()
+    fake_session.rows = [(first, 'a', 1.5, 2), (second, 'b', None, 0)]
+
+    foms = queries.get_foms('plate_1', 'CA_FOMS_standard', Fom.I_A_AVE, group_by)
+
+    assert list(foms.sample_ids) == [first, second]
+    assert list(foms.sample_labels) == ['a', 'b']
+    assert foms.values.dtype == np.float64
+    np.testing.assert_array_equal(foms.values, [1.5, np.nan])
+    assert list(foms.counts) == [2, 0]
+    compiled = str(compile_postgres(fake_session.statements[0]))
+    assert aggregate in compiled
+    assert 'GROUP BY production.sample_fom.sample_id, production.sample_fom.sample_label' in compiled
+
+
+def test_get_foms_empty(fake_session):
+    foms = queries.get_foms('plate_1', 'CA_FOMS_standard', Fom.Q_C, GroupBy.MEAN)
+
+    assert foms.values.shape == foms.sample_ids.shape == (0,)
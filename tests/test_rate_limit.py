@@ -0,0 +1,60 @@
+#   Copyright 2022 Modelyst LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+from mps_client.utils.rate_limit import RateLimiter, get_rate_limiter, parse_retry_after
+
+
+def test_tokens_are_spaced_at_rate():
+    limiter = RateLimiter(max_rate=10, burst=2)
+    waits = [limiter.reserve() for _ in range(4)]
+    assert waits[:2] == [0, 0]
+    assert waits[2] == pytest.approx(0.1, abs=0.01)
+    assert waits[3] == pytest.approx(0.2, abs=0.01)
+
+
+def test_rate_limited_honors_retry_after_and_recovers():
+    limiter = RateLimiter(max_rate=10, burst=5)
+    assert limiter.on_rate_limited(retry_after=3) == 3
+    assert limiter.rate == 5
+    assert limiter.reserve() == pytest.approx(3, abs=0.01)
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.rate == 10
+    assert limiter.failures == 0
+
+
+def test_backoff_grows_exponentially_with_jitter():
+    limiter = RateLimiter(max_rate=10, max_backoff=8)
+    delays = [limiter.on_rate_limited() for _ in range(6)]
+    for delay, backoff in zip(delays, [1, 2, 4, 8, 8, 8]):
+        assert backoff / 2 <= delay <= backoff
+    assert limiter.rate == pytest.approx(10 / 2**6)
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after('garbage') is None
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert parse_retry_after(format_datetime(retry_at, usegmt=True)) == pytest.approx(30, abs=2)
+
+
+def test_limiters_are_shared_per_host():
+    assert get_rate_limiter('data.caltech.edu') is get_rate_limiter('data.caltech.edu')
+    assert get_rate_limiter('data.caltech.edu') is not get_rate_limiter('doi.org')